@@ -26,6 +26,7 @@ MC_xicc_eff.* MC_xicc_pT.* \
 MC_jpsi_eff.* MC_jpsi_pT.* \
 MC_lc-tok0sP_eff.* MC_lc-tok0sP_pT.* \
 ./*.log \
+metrics_o2.* \
 output_* \
 || { echo "Error: Failed to delete files."; exit 1; }
 
@@ -32,6 +32,10 @@ DOPOSTPROCESS=1     # Run output postprocessing. (Comparison plots. Requires DOA
 # O2 database
 DATABASE_O2="workflows.yml"
 MAKE_GRAPH=0        # Make topology graph.
+GRAPH_METRICS=""    # Resource metrics of workflows (e.g. a copy of metrics_o2.json from a previous run) to annotate the topology graph with ("" = cost hints of the database)
+TUNE_MEMORY=0       # Derive the DPL memory settings and the number of AOD readers from the workflows, the input files and the shared memory available to parallel jobs. (0 = use the database options, 1 = replace them with a warning)
+NCORES_PIPELINE=0   # Number of cores to distribute among parallel replicas of heavy workflows per job. (0 = no automatic replicas)
+O2_STAGE_CUT=""     # Workflows at which to cut the topology into reusable upstream and downstream stages, e.g. "o2-analysis-hf-track-index-skim-creator_skimX". (empty = single stage)
 
 # Activation of O2 workflows
 # Trigger selection
@@ -137,6 +141,7 @@ APPLYCUTS_B0=0      # Apply B0 selection cuts.
 APPLYCUTS_BPLUS=0   # Apply B+ selection cuts.
 
 SAVETREES=0         # Save O2 tables to trees.
+TABLES_KEEP=""      # Tables to be saved even if they are consumed by other workflows. (Only terminal tables are saved by default.)
 USEO2VERTEXER=1     # Use the O2 vertexer in AliPhysics.
 USEALIEVCUTS=1      # Use AliEventCuts in AliPhysics (as used by conversion task)
 DORATIO=1           # Plot histogram ratios in comparison.
@@ -150,7 +155,7 @@ function Clean {
 
   # Cleanup after running
   [ "$1" -eq 2 ] && {
-    rm -f "$LISTFILES_ALI" "$LISTFILES_O2" "$SCRIPT_ALI" "$SCRIPT_O2" "$SCRIPT_POSTPROCESS" || ErrExit "Failed to rm created files."
+    rm -f "$LISTFILES_ALI" "$LISTFILES_O2" "$SCRIPT_ALI" "$SCRIPT_O2" "$SCRIPT_O2_UPSTREAM" "$SCRIPT_POSTPROCESS" || ErrExit "Failed to rm created files."
     [ "$JSON_EDIT" ] && { rm "$JSON_EDIT" || ErrExit "Failed to rm $JSON_EDIT."; }
     [ "$DATABASE_O2_EDIT" ] && { rm "$DATABASE_O2_EDIT" || ErrExit "Failed to rm $DATABASE_O2_EDIT."; }
   }
@@ -160,224 +165,23 @@ function Clean {
 
 # Modify the JSON file.
 function AdjustJson {
-  # Make a copy of the default JSON file to modify it.
+  # Make a modified copy of the default JSON file.
   JSON_EDIT="${JSON/.json/_edit.json}"
-  cp "$JSON" "$JSON_EDIT" || ErrExit "Failed to cp $JSON $JSON_EDIT."
-  JSON="$JSON_EDIT"
 
   # Derived AO2D input
-  if [ "$INPUT_PARENT_MASK" ]; then
-    ReplaceString "PARENT_PATH_MASK" "$INPUT_PARENT_MASK" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-
-  # Collision system
-  MsgWarn "Setting collision system $INPUT_SYS"
-
-  # Run 2/3/5
-  MsgWarn "Using Run $INPUT_RUN"
-  if [ "$INPUT_RUN" -eq 2 ]; then
-    ReplaceString "\"processRun2\": \"false\"" "\"processRun2\": \"true\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"processRun3\": \"true\"" "\"processRun3\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  elif [ "$INPUT_RUN" -eq 3 ]; then
-    ReplaceString "\"processRun2\": \"true\"" "\"processRun2\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"processRun3\": \"false\"" "\"processRun3\": \"true\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-
-  # MC
-  if [ "$INPUT_IS_MC" -eq 1 ]; then
-    MsgWarn "Using MC data"
-    ReplaceString "\"processMc\": \"false\"" "\"processMc\": \"true\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"processMC\": \"false\"" "\"processMC\": \"true\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"isMC\": \"false\"" "\"isMC\": \"true\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  else
-    MsgWarn "Using real data"
-    ReplaceString "\"processMc\": \"true\"" "\"processMc\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"processMC\": \"true\"" "\"processMC\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"isMC\": \"true\"" "\"isMC\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"processData\": \"false\"" "\"processData\": \"true\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-
-  # event-selection
-  ReplaceString "\"syst\": \"pp\"" "\"syst\": \"$INPUT_SYS\"" "$JSON" || ErrExit "Failed to edit $JSON."
-
-  # hf-track-index-skim-creator-tag-sel-collisions
-  if [ $DOO2_TRIGSEL -eq 1 ]; then
-    # trigger selection
-    ReplaceString "\"processTrigSel\": \"false\"" "\"processTrigSel\": \"true\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"processNoTrigSel\": \"true\"" "\"processNoTrigSel\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-  if [ "$INPUT_RUN" -eq 3 ]; then
-    # do not use trigger selection for Run 3
-    ReplaceString "\"processTrigSel\": \"true\"" "\"processTrigSel\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"processNoTrigSel\": \"false\"" "\"processNoTrigSel\": \"true\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-
-  # hf-track-index-skim-creator-tag-sel-tracks, hf-track-index-skim-creator-cascades
-  if [ "$INPUT_RUN" -eq 3 ]; then
-    # do not perform track quality cuts for Run 3 until they are updated
-    ReplaceString "\"doCutQuality\": \"true\"" "\"doCutQuality\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-
-  # hf-track-index-skim-creator-cascades
-  if [[ $DOO2_CAND_CASC -eq 1 || $DOO2_SEL_LCK0SP -eq 1 || $DOO2_TASK_LCK0SP -eq 1 || $DOO2_TREE_LCK0SP -eq 1 ]]; then
-    ReplaceString "\"processCascades\": \"false\"" "\"processCascades\": \"true\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"processNoCascades\": \"true\"" "\"processNoCascades\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-
-  # timestamp-task
-  if [[ "$INPUT_IS_MC" -eq 1 && "$INPUT_RUN" -eq 2 ]]; then
-    ReplaceString "\"isRun2MC\": \"false\"" "\"isRun2MC\": \"true\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  else
-    ReplaceString "\"isRun2MC\": \"true\"" "\"isRun2MC\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-
-  # track-selection
-  if [ "$INPUT_RUN" -eq 3 ]; then
-    ReplaceString "\"isRun3\": \"false\"" "\"isRun3\": \"true\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  else
-    ReplaceString "\"isRun3\": \"true\"" "\"isRun3\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-
-  # lambdakzero-builder
-  if [ "$INPUT_RUN" -eq 2 ]; then
-    ReplaceString "\"isRun2\": \"0\"" "\"isRun2\": \"1\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  else
-    ReplaceString "\"isRun2\": \"1\"" "\"isRun2\": \"0\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-
-  # hf-track-index-skim-creator..., hf-candidate-creator-...
-  if [ "$INPUT_RUN" -eq 2 ]; then
-    ReplaceString "\"isRun2\": \"false\"" "\"isRun2\": \"true\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  else
-    ReplaceString "\"isRun2\": \"true\"" "\"isRun2\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-
-  # tof-event-time
-  if [ "$INPUT_RUN" -eq 3 ]; then
-    ReplaceString "\"processNoFT0\": \"false\"" "\"processNoFT0\": \"true\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  else
-    ReplaceString "\"processNoFT0\": \"true\"" "\"processNoFT0\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-
-  # hf-task-flow
-  if [ "$INPUT_RUN" -eq 3 ]; then
-    ReplaceString "\"processSameRun3\": \"false\"" "\"processSameRun3\": \"true\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"processSameRun2\": \"true\"" "\"processSameRun2\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  else
-    ReplaceString "\"processSameRun3\": \"true\"" "\"processSameRun3\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"processSameRun2\": \"false\"" "\"processSameRun2\": \"true\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-
-  # jet-finder-charged-d0-qa
-  if [ "$INPUT_IS_MC" -eq 1 ]; then
-    ReplaceString "\"processJetsData\": \"true\"" "\"processJetsData\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  else
-    ReplaceString "\"processJetsMCD\": \"true\"" "\"processJetsMCD\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"processJetsMCP\": \"true\"" "\"processJetsMCP\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-
-  # jet-substructure...
-  if [ "$INPUT_IS_MC" -eq 1 ]; then
-    ReplaceString "\"processChargedJetsHF_data\": \"true\"" "\"processChargedJetsHF_data\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"processOutput_data\": \"true\"" "\"processOutput_data\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"processDummy_data\": \"false\"" "\"processDummy_data\": \"true\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  else
-    ReplaceString "\"processChargedJetsHF_mcd\": \"true\"" "\"processChargedJetsHF_mcd\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"processChargedJetsHFMCP_mcp\": \"true\"" "\"processChargedJetsHFMCP_mcp\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"processOutput_mcd\": \"true\"" "\"processOutput_mcd\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"processOutput_mcp\": \"true\"" "\"processOutput_mcp\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"processDummy_mcd\": \"false\"" "\"processDummy_mcd\": \"true\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"processDummy_mcp\": \"false\"" "\"processDummy_mcp\": \"true\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-  ReplaceString "\"processChargedJetsHF_data\"" "\"processChargedJetsHF\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  ReplaceString "\"processChargedJetsHF_mcd\"" "\"processChargedJetsHF\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  ReplaceString "\"processChargedJetsHFMCP_mcp\"" "\"processChargedJetsHFMCP\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  ReplaceString "\"processOutput_data\"" "\"processOutput\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  ReplaceString "\"processOutput_mcd\"" "\"processOutput\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  ReplaceString "\"processOutput_mcp\"" "\"processOutput\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  ReplaceString "\"processDummy_data\"" "\"processDummy\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  ReplaceString "\"processDummy_mcd\"" "\"processDummy\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  ReplaceString "\"processDummy_mcp\"" "\"processDummy\"" "$JSON" || ErrExit "Failed to edit $JSON."
-
-  # Enable D0 selection.
-  if [ $APPLYCUTS_D0 -eq 1 ]; then
-    MsgWarn "Using D0 selection cuts"
-    ReplaceString "\"selectionFlagD0\": \"0\"" "\"selectionFlagD0\": \"1\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"selectionFlagD0bar\": \"0\"" "\"selectionFlagD0bar\": \"1\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-
-  # Enable Ds selection.
-  if [ $APPLYCUTS_DS -eq 1 ]; then
-    MsgWarn "Using Ds selection cuts"
-    ReplaceString "\"selectionFlagDs\": \"0\"" "\"selectionFlagDs\": \"7\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-
-  # Enable D+ selection.
-  if [ $APPLYCUTS_DPLUS -eq 1 ]; then
-    MsgWarn "Using D+ selection cuts"
-    ReplaceString "\"selectionFlagDplus\": \"0\"" "\"selectionFlagDplus\": \"7\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-
-  # Enable Λc selection.
-  if [ $APPLYCUTS_LC -eq 1 ]; then
-    MsgWarn "Using Λc selection cuts"
-    ReplaceString "\"selectionFlagLc\": \"0\"" "\"selectionFlagLc\": \"1\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-
-  # Enable Λb selection.
-  if [ $APPLYCUTS_LB -eq 1 ]; then
-    MsgWarn "Using Λb selection cuts"
-    ReplaceString "\"selectionFlagLb\": \"0\"" "\"selectionFlagLb\": \"1\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-
-  # Enable Ξc selection.
-  if [ $APPLYCUTS_XIC -eq 1 ]; then
-    MsgWarn "Using Ξc selection cuts"
-    ReplaceString "\"selectionFlagXic\": \"0\"" "\"selectionFlagXic\": \"1\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-
-  # Enable J/ψ selection.
-  if [ $APPLYCUTS_JPSI -eq 1 ]; then
-    MsgWarn "Using J/ψ selection cuts"
-    ReplaceString "\"selectionFlagJpsi\": \"0\"" "\"selectionFlagJpsi\": \"1\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-
-  # Enable X(3872) selection.
-  if [ $APPLYCUTS_X -eq 1 ]; then
-    MsgWarn "Using X(3872) selection cuts"
-    ReplaceString "\"selectionFlagX\": \"0\"" "\"selectionFlagX\": \"1\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-
-  # Enable χc(1p) selection.
-  if [ $APPLYCUTS_CHIC -eq 1 ]; then
-    MsgWarn "Using χc(1p) selection cuts"
-    ReplaceString "\"selectionFlagChic\": \"0\"" "\"selectionFlagChic\": \"1\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-
-  # Enable Λc → K0S p selection.
-  if [ $APPLYCUTS_LCK0SP -eq 1 ]; then
-    MsgWarn "Using Λc → K0S p selection cuts"
-    ReplaceString "\"selectionFlagLcToK0sP\": \"0\"" "\"selectionFlagLcToK0sP\": \"1\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"selectionFlagLcbarToK0sP\": \"0\"" "\"selectionFlagLcbarToK0sP\": \"1\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-
-  # Enable Ξcc selection.
-  if [ $APPLYCUTS_XICC -eq 1 ]; then
-    MsgWarn "Using Ξcc selection cuts"
-    ReplaceString "\"selectionFlagXicc\": \"0\"" "\"selectionFlagXicc\": \"1\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-
-  # Enable B0 selection.
-  if [ $APPLYCUTS_B0 -eq 1 ]; then
-    MsgWarn "Using B0 selection cuts"
-    ReplaceString "\"selectionFlagB0\": \"0\"" "\"selectionFlagB0\": \"1\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-
-  # Enable B+ selection.
-  if [ $APPLYCUTS_BPLUS -eq 1 ]; then
-    MsgWarn "Using B+ selection cuts"
-    ReplaceString "\"selectionFlagBplus\": \"0\"" "\"selectionFlagBplus\": \"1\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
+  PARENT_PATH="$INPUT_PARENT_MASK"
+  # Derived AO2Ds of the upstream stage refer to their parent files by their full paths.
+  [[ ! "$PARENT_PATH" && "$O2_STAGE_CUT" ]] && PARENT_PATH=";"
+
+  # Apply the rules in json_rules.yml.
+  OPT_JSON="-s INPUT_RUN=$INPUT_RUN -s INPUT_IS_MC=$INPUT_IS_MC -s INPUT_SYS=$INPUT_SYS"
+  for Var in ${!DOO2_@} ${!APPLYCUTS_@}; do
+    OPT_JSON+=" -s $Var=${!Var}"
+  done
+  [ "$DIR_CACHE_JSON" ] && OPT_JSON+=" -c $DIR_CACHE_JSON"
+  # shellcheck disable=SC2086 # Ignore unquoted options.
+  python3 "$DIR_EXEC/adjust_json.py" "$JSON" "$JSON_EDIT" "$DIR_TASKS/json_rules.yml" -s "PARENT_PATH=$PARENT_PATH" $OPT_JSON || ErrExit "Failed to edit $JSON."
+  JSON="$JSON_EDIT"
 }
 
 # Generate the O2 script containing the full workflow specification.
@@ -498,7 +302,11 @@ function MakeScriptO2 {
   [ "$INPUT_IS_MC" -eq 1 ] && OPT_MAKECMD+=" --mc"
   [ "$DEBUG" -eq 1 ] && OPT_MAKECMD+=" -d"
   [ $SAVETREES -eq 1 ] && OPT_MAKECMD+=" -t"
+  [[ $SAVETREES -eq 1 && "$TABLES_KEEP" ]] && OPT_MAKECMD+=" -k ${TABLES_KEEP// /,}"
   [ $MAKE_GRAPH -eq 1 ] && OPT_MAKECMD+=" -g"
+  [[ $MAKE_GRAPH -eq 1 && "$GRAPH_METRICS" ]] && OPT_MAKECMD+=" --metrics $GRAPH_METRICS"
+  [ $NCORES_PIPELINE -gt 0 ] && OPT_MAKECMD+=" -p $NCORES_PIPELINE"
+  [ $TUNE_MEMORY -eq 1 ] && OPT_MAKECMD+=" -m -i $LISTFILES_O2 --files-per-job $NFILESPERJOB_O2 --jobs $NJOBSPARALLEL_O2"
 
   # Make a copy of the default workflow database file before modifying it.
   DATABASE_O2_EDIT="${DATABASE_O2/.yml/_edit.yml}"
@@ -510,12 +318,38 @@ function MakeScriptO2 {
   ReplaceString "$SUFFIX_SKIM_MASK" "$SUFFIX_SKIM" "$DATABASE_O2" || ErrExit "Failed to edit $DATABASE_O2."
   ReplaceString "$SUFFIX_DER_MASK" "$SUFFIX_DER" "$DATABASE_O2" || ErrExit "Failed to edit $DATABASE_O2."
 
+  # Staged mode: Cut the topology into the upstream stage producing a reusable derived AO2D and the downstream stage.
+  if [ "$O2_STAGE_CUT" ]; then
+    [ "$INPUT_PARENT_MASK" ] && ErrExit "The staged mode cannot be used with derived AO2D input."
+    STAGE_CUT="$O2_STAGE_CUT"
+    STAGE_CUT="${STAGE_CUT//$SUFFIX_RUN_MASK/$SUFFIX_RUN}"
+    STAGE_CUT="${STAGE_CUT//$SUFFIX_SKIM_MASK/$SUFFIX_SKIM}"
+    STAGE_CUT="${STAGE_CUT//$SUFFIX_DER_MASK/$SUFFIX_DER}"
+    # shellcheck disable=SC2086 # Ignore unquoted variable to squeeze spaces.
+    OPT_MAKECMD+=" -c $(echo $STAGE_CUT | tr " " ",")"
+    SCRIPT_O2_UPSTREAM="script_o2_upstream.sh"
+  fi
+
   # Generate the O2 command.
   MAKECMD="python3 $DIR_EXEC/make_command_o2.py $DATABASE_O2 $OPT_MAKECMD"
+  [ "$O2_STAGE_CUT" ] && MAKECMD+=" -s downstream"
   O2EXEC=$($MAKECMD -w "$WORKFLOWS")
   $MAKECMD -w "$WORKFLOWS" 1> /dev/null 2> /dev/null || ErrExit "Generating of O2 command failed."
   [ "$O2EXEC" ] || ErrExit "Nothing to do!"
 
+  # Create the script with the O2 command of the upstream stage.
+  if [ "$O2_STAGE_CUT" ]; then
+    MAKECMD_UP="python3 $DIR_EXEC/make_command_o2.py $DATABASE_O2 $OPT_MAKECMD -s upstream -j $JSON"
+    O2EXEC_UP=$($MAKECMD_UP -w "$WORKFLOWS")
+    $MAKECMD_UP -w "$WORKFLOWS" 1> /dev/null 2> /dev/null || ErrExit "Generating of O2 upstream command failed."
+    cat << EOF > "$SCRIPT_O2_UPSTREAM"
+#!/bin/bash
+FileIn="\$1"
+JSON="\$2"
+$O2EXEC_UP
+EOF
+  fi
+
   # Create the script with the full O2 command.
   cat << EOF > "$SCRIPT_O2"
 #!/bin/bash
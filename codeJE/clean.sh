@@ -6,6 +6,7 @@ rm -rf \
 AnalysisResults_ALI.root AnalysisResults_O2.root \
 comparison_histos_jets.* comparison_ratios_jets.* \
 ./*.log \
+metrics_o2.* \
 output_* \
 || { echo "Error: Failed to delete files."; exit 1; }
 
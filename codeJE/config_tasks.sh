@@ -26,6 +26,8 @@ DOPOSTPROCESS=1     # Run output postprocessing. (Comparison plots. Requires DOA
 # O2 database
 DATABASE_O2="workflows.yml"
 MAKE_GRAPH=0          # Make topology graph.
+GRAPH_METRICS=""      # Resource metrics of workflows (e.g. a copy of metrics_o2.json from a previous run) to annotate the topology graph with ("" = cost hints of the database)
+TUNE_MEMORY=0         # Derive the DPL memory settings and the number of AOD readers from the workflows, the input files and the shared memory available to parallel jobs. (0 = use the database options, 1 = replace them with a warning)
 
 # Activation of O2 workflows
 # Trigger selection
@@ -68,66 +70,18 @@ function Clean {
 
 # Modify the JSON file.
 function AdjustJson {
-  # Make a copy of the default JSON file to modify it.
+  # Make a modified copy of the default JSON file.
   JSON_EDIT="${JSON/.json/_edit.json}"
-  cp "$JSON" "$JSON_EDIT" || ErrExit "Failed to cp $JSON $JSON_EDIT."
-  JSON="$JSON_EDIT"
-
-  # Collision system
-  MsgWarn "Setting collision system $INPUT_SYS"
-
-  # Run 2/3/5
-  MsgWarn "Using Run $INPUT_RUN"
-  if [ "$INPUT_RUN" -eq 2 ]; then
-    ReplaceString "\"processRun2\": \"false\"" "\"processRun2\": \"true\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"processRun3\": \"true\"" "\"processRun3\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  elif [ "$INPUT_RUN" -eq 3 ]; then
-    ReplaceString "\"processRun2\": \"true\"" "\"processRun2\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"processRun3\": \"false\"" "\"processRun3\": \"true\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-
-  # MC
-  if [ "$INPUT_IS_MC" -eq 1 ]; then
-    MsgWarn "Using MC data"
-    ReplaceString "\"processMc\": \"false\"" "\"processMc\": \"true\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"processMC\": \"false\"" "\"processMC\": \"true\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"isMC\": \"false\"" "\"isMC\": \"true\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  else
-    MsgWarn "Using real data"
-    ReplaceString "\"processMc\": \"true\"" "\"processMc\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"processMC\": \"true\"" "\"processMC\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"isMC\": \"true\"" "\"isMC\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"processData\": \"false\"" "\"processData\": \"true\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-
-  # event-selection
-  ReplaceString "\"syst\": \"pp\"" "\"syst\": \"$INPUT_SYS\"" "$JSON" || ErrExit "Failed to edit $JSON."
-
-  if [ $DOO2_TRIGSEL -eq 1 ]; then
-    # trigger selection
-    ReplaceString "\"processTrigSel\": \"false\"" "\"processTrigSel\": \"true\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"processNoTrigSel\": \"true\"" "\"processNoTrigSel\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-  if [ "$INPUT_RUN" -eq 3 ]; then
-    # do not use trigger selection for Run 3
-    ReplaceString "\"processTrigSel\": \"true\"" "\"processTrigSel\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-    ReplaceString "\"processNoTrigSel\": \"false\"" "\"processNoTrigSel\": \"true\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-
-  # timestamp-task
-  if [[ "$INPUT_IS_MC" -eq 1 && "$INPUT_RUN" -eq 2 ]]; then
-    ReplaceString "\"isRun2MC\": \"false\"" "\"isRun2MC\": \"true\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  else
-    ReplaceString "\"isRun2MC\": \"true\"" "\"isRun2MC\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
-
-  # track-selection
-  if [ "$INPUT_RUN" -eq 3 ]; then
-    ReplaceString "\"isRun3\": \"false\"" "\"isRun3\": \"true\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  else
-    ReplaceString "\"isRun3\": \"true\"" "\"isRun3\": \"false\"" "$JSON" || ErrExit "Failed to edit $JSON."
-  fi
 
+  # Apply the rules in json_rules.yml.
+  OPT_JSON="-s INPUT_RUN=$INPUT_RUN -s INPUT_IS_MC=$INPUT_IS_MC -s INPUT_SYS=$INPUT_SYS"
+  for Var in ${!DOO2_@}; do
+    OPT_JSON+=" -s $Var=${!Var}"
+  done
+  [ "$DIR_CACHE_JSON" ] && OPT_JSON+=" -c $DIR_CACHE_JSON"
+  # shellcheck disable=SC2086 # Ignore unquoted options.
+  python3 "$DIR_EXEC/adjust_json.py" "$JSON" "$JSON_EDIT" "$DIR_TASKS/json_rules.yml" $OPT_JSON || ErrExit "Failed to edit $JSON."
+  JSON="$JSON_EDIT"
 }
 
 # Generate the O2 script containing the full workflow specification.
@@ -159,6 +113,8 @@ function MakeScriptO2 {
   [ "$DEBUG" -eq 1 ] && OPT_MAKECMD+=" -d"
   [ $SAVETREES -eq 1 ] && OPT_MAKECMD+=" -t"
   [ $MAKE_GRAPH -eq 1 ] && OPT_MAKECMD+=" -g"
+  [[ $MAKE_GRAPH -eq 1 && "$GRAPH_METRICS" ]] && OPT_MAKECMD+=" --metrics $GRAPH_METRICS"
+  [ $TUNE_MEMORY -eq 1 ] && OPT_MAKECMD+=" -m -i $LISTFILES_O2 --files-per-job $NFILESPERJOB_O2 --jobs $NJOBSPARALLEL_O2"
 
   # Make a copy of the default workflow database file before modifying it.
   DATABASE_O2_EDIT="${DATABASE_O2/.yml/_edit.yml}"
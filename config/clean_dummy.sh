@@ -5,6 +5,7 @@
 rm -rf \
 AnalysisResults_ALI.root AnalysisResults_O2.root AnalysisResults_trees_O2.root \
 ./*.log \
+metrics_o2.* \
 output_* \
 || { echo "Error: Failed to delete files."; exit 1; }
 
@@ -26,6 +26,8 @@ DOPOSTPROCESS=1     # Run output postprocessing. (Compare AliPhysics and O2 outp
 # O2 database
 DATABASE_O2="workflows_dummy.yml"
 MAKE_GRAPH=0        # Make topology graph.
+GRAPH_METRICS=""    # Resource metrics of workflows (e.g. a copy of metrics_o2.json from a previous run) to annotate the topology graph with ("" = cost hints of the database)
+TUNE_MEMORY=0       # Derive the DPL memory settings and the number of AOD readers from the workflows, the input files and the shared memory available to parallel jobs. (0 = use the database options, 1 = replace them with a warning)
 
 # Activation of O2 workflows
 # Trigger selection
@@ -103,6 +105,8 @@ function MakeScriptO2 {
   [ "$DEBUG" -eq 1 ] && OPT_MAKECMD+=" -d"
   [ $SAVETREES -eq 1 ] && OPT_MAKECMD+=" -t"
   [ $MAKE_GRAPH -eq 1 ] && OPT_MAKECMD+=" -g"
+  [[ $MAKE_GRAPH -eq 1 && "$GRAPH_METRICS" ]] && OPT_MAKECMD+=" --metrics $GRAPH_METRICS"
+  [ $TUNE_MEMORY -eq 1 ] && OPT_MAKECMD+=" -m -i $LISTFILES_O2 --files-per-job $NFILESPERJOB_O2 --jobs $NJOBSPARALLEL_O2"
 
   # Make a copy of the default workflow database file before modifying it.
   DATABASE_O2_EDIT="${DATABASE_O2/.yml/_edit.yml}"
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+"""
+Adjusts the JSON configuration of O2 tasks according to the run settings.
+Loads the JSON file once, applies the rules from a YAML rule table in one pass and writes the result once.
+
+Each rule can have:
+- "when": settings that must all have the given values (a value can be a list of allowed values).
+  A list of such dictionaries means that any of them must match.
+- "unless": settings (same format as "when") that must not match.
+- "message": message to print out when the rule is applied.
+- "replace": parameters whose values are replaced: "<parameter>: [<old value>, <new value>]".
+- "rename": parameters to rename: "<old name>: <new name>".
+Values and messages can refer to settings as "{<setting>}".
+Replacements of the same parameter are applied in the order of the rules. Parameters are renamed afterwards.
+Parameters are matched in all devices at any depth.
+
+The adjusted JSON file can be cached per combination of the input JSON file, rules and settings.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+from typing import Dict, List, Tuple, Union
+
+import yaml  # pylint: disable=import-error
+from utilities import check_file, msg_fatal, msg_warn
+
+VERSION = 1  # version of the rule semantics (part of the cache key)
+
+Condition = Union[dict, List[dict], None]
+
+
+def matches(condition: Condition, settings: Dict[str, str]) -> bool:
+    """Check whether settings match a condition."""
+    if isinstance(condition, list):
+        return any(matches(c, settings) for c in condition)
+    for name, values in (condition or {}).items():
+        if name not in settings:
+            msg_fatal("Setting %s used in the rules is not provided." % name)
+        values = values if isinstance(values, list) else [values]
+        if settings[name] not in [str(v) for v in values]:
+            return False
+    return True
+
+
+def get_operations(rules: List[dict], settings: Dict[str, str]) -> Tuple[Dict[str, List[Tuple[str, str]]], dict]:
+    """Get replacements (old and new values per parameter) and renaming of parameters from active rules."""
+    replacements: Dict[str, List[Tuple[str, str]]] = {}
+    renaming: Dict[str, str] = {}
+    for rule in rules:
+        if not matches(rule.get("when"), settings):
+            continue
+        if "unless" in rule and matches(rule["unless"], settings):
+            continue
+        if "message" in rule:
+            msg_warn(rule["message"].format(**settings))
+        for name, (old, new) in rule.get("replace", {}).items():
+            replacements.setdefault(name, []).append((str(old).format(**settings), str(new).format(**settings)))
+        renaming.update(rule.get("rename", {}))
+    return replacements, renaming
+
+
+def adjust(node, replacements: Dict[str, List[Tuple[str, str]]], renaming: Dict[str, str]):
+    """Apply the replacements and the renaming of parameters in all nested dictionaries."""
+    if isinstance(node, list):
+        return [adjust(item, replacements, renaming) for item in node]
+    if not isinstance(node, dict):
+        return node
+    result = {}
+    for name, value in node.items():
+        if isinstance(value, str):
+            for old, new in replacements.get(name, []):
+                if value == old:
+                    value = new
+        else:
+            value = adjust(value, replacements, renaming)
+        result[renaming.get(name, name)] = value
+    return result
+
+
+def get_cache_key(path_json: str, path_rules: str, settings: Dict[str, str]) -> str:
+    """Get the key identifying the adjusted JSON file."""
+    sha = hashlib.sha256(("%d\n" % VERSION).encode())
+    for path in (path_json, path_rules):
+        with open(path, "rb") as file:
+            sha.update(hashlib.sha256(file.read()).hexdigest().encode())
+    for name in sorted(settings):
+        sha.update(("%s=%s\n" % (name, settings[name])).encode())
+    return sha.hexdigest()
+
+
+def evict(dir_cache: str, age_max: float):
+    """Delete cached files unused for longer than the maximum age (in seconds)."""
+    time_now = time.time()
+    for name in os.listdir(dir_cache):
+        path = os.path.join(dir_cache, name)
+        if os.path.isfile(path) and time_now - os.path.getmtime(path) > age_max:
+            os.remove(path)
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description="Adjust the JSON configuration of O2 tasks.")
+    parser.add_argument("input", help="input JSON file")
+    parser.add_argument("output", help="output JSON file")
+    parser.add_argument("rules", help="YAML file with rules")
+    parser.add_argument(
+        "-s", "--setting", action="append", default=[], metavar="NAME=VALUE", help="setting used in rules (repeatable)"
+    )
+    parser.add_argument("-c", "--cache", type=str, help="directory of the cache of adjusted JSON files")
+    parser.add_argument("--cache-age", type=float, default=30, help="maximum age of unused cached files [days]")
+    args = parser.parse_args()
+
+    check_file(args.input)
+    check_file(args.rules)
+    settings = {}
+    for setting in args.setting:
+        if "=" not in setting:
+            msg_fatal("Invalid setting: %s" % setting)
+        name, value = setting.split("=", 1)
+        settings[name] = value
+    with open(args.rules, "r") as file:
+        rules = yaml.safe_load(file) or []
+    replacements, renaming = get_operations(rules, settings)  # Print out the messages also when using the cache.
+
+    path_cached = ""
+    if args.cache:
+        os.makedirs(args.cache, exist_ok=True)
+        path_cached = os.path.join(args.cache, get_cache_key(args.input, args.rules, settings) + ".json")
+        if os.path.isfile(path_cached):
+            shutil.copyfile(path_cached, args.output)
+            os.utime(path_cached)  # Mark as recently used.
+            return
+
+    with open(args.input, "r") as file:
+        try:
+            data = json.load(file)
+        except ValueError as error:
+            msg_fatal("Failed to parse %s: %s" % (args.input, error))
+    data = adjust(data, replacements, renaming)
+    with open(args.output, "w") as file:
+        json.dump(data, file, indent=4, ensure_ascii=False)
+        file.write("\n")
+
+    if path_cached:
+        path_tmp = "%s.tmp.%d" % (path_cached, os.getpid())
+        shutil.copyfile(args.output, path_tmp)
+        os.replace(path_tmp, path_cached)
+        evict(args.cache, args.cache_age * 86400)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,9 @@ JSON="$2"
 SCRIPT="$3"
 DEBUG=$4
 NFILESPERJOB=$5
+OPT_JOBS="$6" # (optional) options of the job runner
 FILEOUT="AnalysisResults.root"
+FILEOUT_MERGED="${7:-$FILEOUT}" # (optional) merged output file
 
 [ "$DEBUG" -eq 1 ] && echo "Running $0"
 
@@ -27,49 +29,51 @@ JSON="$(realpath "$JSON")"
 LogFile="log_ali.log"
 ListIn="list_ali.txt"
 FilesToMerge="ListOutToMergeAli.txt"
-IndexFile=0
-IndexJob=0
 DirOutMain="output_ali"
 
 CMDPARALLEL="cd \"$DirOutMain/{}\" && bash \"$DIR_THIS/run_ali.sh\" \"$SCRIPT\" \"$ListIn\" \"$JSON\" \"$LogFile\""
 
 # Clean before running.
-rm -rf "$FilesToMerge" "$FILEOUT" "$DirOutMain" || ErrExit "Failed to delete output files."
+rm -rf "$FilesToMerge" "$FILEOUT_MERGED" "$DirOutMain" || ErrExit "Failed to delete output files."
 
 CheckFile "$LISTINPUT"
 echo "Output directory: $DirOutMain (logfiles: $LogFile)"
-# Loop over input files
-while read -r FileIn; do
-  CheckFile "$FileIn"
-  FileIn="$(realpath "$FileIn")"
-  IndexJob=$((IndexFile / NFILESPERJOB))
-  DirOut="$DirOutMain/$IndexJob"
-  # New job
-  if [ $((IndexFile % NFILESPERJOB)) -eq 0 ]; then
-    mkdir -p $DirOut || ErrExit "Failed to mkdir $DirOut."
-    echo "$DirOut/$FILEOUT" >> "$FilesToMerge" || ErrExit "Failed to echo to $FilesToMerge."
-  fi
-  echo "$FileIn" >> "$DirOut/$ListIn" || ErrExit "Failed to echo to $DirOut/$ListIn."
-  [ "$DEBUG" -eq 1 ] && echo "Input file ($IndexFile, job $IndexJob): $FileIn"
-  ((IndexFile++))
-done < "$LISTINPUT"
+# Split input files into jobs.
+OPT_PLAN="-n $NFILESPERJOB -m $FILEOUT $FilesToMerge"
+ListInfo="${LISTINPUT/.txt/_info.txt}" # sizes and numbers of events of input files from the catalogue
+[ -f "$ListInfo" ] && OPT_PLAN+=" -c $ListInfo"
+[ "$DEBUG" -eq 1 ] && OPT_PLAN+=" -d"
+# shellcheck disable=SC2086 # Ignore unquoted options.
+NJOBS=$(python3 "$DIR_THIS/plan_jobs.py" "$LISTINPUT" "$DirOutMain" "$ListIn" $OPT_PLAN) || ErrExit "Failed to split input files into jobs."
 
-echo "Running AliPhysics jobs... ($((IndexJob+1)) jobs, $NFILESPERJOB files/job)"
-OPT_PARALLEL="--halt soon,fail=100%"
+echo "Running AliPhysics jobs... ($NJOBS jobs, max. $NFILESPERJOB files/job)"
+# Name of the step in the timeline trace.
+OPT_JOBS+=" --trace-name AliPhysics"
+# Monitor job logs.
+OPT_JOBS+=" --log-type ali --log $DirOutMain/{}/$LogFile --log-summary $DirOutMain/{}/errors_ali.json"
+# Identify job results in the cache.
+OPT_JOBS+=" --cache-list $DirOutMain/{}/$ListIn --cache-file $SCRIPT --cache-file $JSON --cache-file $DIR_THIS/run_ali.sh"
+# The software is identified by the build variables of aliBuild and by the executables and libraries of the builds (rebuilt in place in development).
+OPT_JOBS+=" --cache-env ALICE_PHYSICS --cache-env ALICE_ROOT --cache-env ROOTSYS"
+OPT_JOBS+=" --cache-env ALIPHYSICS_VERSION --cache-env ALIPHYSICS_REVISION --cache-env ALIPHYSICS_HASH"
+OPT_JOBS+=" --cache-env ALIROOT_VERSION --cache-env ALIROOT_REVISION --cache-env ALIROOT_HASH"
+OPT_JOBS+=" --cache-build ALICE_PHYSICS --cache-build ALICE_ROOT"
+OPT_JOBS+=" --cache-output $DirOutMain/{}/$FILEOUT --cache-output $DirOutMain/{}/$LogFile"
+# Merge output files while jobs are running.
+echo "Merging output files... (output file: $FILEOUT_MERGED, logfile: $LogFile)"
+OPT_JOBS+=" --merge $FilesToMerge $FILEOUT_MERGED"
 if [ "$DEBUG" -eq 0 ]; then
   # shellcheck disable=SC2086 # Ignore unquoted options.
-  parallel $OPT_PARALLEL "$CMDPARALLEL" ::: $(seq 0 $IndexJob) > $LogFile 2>&1
+  python3 "$DIR_THIS/run_jobs.py" $OPT_JOBS "$CMDPARALLEL" "$NJOBS" > $LogFile 2>&1
 else
   # shellcheck disable=SC2086 # Ignore unquoted options.
-  parallel $OPT_PARALLEL --will-cite --progress "$CMDPARALLEL" ::: $(seq 0 $IndexJob) > $LogFile
+  python3 "$DIR_THIS/run_jobs.py" $OPT_JOBS --debug "$CMDPARALLEL" "$NJOBS" > $LogFile
 fi || ErrExit "\nCheck $(realpath $LogFile)"
 grep -q -e '^'"W-" -e '^'"Warning" "$LogFile" && MsgWarn "There were warnings!\nCheck $(realpath $LogFile)"
 grep -q -e '^'"E-" -e '^'"Error" "$LogFile" && MsgErr "There were errors!\nCheck $(realpath $LogFile)"
 grep -q -e '^'"F-" -e '^'"Fatal" -e "segmentation" -e "Segmentation" "$LogFile" && ErrExit "There were fatal errors!\nCheck $(realpath $LogFile)"
 
-echo "Merging output files... (output file: $FILEOUT, logfile: $LogFile)"
-hadd "$FILEOUT" @"$FilesToMerge" >> $LogFile 2>&1 || \
-{ MsgErr "Error\nCheck $(realpath $LogFile)"; tail -n 2 "$LogFile"; exit 1; }
+CheckFile "$FILEOUT_MERGED"
 rm -f "$FilesToMerge" || ErrExit "Failed to rm $FilesToMerge."
 
 exit 0
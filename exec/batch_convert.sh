@@ -8,6 +8,7 @@ INPUT_IS_MC=$3
 USEALIEVCUTS=$4
 DEBUG=$5
 NFILESPERJOB=$6
+OPT_JOBS="$7" # (optional) options of the job runner
 FILEOUT="AO2D.root"
 
 [ "$DEBUG" -eq 1 ] && echo "Running $0"
@@ -22,42 +23,49 @@ source "$DIR_THIS/utilities.sh" || { echo "Error: Failed to load utilities."; ex
 
 LogFile="log_convert.log"
 ListIn="list_convert.txt"
-IndexFile=0
-IndexJob=0
 DirOutMain="output_conversion"
 
 CMDPARALLEL="cd \"$DirOutMain/{}\" && bash \"$DIR_THIS/run_convert.sh\" \"$ListIn\" $INPUT_IS_MC $USEALIEVCUTS \"$LogFile\""
 
 # Clean before running.
-rm -rf "$LISTOUTPUT" "$DirOutMain" || ErrExit "Failed to delete output files."
+rm -rf "$LISTOUTPUT" "$LISTOUTPUT.tmp" "$DirOutMain" || ErrExit "Failed to delete output files."
 
 CheckFile "$LISTINPUT"
 echo "Output directory: $DirOutMain (logfiles: $LogFile)"
-# Loop over input files
-while read -r FileIn; do
-  CheckFile "$FileIn"
-  FileIn="$(realpath "$FileIn")"
-  IndexJob=$((IndexFile / NFILESPERJOB))
-  DirOut="$DirOutMain/$IndexJob"
-  # New job
-  if [ $((IndexFile % NFILESPERJOB)) -eq 0 ]; then
-    mkdir -p $DirOut || ErrExit "Failed to mkdir $DirOut."
-    echo "$DirOut/$FILEOUT" >> "$LISTOUTPUT" || ErrExit "Failed to echo to $LISTOUTPUT."
-  fi
-  echo "$FileIn" >> "$DirOut/$ListIn" || ErrExit "Failed to echo to $DirOut/$ListIn."
-  [ "$DEBUG" -eq 1 ] && echo "Input file ($IndexFile, job $IndexJob): $FileIn"
-  ((IndexFile++))
-done < "$LISTINPUT"
+# Split input files into jobs.
+# The output list appears complete at once so that pipelined O2 jobs can be planned as soon as it exists.
+OPT_PLAN="-n $NFILESPERJOB -m $FILEOUT $LISTOUTPUT.tmp"
+ListInfo="${LISTINPUT/.txt/_info.txt}" # sizes and numbers of events of input files from the catalogue
+[ -f "$ListInfo" ] && OPT_PLAN+=" -c $ListInfo"
+[ "$DEBUG" -eq 1 ] && OPT_PLAN+=" -d"
+# shellcheck disable=SC2086 # Ignore unquoted options.
+NJOBS=$(python3 "$DIR_THIS/plan_jobs.py" "$LISTINPUT" "$DirOutMain" "$ListIn" $OPT_PLAN) || ErrExit "Failed to split input files into jobs."
+mv "$LISTOUTPUT.tmp" "$LISTOUTPUT" || ErrExit "Failed to mv $LISTOUTPUT.tmp $LISTOUTPUT."
 
-echo "Running conversion jobs... ($((IndexJob+1)) jobs, $NFILESPERJOB files/job)"
-OPT_PARALLEL="--halt soon,fail=100%"
+echo "Running conversion jobs... ($NJOBS jobs, max. $NFILESPERJOB files/job)"
+# Name of the step in the timeline trace.
+OPT_JOBS+=" --trace-name conversion"
+# Monitor job logs.
+OPT_JOBS+=" --log-type ali --log $DirOutMain/{}/$LogFile --log-summary $DirOutMain/{}/errors_convert.json"
+# Mark finished jobs for pipelined O2 jobs.
+OPT_JOBS+=" --mark $DirOutMain/{}"
+# Identify job results in the cache.
+# The command includes the conversion settings. The AliPhysics version is identified by the build variables of aliBuild
+# and by the executables and libraries of the builds (rebuilt in place in development).
+OPT_JOBS+=" --cache-list $DirOutMain/{}/$ListIn --cache-file $DIR_THIS/run_convert.sh --cache-file $DIR_THIS/convertAO2D.C"
+OPT_JOBS+=" --cache-env ALICE_PHYSICS --cache-env ALICE_ROOT --cache-env ROOTSYS"
+OPT_JOBS+=" --cache-env ALIPHYSICS_VERSION --cache-env ALIPHYSICS_REVISION --cache-env ALIPHYSICS_HASH"
+OPT_JOBS+=" --cache-build ALICE_PHYSICS --cache-build ALICE_ROOT"
+OPT_JOBS+=" --cache-output $DirOutMain/{}/$FILEOUT --cache-output $DirOutMain/{}/$LogFile"
 if [ "$DEBUG" -eq 0 ]; then
   # shellcheck disable=SC2086 # Ignore unquoted options.
-  parallel $OPT_PARALLEL "$CMDPARALLEL" ::: $(seq 0 $IndexJob) > $LogFile 2>&1
+  python3 "$DIR_THIS/run_jobs.py" $OPT_JOBS "$CMDPARALLEL" "$NJOBS" > $LogFile 2>&1
 else
   # shellcheck disable=SC2086 # Ignore unquoted options.
-  parallel $OPT_PARALLEL --will-cite --progress "$CMDPARALLEL" ::: $(seq 0 $IndexJob) > $LogFile
+  python3 "$DIR_THIS/run_jobs.py" $OPT_JOBS --debug "$CMDPARALLEL" "$NJOBS" > $LogFile
 fi || ErrExit "\nCheck $(realpath $LogFile)"
+NCACHED=$(grep -c "restored from the cache" "$LogFile")
+[ "$NCACHED" -gt 0 ] && echo "Converted files restored from the cache: $NCACHED/$NJOBS jobs"
 grep -q -e '^'"W-" -e '^'"Warning" "$LogFile" && MsgWarn "There were warnings!\nCheck $(realpath $LogFile)"
 grep -q -e '^'"E-" -e '^'"Error" "$LogFile" && MsgErr "There were errors!\nCheck $(realpath $LogFile)"
 grep -q -e '^'"F-" -e '^'"Fatal" -e "segmentation" -e "Segmentation" "$LogFile" && ErrExit "There were fatal errors!\nCheck $(realpath $LogFile)"
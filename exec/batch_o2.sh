@@ -10,6 +10,12 @@ NFILESPERJOB=$5
 FILEOUT_TREE="$6"
 FILEOUT="AnalysisResults.root"
 NJOBSPARALLEL=$7
+SCRIPT_UPSTREAM="$8"  # (optional) script of the upstream stage of the staged mode
+OPT_JOBS="$9"         # (optional) options of the job runner
+WAIT_PID="${10}"      # (optional) process producing the input files while O2 jobs are running (pipelined mode)
+CHECK_EVENTS="${11}"  # (optional) histogram ("<path>[:<bin>]") with the number of processed events to compare with the number of input collisions
+DIR_DERIVED="${12:-derived_o2}"  # (optional) persistent storage of derived AO2Ds of the upstream stage
+CHECK_OUTPUT="${13:-0}"  # (optional) compare the objects in the job outputs with the output of the first successful job
 
 [ "$DEBUG" -eq 1 ] && echo "Running $0"
 
@@ -24,62 +30,98 @@ CheckFile "$SCRIPT"
 CheckFile "$JSON"
 SCRIPT="$(realpath "$SCRIPT")"
 JSON="$(realpath "$JSON")"
+[ "$SCRIPT_UPSTREAM" ] && { CheckFile "$SCRIPT_UPSTREAM"; SCRIPT_UPSTREAM="$(realpath "$SCRIPT_UPSTREAM")"; }
 
 LogFile="log_o2.log"
 ListIn="list_o2.txt"
 FilesToMerge="ListOutToMergeO2.txt"
 FilesToMergeTree="ListOutToMergeO2Tree.txt"
-IndexFile=0
-IndexJob=0
 DirOutMain="output_o2"
+DirDerived="$(realpath -m "$DIR_DERIVED")"
 
 CMDPARALLEL="cd \"$DirOutMain/{}\" && bash \"$DIR_THIS/run_o2.sh\" \"$SCRIPT\" \"$ListIn\" \"$JSON\" \"$LogFile\""
+[ "$SCRIPT_UPSTREAM" ] && CMDPARALLEL+=" \"$SCRIPT_UPSTREAM\" \"$DirDerived\""
+# Check the integrity of the job output (if requested).
+if [[ "$CHECK_OUTPUT" -eq 1 || "$CHECK_EVENTS" ]]; then
+  CMDPARALLEL+=" && python3 \"$DIR_THIS/check_job_output.py\" \"$ListIn\" \"$FILEOUT\""
+  # Top-level directories are compared with the output of the first successful job.
+  [ "$CHECK_OUTPUT" -eq 1 ] && CMDPARALLEL+=" -o \"$(realpath -m "$DirOutMain")/objects.txt\""
+  [ "$CHECK_EVENTS" ] && CMDPARALLEL+=" -e \"$CHECK_EVENTS\""
+fi
 
 # Clean before running.
 rm -rf "$FilesToMerge" "$FilesToMergeTree" "$FILEOUT" "$FILEOUT_TREE" "$DirOutMain" || ErrExit "Failed to delete output files."
 
 CheckFile "$LISTINPUT"
 echo "Output directory: $DirOutMain (logfiles: $LogFile)"
-# Loop over input files
-while read -r FileIn; do
-  CheckFile "$FileIn"
-  FileIn="$(realpath "$FileIn")"
-  IndexJob=$((IndexFile / NFILESPERJOB))
-  DirOut="$DirOutMain/$IndexJob"
-  # New job
-  if [ $((IndexFile % NFILESPERJOB)) -eq 0 ]; then
-    mkdir -p $DirOut || ErrExit "Failed to mkdir $DirOut."
-    echo "$DirOut/$FILEOUT" >> "$FilesToMerge" || ErrExit "Failed to echo to $FilesToMerge."
-    [ "$FILEOUT_TREE" ] && \
-    { echo "$DirOut/$FILEOUT_TREE" >> "$FilesToMergeTree" || ErrExit "Failed to echo to $FilesToMergeTree."; }
-  fi
-  echo "$FileIn" >> "$DirOut/$ListIn" || ErrExit "Failed to echo to $DirOut/$ListIn."
-  [ "$DEBUG" -eq 1 ] && echo "Input file ($IndexFile, job $IndexJob): $FileIn"
-  ((IndexFile++))
-done < "$LISTINPUT"
+# Split input files into jobs.
+OPT_PLAN="-n $NFILESPERJOB -j $NJOBSPARALLEL -m $FILEOUT $FilesToMerge"
+[ "$FILEOUT_TREE" ] && OPT_PLAN+=" -m $FILEOUT_TREE $FilesToMergeTree"
+[ "$WAIT_PID" ] && OPT_PLAN+=" --pending"
+ListInfo="${LISTINPUT/.txt/_info.txt}" # sizes and numbers of events of input files from the catalogue
+[ -f "$ListInfo" ] && OPT_PLAN+=" -c $ListInfo"
+[ "$DEBUG" -eq 1 ] && OPT_PLAN+=" -d"
+# shellcheck disable=SC2086 # Ignore unquoted options.
+NJOBS=$(python3 "$DIR_THIS/plan_jobs.py" "$LISTINPUT" "$DirOutMain" "$ListIn" $OPT_PLAN) || ErrExit "Failed to split input files into jobs."
 
-echo "Running O2 jobs... ($((IndexJob+1)) jobs, $NJOBSPARALLEL parallel, $NFILESPERJOB files/job)"
-OPT_PARALLEL="--halt soon,fail=100% --jobs $NJOBSPARALLEL"
+echo "Running O2 jobs... ($NJOBS jobs, $NJOBSPARALLEL parallel, max. $NFILESPERJOB files/job)"
+# Start jobs only if there is enough free memory and shared memory for the DPL shared memory segment.
+ShmJob=$(cat "$SCRIPT" "$SCRIPT_UPSTREAM" 2> /dev/null | grep -o -e "--shm-segment-size [0-9]*" | cut -d " " -f 2 | sort -n | tail -n 1)
+OPT_JOBS+=" --jobs $NJOBSPARALLEL"
+# Start jobs only when their input files are produced.
+[ "$WAIT_PID" ] && OPT_JOBS+=" --wait-inputs $DirOutMain/{}/$ListIn --wait-pid $WAIT_PID"
+[ "$ShmJob" ] && OPT_JOBS+=" --shm-job $ShmJob"
+# Retry failed jobs with input files split in smaller jobs to isolate bad input files.
+OPT_JOBS+=" --split $DirOutMain/{}/$ListIn"
+# Copy input files to local storage before jobs start (if enabled). (The staged mode reads the input files once.)
+[ "$SCRIPT_UPSTREAM" ] || OPT_JOBS+=" --stage-list $DirOutMain/{}/$ListIn"
+# Name of the step in the timeline trace.
+OPT_JOBS+=" --trace-name O2"
+# Monitor job logs.
+OPT_JOBS+=" --log-type o2 --log $DirOutMain/{}/$LogFile --log-summary $DirOutMain/{}/errors_o2.json"
+[ "$SCRIPT_UPSTREAM" ] && OPT_JOBS+=" --log $DirOutMain/{}/${LogFile/.log/_upstream.log}"
+# Identify job results in the cache.
+OPT_JOBS+=" --cache-list $DirOutMain/{}/$ListIn --cache-file $SCRIPT --cache-file $JSON --cache-file $DIR_THIS/run_o2.sh"
+# The software is identified by the build variables of aliBuild and by the executables and libraries of the builds (rebuilt in place in development).
+OPT_JOBS+=" --cache-env O2PHYSICS_ROOT --cache-env O2_ROOT --cache-env ROOTSYS"
+OPT_JOBS+=" --cache-env O2PHYSICS_VERSION --cache-env O2PHYSICS_REVISION --cache-env O2PHYSICS_HASH"
+OPT_JOBS+=" --cache-env O2_VERSION --cache-env O2_REVISION --cache-env O2_HASH"
+OPT_JOBS+=" --cache-build O2PHYSICS_ROOT --cache-build O2_ROOT"
+for File in "$FILEOUT" "$FILEOUT_TREE" "$LogFile" "${LogFile/.log/_upstream.log}" "performanceMetrics.json"; do
+  [ "$File" ] && OPT_JOBS+=" --cache-output $DirOutMain/{}/$File"
+done
+[ "$SCRIPT_UPSTREAM" ] && OPT_JOBS+=" --cache-file $SCRIPT_UPSTREAM"
+# Merge output files while jobs are running.
+echo "Merging output files... (output file: $FILEOUT, logfile: $LogFile)"
+OPT_JOBS+=" --merge $FilesToMerge $FILEOUT"
+[ "$FILEOUT_TREE" ] && {
+  echo "Merging output trees... (output file: $FILEOUT_TREE, logfile: $LogFile)"
+  OPT_JOBS+=" --merge $FilesToMergeTree $FILEOUT_TREE"
+}
 if [ "$DEBUG" -eq 0 ]; then
   # shellcheck disable=SC2086 # Ignore unquoted options.
-  parallel $OPT_PARALLEL "$CMDPARALLEL" ::: $(seq 0 $IndexJob) > $LogFile 2>&1
+  python3 "$DIR_THIS/run_jobs.py" $OPT_JOBS "$CMDPARALLEL" "$NJOBS" > $LogFile 2>&1
 else
   # shellcheck disable=SC2086 # Ignore unquoted options.
-  parallel $OPT_PARALLEL --will-cite --progress "$CMDPARALLEL" ::: $(seq 0 $IndexJob) > $LogFile
-fi || ErrExit "\nCheck $(realpath $LogFile)"
+  python3 "$DIR_THIS/run_jobs.py" $OPT_JOBS --debug "$CMDPARALLEL" "$NJOBS" > $LogFile
+fi
+ExitCode=$?
+# Exit code 2: Input files failed alone and were excluded from the merged outputs.
+[ $ExitCode -eq 2 ] && ErrExit "Some input files failed alone and were excluded from the outputs!\nCheck $(realpath $LogFile)"
+[ $ExitCode -ne 0 ] && ErrExit "\nCheck $(realpath $LogFile)"
 grep -q -e "\\[WARN\\]" -e "Warning in " "$LogFile" && MsgWarn "There were warnings!\nCheck $(realpath $LogFile)"
 grep -q -e "\\[ERROR\\]" -e "\\[FATAL\\]" -e "segmentation" -e "Segmentation" -e "command not found" -e "Error:" -e "Error in " "$LogFile" && MsgErr "There were errors!\nCheck $(realpath $LogFile)"
 
-echo "Merging output files... (output file: $FILEOUT, logfile: $LogFile)"
-hadd $FILEOUT @"$FilesToMerge" >> $LogFile 2>&1 || \
-{ MsgErr "Error\nCheck $(realpath $LogFile)"; tail -n 2 "$LogFile"; exit 1; }
+CheckFile "$FILEOUT"
 rm -f "$FilesToMerge" || ErrExit "Failed to rm $FilesToMerge."
 
 [ "$FILEOUT_TREE" ] && {
-  echo "Merging output trees... (output file: $FILEOUT_TREE, logfile: $LogFile)"
-  hadd "$FILEOUT_TREE" @"$FilesToMergeTree" >> $LogFile 2>&1 || \
-  { MsgErr "Error\nCheck $(realpath $LogFile)"; tail -n 2 "$LogFile"; exit 1; }
+  CheckFile "$FILEOUT_TREE"
   rm -f "$FilesToMergeTree" || ErrExit "Failed to rm $FilesToMergeTree."
 }
 
+# Report resource usage of DPL devices.
+echo "Collecting resource metrics..."
+python3 "$DIR_THIS/collect_metrics.py" "$DirOutMain" -s "$SCRIPT" -o "metrics_o2" || MsgWarn "Failed to collect resource metrics."
+
 exit 0
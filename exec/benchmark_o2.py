@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks the throughput of O2 jobs over a grid of job parameters to tune them for this machine.
+Runs batch_o2.sh with the same input files for each combination of the number of files per job,
+the maximum number of parallel jobs and the number of cores per job (jobs of a point share a pool of cores),
+each point in its own directory <output>/<point>.
+Records the wall time, the CPU efficiency (CPU time of all processes / (wall time * number of cores)),
+the peak memory usage of one job and of all jobs together, and the input throughput in MB/s and events/s
+(if numbers of events are known from the info file of the input list or from an events file).
+Checks the integrity of the merged output of each point by comparing the numbers of entries in all histograms
+with the first point with output (requires PyROOT).
+Writes a JSON and a CSV report, prints out a table and writes the settings of the fastest point with correct output
+in a shell file that can be sourced in the input specification.
+Must be executed in the O2 environment.
+"""
+
+import argparse
+import csv
+import json
+import os
+import resource
+import shutil
+import socket
+import subprocess as sp  # nosec B404
+import time
+from dataclasses import asdict, dataclass, fields
+from typing import Dict, List, Optional
+
+from utilities import check_file, eprint, msg_bold, msg_fatal, msg_step, msg_warn
+
+DIR_THIS = os.path.dirname(os.path.realpath(__file__))
+FILEOUT = "AnalysisResults.root"  # merged output of batch_o2.sh
+FILE_REPORT = "report_jobs.json"  # report of the job runner
+MB = 1e6
+GB = 1e9
+
+
+@dataclass
+class Point:
+    """Benchmark point"""
+
+    files_per_job: int
+    parallel: int
+    cores_job: float
+    exit_code: int = -1
+    wall_s: float = 0.0  # wall time
+    cpu_s: float = 0.0  # CPU time of all processes
+    cpu_eff: float = 0.0  # CPU time / (wall time * number of cores)
+    rss_job_gb: float = 0.0  # peak memory usage of one job
+    rss_total_gb: float = 0.0  # peak memory usage of all running jobs
+    mb_s: float = 0.0  # input throughput
+    events_s: float = 0.0  # processed events per second (0 = unknown)
+    output: str = "missing"  # integrity of the merged output: ok, mismatch, missing, unchecked
+    n_mismatch: int = 0  # number of histograms with different numbers of entries than in the reference
+
+    @property
+    def name(self) -> str:
+        """Name of the point directory"""
+        return "files%d_jobs%d_cores%g" % (self.files_per_job, self.parallel, self.cores_job)
+
+    @property
+    def ok(self) -> bool:
+        """Successful run with correct output"""
+        return self.exit_code == 0 and self.output in ("ok", "unchecked")
+
+
+def get_entries(path: str) -> Optional[Dict[str, float]]:
+    """Get numbers of entries of all histograms in a ROOT file. Return None if PyROOT is not available."""
+    try:
+        import ROOT  # pylint: disable=import-outside-toplevel,import-error
+    except ImportError:
+        return None
+    entries: Dict[str, float] = {}
+
+    def add(obj, name: str):
+        if obj.InheritsFrom("TDirectory"):
+            for key in obj.GetListOfKeys():
+                add(key.ReadObj(), "%s/%s" % (name, key.GetName()))
+        elif obj.InheritsFrom("TCollection"):
+            for item in obj:
+                add(item, "%s/%s" % (name, item.GetName()))
+        elif obj.InheritsFrom("TH1"):
+            entries[name] = obj.GetEntries()
+
+    file = ROOT.TFile.Open(path)
+    if not file or file.IsZombie():
+        return {}
+    add(file, "")
+    file.Close()
+    return entries
+
+
+def read_input(path_list: str, path_events: str):
+    """Get the total size and the total number of events (0 if unknown) of the input files."""
+    with open(path_list, "r") as file:
+        files = [os.path.realpath(line.strip()) for line in file if line.strip()]
+    sizes: Dict[str, int] = {}
+    events: Dict[str, int] = {}
+    path_info = path_list.replace(".txt", "_info.txt")
+    if os.path.isfile(path_info):
+        with open(path_info, "r") as file:
+            for line in file:
+                words = line.split()
+                if len(words) >= 3:
+                    sizes[os.path.realpath(words[0])] = int(words[1])
+                    if int(words[2]) >= 0:
+                        events[os.path.realpath(words[0])] = int(words[2])
+    if path_events:
+        with open(path_events, "r") as file:
+            for line in file:
+                words = line.split()
+                if len(words) >= 2:
+                    events[os.path.realpath(words[0])] = int(words[1])
+    size = sum(sizes[f] if f in sizes else os.path.getsize(f) for f in files)
+    n_events = sum(events[f] for f in files) if all(f in events for f in files) else 0
+    return len(files), size, n_events
+
+
+def get_cpu_children() -> float:
+    """Get the CPU time of terminated child processes and their descendants."""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_point(point: Point, args, n_cores: float, size: int, n_events: int) -> Point:
+    """Run O2 jobs of a benchmark point."""
+    dir_point = os.path.join(args.output, point.name)
+    shutil.rmtree(dir_point, ignore_errors=True)
+    os.makedirs(dir_point)
+    path_pool = os.path.join(os.path.realpath(dir_point), "core_pool.json")
+    opt_jobs = "%s --report %s --core-pool %s --cores %g --cores-job %g" % (
+        args.opt_jobs,
+        FILE_REPORT,
+        path_pool,
+        n_cores,
+        point.cores_job,
+    )
+    command = [
+        "bash",
+        os.path.join(DIR_THIS, "batch_o2.sh"),
+        os.path.realpath(args.input),
+        os.path.realpath(args.json),
+        os.path.realpath(args.script),
+        "0",
+        str(point.files_per_job),
+        "",
+        str(point.parallel),
+        os.path.realpath(args.upstream) if args.upstream else "",
+        opt_jobs,
+    ]
+    cpu_start = get_cpu_children()
+    time_start = time.time()
+    with open(os.path.join(dir_point, "benchmark.log"), "w") as file_log:
+        point.exit_code = sp.call(command, cwd=dir_point, stdout=file_log, stderr=sp.STDOUT)  # nosec B603
+    point.wall_s = time.time() - time_start
+    for path in (path_pool, path_pool + ".lock"):
+        if os.path.exists(path):
+            os.remove(path)
+    point.cpu_s = get_cpu_children() - cpu_start
+    point.cpu_eff = point.cpu_s / (point.wall_s * n_cores) if point.wall_s > 0 else 0.0
+    point.mb_s = size / MB / point.wall_s if point.wall_s > 0 else 0.0
+    point.events_s = n_events / point.wall_s if point.wall_s > 0 else 0.0
+    try:
+        with open(os.path.join(dir_point, FILE_REPORT), "r") as file:
+            report = json.load(file)
+        point.rss_job_gb = max([job["rss_peak"] for job in report["jobs"]], default=0) / GB
+        point.rss_total_gb = report["rss_total_peak"] / GB
+    except (OSError, ValueError, KeyError):
+        msg_warn("Failed to read the job report of %s." % point.name)
+    if not args.debug:
+        shutil.rmtree(os.path.join(dir_point, "output_o2"), ignore_errors=True)
+        shutil.rmtree(os.path.join(dir_point, "derived_o2"), ignore_errors=True)
+    return point
+
+
+def check_output(points: List[Point], dir_out: str):
+    """Check the integrity of the merged outputs by comparing them with the first point with output."""
+    reference = None
+    for point in points:
+        path = os.path.join(dir_out, point.name, FILEOUT)
+        if not os.path.isfile(path):
+            point.output = "missing"
+            continue
+        entries = get_entries(path)
+        if entries is None:
+            point.output = "unchecked"
+            continue
+        if reference is None:
+            reference = entries
+        point.n_mismatch = sum(1 for name in set(reference) | set(entries) if reference.get(name) != entries.get(name))
+        point.output = "ok" if entries and not point.n_mismatch else "mismatch"
+    if any(point.output == "unchecked" for point in points):
+        msg_warn("PyROOT not available. Content of the outputs not checked.")
+
+
+def write_reports(points: List[Point], path_out: str):
+    """Write the JSON and the CSV report."""
+    with open(path_out + ".json", "w") as file:
+        json.dump([asdict(point) for point in points], file, indent=2)
+    columns = [f.name for f in fields(Point)]
+    with open(path_out + ".csv", "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(columns)
+        for point in points:
+            writer.writerow([getattr(point, c) for c in columns])
+
+
+def print_table(points: List[Point], best: Optional[Point]):
+    """Print out a table of the benchmark points sorted by wall time."""
+    msg_bold(
+        "%6s %6s %6s %5s %9s %6s %9s %9s %8s %9s %-9s"
+        % ("files", "jobs", "cores", "exit", "wall [s]", "CPU %", "RSS1 [GB]", "RSS [GB]", "MB/s", "events/s", "output")
+    )
+    for p in sorted(points, key=lambda p: (not p.ok, p.wall_s)):
+        eprint(
+            "%6d %6d %6g %5d %9.1f %6.1f %9.2f %9.2f %8.1f %9.1f %-9s%s"
+            % (
+                p.files_per_job,
+                p.parallel,
+                p.cores_job,
+                p.exit_code,
+                p.wall_s,
+                100 * p.cpu_eff,
+                p.rss_job_gb,
+                p.rss_total_gb,
+                p.mb_s,
+                p.events_s,
+                p.output,
+                " <- best" if p is best else "",
+            )
+        )
+
+
+def write_best(best: Point, path: str):
+    """Write the best settings in a shell file."""
+    with open(path, "w") as file:
+        file.write(
+            "# Fastest O2 job settings with correct output on %s (benchmark_o2.py, %s)\n"
+            % (socket.gethostname(), time.strftime("%Y-%m-%d %H:%M"))
+        )
+        file.write("NFILESPERJOB_O2=%d\n" % best.files_per_job)
+        file.write("NJOBSPARALLEL_O2=%d\n" % best.parallel)
+        file.write("NCORESPERJOB_O2=%g\n" % best.cores_job)
+
+
+def main():
+    """Main function"""
+    n_cpu = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description="Benchmark the throughput of O2 jobs over a grid of job parameters.")
+    parser.add_argument("input", help="list of input files")
+    parser.add_argument("json", help="JSON configuration")
+    parser.add_argument("script", help="O2 script")
+    parser.add_argument("-u", "--upstream", type=str, help="O2 script of the upstream stage of the staged mode")
+    parser.add_argument(
+        "-f", "--files-per-job", type=int, nargs="+", default=[1, 4, 16], help="numbers of input files per job"
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        nargs="+",
+        default=sorted({max(1, n_cpu // 4), max(1, n_cpu // 2), n_cpu}),
+        help="maximum numbers of parallel jobs",
+    )
+    parser.add_argument("-c", "--cores-job", type=float, nargs="+", default=[1.6], help="numbers of cores per job")
+    parser.add_argument("--cores", type=float, default=0, help="number of available cores (0 = number of CPUs)")
+    parser.add_argument("-e", "--events", type=str, default="", help='file with lines "<path> <number of events>"')
+    parser.add_argument("--opt-jobs", type=str, default="", help="other options of the job runner")
+    parser.add_argument("-o", "--output", type=str, default="benchmark_o2", help="output directory and report name")
+    parser.add_argument("-d", "--debug", action="store_true", help="debug mode (keep job directories)")
+    args = parser.parse_args()
+
+    for path in (args.input, args.json, args.script):
+        check_file(path)
+    if not shutil.which("o2-analysis-timestamp") and not os.environ.get("O2PHYSICS_ROOT"):
+        msg_warn("O2Physics environment does not seem to be loaded.")
+    n_cores = args.cores if args.cores > 0 else n_cpu
+    n_files, size, n_events = read_input(args.input, args.events)
+    if not n_files:
+        msg_fatal("No input files in %s." % args.input)
+    points = [
+        Point(f, j, c)
+        for f in sorted(set(args.files_per_job))
+        for j in sorted(set(args.jobs))
+        for c in sorted(set(args.cores_job))
+    ]
+    eprint(
+        "Benchmarking %d points with %d input files (%.1f MB, %s events) on %g cores"
+        % (len(points), n_files, size / MB, n_events or "unknown", n_cores)
+    )
+    os.makedirs(args.output, exist_ok=True)
+    for i, point in enumerate(points):
+        msg_step(
+            "Point %d/%d: %d files/job, %d parallel jobs, %g cores/job"
+            % (i + 1, len(points), point.files_per_job, point.parallel, point.cores_job)
+        )
+        run_point(point, args, n_cores, size, n_events)
+        eprint("Exit code %d, wall time %.1f s" % (point.exit_code, point.wall_s))
+    check_output(points, args.output)
+    write_reports(points, args.output)
+    points_ok = [p for p in points if p.ok]
+    best = min(points_ok, key=lambda p: p.wall_s) if points_ok else None
+    msg_step("Results (reports: %s.json, %s.csv)" % (args.output, args.output))
+    print_table(points, best)
+    if not best:
+        msg_fatal("No point finished successfully with correct output.")
+    path_best = args.output + "_best.sh"
+    write_best(best, path_best)
+    eprint("Best settings written in %s (source it in the input specification to use them)." % path_best)
+
+
+if __name__ == "__main__":
+    main()
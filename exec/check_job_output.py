@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+"""
+Checks the integrity of the output of an O2 job.
+- All input files must be readable.
+- If a histogram with the number of processed events is given, its value must be equal to the number of collisions
+  in the input files (entries of the collision trees in all data frames).
+- The output file must contain all objects of the reference list of objects.
+  If the reference list does not exist, it is created with the objects of this output
+  (i.e. by the first job whose output passes the other checks).
+  Objects are compared down to a given depth of their paths. By default, only the top-level directories
+  (outputs of tasks) are compared because the content of directories can depend on the input data
+  (e.g. histograms per run).
+The exit code is 1 if the check fails.
+The check is skipped if PyROOT is not available.
+"""
+
+import argparse
+import os
+import re
+import sys
+from typing import List, Optional
+
+from utilities import msg_err, msg_warn
+
+PATTERN_TREE_EVENTS = r"O2collision(_\d+)?$"  # trees of collisions in the data frames of AO2D files
+
+
+def get_objects(obj, name: str, objects: List[str]):
+    """Get the paths of all objects in a directory or a collection."""
+    if obj.InheritsFrom("TDirectory"):
+        for key in obj.GetListOfKeys():
+            get_objects(key.ReadObj(), "%s/%s" % (name, key.GetName()), objects)
+    elif obj.InheritsFrom("TCollection"):
+        for item in obj:
+            get_objects(item, "%s/%s" % (name, item.GetName()), objects)
+    else:
+        objects.append(name)
+
+
+def count_events(root, path: str) -> Optional[int]:
+    """Get the number of collisions in an AO2D file. Return -1 if the file cannot be read, None if unknown."""
+    file = root.TFile.Open(path)
+    if not file or file.IsZombie():
+        return -1
+    n_events = None
+    for key in file.GetListOfKeys():
+        if not key.GetName().startswith("DF_"):
+            continue
+        dir_df = key.ReadObj()
+        for key_tree in dir_df.GetListOfKeys():
+            if re.match(PATTERN_TREE_EVENTS, key_tree.GetName()):
+                n_events = (n_events or 0) + key_tree.ReadObj().GetEntries()
+                break
+    file.Close()
+    return n_events
+
+
+def get_value(root, path: str, name: str) -> Optional[float]:
+    """Get the entries or the content of a bin ("<path>:<bin>") of a histogram."""
+    name, _, i_bin = name.partition(":")
+    file = root.TFile.Open(path)
+    hist = file.Get(name) if file and not file.IsZombie() else None
+    if not hist:
+        return None
+    value = hist.GetBinContent(int(i_bin)) if i_bin else hist.GetEntries()
+    file.Close()
+    return value
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description="Check the integrity of the output of an O2 job.")
+    parser.add_argument("input", help="list of input files")
+    parser.add_argument("output", help="output file")
+    parser.add_argument("-o", "--objects", type=str, help="reference list of output objects")
+    parser.add_argument("--depth", type=int, default=1, help="depth of the paths of compared objects (0 = full paths)")
+    parser.add_argument(
+        "-e", "--events", type=str, help='histogram ("<path>[:<bin>]") with the number of processed events'
+    )
+    args = parser.parse_args()
+
+    try:
+        import ROOT  # pylint: disable=import-outside-toplevel,import-error
+    except ImportError:
+        msg_warn("PyROOT not available. Job output not checked.")
+        sys.exit(0)
+    ROOT.gROOT.SetBatch(True)
+
+    ok = True
+    with open(args.input, "r") as file:
+        files = [line.strip() for line in file if line.strip()]
+    n_events: Optional[int] = 0
+    for path in files:
+        n_file = count_events(ROOT, path)
+        if n_file == -1:
+            msg_err("Failed to read the input file %s." % path)
+            ok = False
+        elif n_file is None or n_events is None:
+            n_events = None
+        else:
+            n_events += n_file
+
+    file_out = ROOT.TFile.Open(args.output)
+    if not file_out or file_out.IsZombie():
+        msg_err("Failed to read the output file %s." % args.output)
+        sys.exit(1)
+    objects: List[str] = []
+    get_objects(file_out, "", objects)
+    file_out.Close()
+    if args.depth > 0:
+        objects = list(dict.fromkeys("/".join(name.split("/")[: args.depth + 1]) for name in objects))
+
+    if args.events:
+        n_processed = get_value(ROOT, args.output, args.events)
+        if n_processed is None:
+            msg_err("Histogram %s not found in %s." % (args.events, args.output))
+            ok = False
+        elif n_events is None:
+            msg_warn("Number of input collisions unknown. Number of processed events not checked.")
+        elif n_processed != n_events:
+            msg_err("Processed events: %g, input collisions: %d" % (n_processed, n_events))
+            ok = False
+
+    if args.objects and ok:
+        if os.path.isfile(args.objects):
+            with open(args.objects, "r") as file:
+                missing = sorted({line.strip() for line in file if line.strip()} - set(objects))
+            if missing:
+                msg_err("%d objects missing in %s, e.g. %s" % (len(missing), args.output, missing[0]))
+                ok = False
+        else:
+            # The first successful job provides the reference. Create it atomically.
+            path_tmp = "%s.tmp.%d" % (args.objects, os.getpid())
+            with open(path_tmp, "w") as file:
+                for name in objects:
+                    file.write(name + "\n")
+            try:
+                os.link(path_tmp, args.objects)
+            except FileExistsError:
+                pass
+            os.remove(path_tmp)
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
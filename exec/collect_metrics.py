@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+"""
+Collects resource metrics of DPL devices from O2 jobs.
+Reads the performanceMetrics.json files produced with --resources-monitoring in the job directories,
+aggregates CPU time, memory and throughput per device and per workflow across all jobs
+and writes a JSON and a CSV report and prints out a summary table.
+Devices are assigned to workflows by the longest workflow name (executable without "o2-analysis-")
+that matches the beginning of the device name. Parallel replicas of a device are aggregated together.
+"""
+
+import argparse
+import csv
+import glob
+import json
+import os
+import re
+from dataclasses import asdict, dataclass, fields
+from typing import Dict, List
+
+from utilities import eprint, msg_bold, msg_fatal, msg_warn
+
+FILE_METRICS = "performanceMetrics.json"  # metrics file written by DPL in the job directory
+PREFIX_WORKFLOW = "o2-analysis-"  # prefix of workflow executables not used in device names
+WORKFLOW_OTHER = "other"  # workflow of devices not assigned to any workflow (e.g. internal DPL devices)
+# Names of DPL metrics
+METRIC_CPU = "cpuUsedAbsolute"  # CPU time used during the monitoring interval [us]
+METRIC_RSS = "resident-set-size"  # resident memory [kB]
+METRIC_PSS = "proportional-set-size"  # proportional memory [kB]
+METRICS_BYTES = ("aod-bytes-read-uncompressed", "arrow-bytes-created")  # cumulative numbers of processed bytes
+
+
+@dataclass
+class Stats:
+    """Aggregated resource usage"""
+
+    jobs: int = 0  # number of jobs
+    cpu_s: float = 0.0  # total CPU time [s]
+    wall_s: float = 0.0  # total monitored time [s]
+    rss_max_mb: float = 0.0  # peak resident memory in one job [MB]
+    pss_max_mb: float = 0.0  # peak proportional memory in one job [MB]
+    bytes_mb: float = 0.0  # total processed data [MB]
+
+    @property
+    def cpu_eff(self) -> float:
+        """Average number of used cores"""
+        return self.cpu_s / self.wall_s if self.wall_s > 0 else 0.0
+
+    @property
+    def throughput_mb_s(self) -> float:
+        """Processed data per CPU second [MB/s]"""
+        return self.bytes_mb / self.cpu_s if self.cpu_s > 0 else 0.0
+
+    def add_job(self, other: "Stats"):
+        """Add resource usage in another job."""
+        self.jobs += other.jobs
+        self.cpu_s += other.cpu_s
+        self.wall_s += other.wall_s
+        self.rss_max_mb = max(self.rss_max_mb, other.rss_max_mb)
+        self.pss_max_mb = max(self.pss_max_mb, other.pss_max_mb)
+        self.bytes_mb += other.bytes_mb
+
+    def add_process(self, other: "Stats", replica: bool = False):
+        """Add resource usage of another process running at the same time (a parallel replica or another device)."""
+        self.jobs = max(self.jobs, other.jobs)
+        self.cpu_s += other.cpu_s
+        self.wall_s = max(self.wall_s, other.wall_s)
+        self.rss_max_mb += other.rss_max_mb
+        self.pss_max_mb += other.pss_max_mb
+        # Replicas process different data while devices of the same workflow process the same data.
+        self.bytes_mb = self.bytes_mb + other.bytes_mb if replica else max(self.bytes_mb, other.bytes_mb)
+
+    def to_dict(self) -> dict:
+        """Convert to a dictionary including the derived quantities."""
+        dic = asdict(self)
+        dic["cpu_eff"] = self.cpu_eff
+        dic["throughput_mb_s"] = self.throughput_mb_s
+        return dic
+
+
+def get_values(samples: list, key: str = "value") -> List[float]:
+    """Get numerical values of metric samples."""
+    values = []
+    for sample in samples:
+        try:
+            values.append(float(sample[key]))
+        except (KeyError, TypeError, ValueError):
+            continue
+    return values
+
+
+def get_device_stats(metrics: dict) -> Stats:
+    """Get resource usage of a device in one job from its metrics."""
+    stats = Stats(jobs=1)
+    stats.cpu_s = sum(get_values(metrics.get(METRIC_CPU, []))) / 1e6
+    times = [t for samples in metrics.values() if isinstance(samples, list) for t in get_values(samples, "timestamp")]
+    if times:
+        stats.wall_s = (max(times) - min(times)) / 1e3
+    stats.rss_max_mb = max(get_values(metrics.get(METRIC_RSS, [])), default=0) / 1e3
+    stats.pss_max_mb = max(get_values(metrics.get(METRIC_PSS, [])), default=0) / 1e3
+    stats.bytes_mb = sum(max(get_values(metrics.get(name, [])), default=0) for name in METRICS_BYTES) / 1e6
+    return stats
+
+
+def get_workflows(path_script: str) -> List[str]:
+    """Get the names of workflows (executables without prefix) from an O2 script."""
+    workflows = []
+    with open(path_script, "r") as file:
+        for line in file:
+            words = line.split()
+            if words and words[0].startswith("o2-"):
+                workflows.append(words[0].replace(PREFIX_WORKFLOW, ""))
+    return workflows
+
+
+def get_workflow(device: str, workflows: List[str]) -> str:
+    """Get the workflow of a device."""
+    matches = [wf for wf in workflows if device.startswith(wf)]
+    return max(matches, key=len) if matches else WORKFLOW_OTHER
+
+
+def collect(dir_jobs: str, workflows: List[str]) -> dict:
+    """Collect metrics from all jobs. Return resource usage per device and per workflow."""
+    stats_dev: Dict[str, Stats] = {}
+    stats_wf: Dict[str, Stats] = {}
+    n_jobs = 0
+    for path in sorted(glob.glob(os.path.join(dir_jobs, "*", FILE_METRICS))):
+        try:
+            with open(path, "r") as file:
+                data = json.load(file)
+        except (OSError, ValueError) as error:
+            msg_warn("Failed to read %s: %s" % (path, error))
+            continue
+        n_jobs += 1
+        # Resource usage in this job
+        stats_dev_job: Dict[str, Stats] = {}
+        for device, metrics in data.items():
+            if not isinstance(metrics, dict):
+                continue
+            device = re.sub(r"_t\d+$", "", device)  # Add parallel replicas to the main device.
+            stats_dev_job.setdefault(device, Stats()).add_process(get_device_stats(metrics), True)
+        stats_wf_job: Dict[str, Stats] = {}
+        for device, stats in stats_dev_job.items():
+            stats_wf_job.setdefault(get_workflow(device, workflows), Stats()).add_process(stats)
+        # Add to the total.
+        for device, stats in stats_dev_job.items():
+            stats_dev.setdefault(device, Stats()).add_job(stats)
+        for workflow, stats in stats_wf_job.items():
+            stats_wf.setdefault(workflow, Stats()).add_job(stats)
+    return {"jobs": n_jobs, "devices": stats_dev, "workflows": stats_wf}
+
+
+def write_reports(result: dict, path_json: str, path_csv: str):
+    """Write the JSON and the CSV report."""
+    report = {
+        "jobs": result["jobs"],
+        "devices": {name: stats.to_dict() for name, stats in result["devices"].items()},
+        "workflows": {name: stats.to_dict() for name, stats in result["workflows"].items()},
+    }
+    with open(path_json, "w") as file:
+        json.dump(report, file, indent=2)
+    columns = [f.name for f in fields(Stats)] + ["cpu_eff", "throughput_mb_s"]
+    with open(path_csv, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["level", "name"] + columns)
+        for level in ("workflows", "devices"):
+            for name, values in report[level].items():
+                writer.writerow([level[:-1], name] + [values[c] for c in columns])
+
+
+def print_table(stats: Dict[str, Stats], title: str, n_rows: int = 0):
+    """Print out a table of resource usage sorted by CPU time."""
+    cpu_total = sum(s.cpu_s for s in stats.values())
+    items = sorted(stats.items(), key=lambda item: item[1].cpu_s, reverse=True)
+    if n_rows > 0:
+        items = items[:n_rows]
+    width = max([len(title)] + [len(name) for name, _ in items])
+    msg_bold(
+        "%-*s %10s %6s %6s %10s %10s %10s"
+        % (width, title, "CPU [s]", "CPU %", "cores", "RSS [MB]", "PSS [MB]", "MB/CPU s")
+    )
+    for name, s in items:
+        eprint(
+            "%-*s %10.1f %6.1f %6.2f %10.0f %10.0f %10.2f"
+            % (
+                width,
+                name,
+                s.cpu_s,
+                100 * s.cpu_s / cpu_total if cpu_total > 0 else 0,
+                s.cpu_eff,
+                s.rss_max_mb,
+                s.pss_max_mb,
+                s.throughput_mb_s,
+            )
+        )
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description="Collect resource metrics of DPL devices from O2 jobs.")
+    parser.add_argument("dir_jobs", help="directory with job subdirectories")
+    parser.add_argument("-s", "--script", action="append", help="O2 script to get the workflow names from")
+    parser.add_argument("-o", "--output", default="metrics_o2", help="output file name without extension")
+    parser.add_argument("-n", "--rows", type=int, default=15, help="maximum number of devices in the table")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.dir_jobs):
+        msg_fatal("Directory %s does not exist." % args.dir_jobs)
+    workflows = [wf for path in args.script or [] for wf in get_workflows(path)]
+    result = collect(args.dir_jobs, workflows)
+    if not result["jobs"]:
+        msg_warn("No %s files found in %s. (Is --resources-monitoring enabled?)" % (FILE_METRICS, args.dir_jobs))
+        return
+    path_json, path_csv = args.output + ".json", args.output + ".csv"
+    write_reports(result, path_json, path_csv)
+    eprint("Resource usage in %d jobs (reports: %s, %s)" % (result["jobs"], path_json, path_csv))
+    print_table(result["workflows"], "Workflow")
+    print_table(result["devices"], "Device", args.rows)
+
+
+if __name__ == "__main__":
+    main()
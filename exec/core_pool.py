@@ -0,0 +1,109 @@
+"""
+Pool of CPU cores shared by several job runners
+
+The allocations are stored in a JSON file protected by a file lock so that independent processes
+(e.g. job runners of different steps running at the same time) can share one core budget.
+Allocations of processes that do not exist anymore are released automatically.
+
+Each runner publishes an estimate of its remaining work (in core-seconds) and whether it has jobs waiting for cores.
+The cores are partitioned between the runners in proportion to their remaining work.
+A runner can use idle cores beyond its share only if no other runner is waiting for cores.
+"""
+
+import fcntl
+import json
+import os
+from dataclasses import dataclass
+
+
+def is_alive(pid: int) -> bool:
+    """Check whether a process exists and has not terminated (zombie processes are not alive)."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    try:
+        with open("/proc/%d/stat" % pid, "r") as file:
+            stat = file.read()
+    except OSError:
+        return True
+    # The process name in parentheses can contain spaces.
+    return stat[stat.rfind(")") + 2 :].split()[0] != "Z"
+
+
+@dataclass
+class CorePool:
+    """Shared budget of CPU cores"""
+
+    path: str  # file with allocations
+    n_cores: float  # total number of cores
+
+    def _update(self, function):
+        """Load the state, let a function modify it and save it under the lock. Return the function result."""
+        with open(self.path + ".lock", "a") as file_lock:
+            fcntl.flock(file_lock, fcntl.LOCK_EX)
+            try:
+                with open(self.path, "r") as file:
+                    state = json.load(file)
+            except (OSError, ValueError):
+                state = {}
+            state = {
+                "jobs": {k: v for k, v in state.get("jobs", {}).items() if is_alive(v["pid"])},
+                "runners": {k: v for k, v in state.get("runners", {}).items() if is_alive(v["pid"])},
+            }
+            result = function(state)
+            path_tmp = "%s.tmp.%d" % (self.path, os.getpid())
+            with open(path_tmp, "w") as file:
+                json.dump(state, file)
+            os.replace(path_tmp, self.path)
+            return result
+
+    def get_share(self, state: dict) -> float:
+        """Get the number of cores assigned to this runner."""
+        runners = state["runners"]
+        work_total = sum(r["work"] for r in runners.values())
+        runner = runners.get(str(os.getpid()))
+        if not runner or work_total <= 0:
+            return self.n_cores
+        return self.n_cores * runner["work"] / work_total
+
+    def acquire(self, name: str, cores: float) -> bool:
+        """Allocate cores for a job. Return True if successful.
+
+        A job is always allowed to run if no cores are allocated so that big jobs cannot wait forever.
+        """
+
+        def allocate(state: dict) -> bool:
+            jobs = state["jobs"]
+            pid = os.getpid()
+            if jobs:
+                if sum(v["cores"] for v in jobs.values()) + cores > self.n_cores:
+                    return False
+                used = sum(v["cores"] for v in jobs.values() if v["pid"] == pid)
+                if used + cores > max(self.get_share(state), cores) and any(
+                    r["waiting"] for r in state["runners"].values() if r["pid"] != pid
+                ):
+                    return False
+            jobs["%d:%s" % (pid, name)] = {"pid": pid, "cores": cores}
+            return True
+
+        return self._update(allocate)
+
+    def release(self, name: str):
+        """Release the cores of a job."""
+        self._update(lambda state: state["jobs"].pop("%d:%s" % (os.getpid(), name), None))
+
+    def set_demand(self, work: float, waiting: bool):
+        """Publish the remaining work (in core-seconds) of this runner and whether it has jobs waiting for cores."""
+
+        def update(state: dict):
+            pid = os.getpid()
+            state["runners"][str(pid)] = {"pid": pid, "work": work, "waiting": waiting}
+
+        self._update(update)
+
+    def remove_runner(self):
+        """Remove the demand of this runner."""
+        self._update(lambda state: state["runners"].pop(str(os.getpid()), None))
@@ -0,0 +1,327 @@
+"""
+Executors of jobs
+
+The runner plans, admits, retries and merges jobs independently of where they are executed.
+An executor starts the job commands, reports their exit codes and provides their outputs.
+- LocalExecutor runs each job as a local process group (with the CPU affinity of its job slot).
+- ArrayExecutor submits the jobs started in one admission round as one array job of a batch system
+  (Slurm or HTCondor) and follows the tasks through completion markers on the shared file system.
+  Each task runs the job command with "{}" replaced by its index in the working directory of the runner,
+  writes its output to "<index>.out" and its exit code atomically to "<index>.exit".
+  A task which leaves the queue of the batch system without a completion marker is considered lost.
+  The "fake" backend writes the same (Slurm) submit files and runs the array tasks as local processes.
+"""
+
+import math
+import os
+import shlex
+import shutil
+import signal
+import subprocess as sp  # nosec B404
+import tempfile
+import time
+from dataclasses import dataclass, field
+from typing import IO, Dict, List, Optional, Set
+
+from placement import Slot, get_launcher
+from utilities import eprint, msg_warn
+
+BACKENDS = ["local", "slurm", "condor", "fake"]  # supported executor backends
+EXIT_LOST = 255  # exit code of a lost task (no completion marker)
+
+
+@dataclass
+class Task:
+    """Job command executed by an executor"""
+
+    index: int  # job index
+    pid: int = 0  # ID of the local process (group)
+    process: Optional[sp.Popen] = None  # local process
+    output: Optional[IO] = None  # temporary file with the output of a local process
+    id_batch: str = ""  # ID of the task in the batch system
+    time_submit: float = 0.0  # submission time
+    n_missing: int = 0  # number of consecutive queue checks which did not find the task
+
+
+class LocalExecutor:
+    """Runs jobs as local processes"""
+
+    local = True
+
+    def __init__(self, affinity: bool = False):
+        self.affinity = affinity  # bind jobs to the CPUs of their slots
+
+    def start(self, index: int, command: str, slot: Slot) -> Task:
+        """Start a job."""
+        output = tempfile.TemporaryFile(mode="w+")  # pylint: disable=consider-using-with
+        process = sp.Popen(  # pylint: disable=consider-using-with,subprocess-popen-preexec-fn # nosec B603 B607
+            (get_launcher(slot) if self.affinity else []) + ["bash", "-c", command],
+            stdout=output,
+            stderr=sp.STDOUT,
+            start_new_session=True,
+            preexec_fn=(lambda: os.sched_setaffinity(0, slot.cpus)) if self.affinity else None,
+        )
+        return Task(index, process.pid, process, output)
+
+    def flush(self):
+        """Submit the started jobs (nothing to do)."""
+
+    def refresh(self):
+        """Update the state of the tasks (nothing to do)."""
+
+    @staticmethod
+    def poll(task: Task) -> Optional[int]:
+        """Get the exit code of a job (None if running)."""
+        assert task.process
+        return task.process.poll()
+
+    @staticmethod
+    def read_output(task: Task) -> str:
+        """Read the output of a finished job."""
+        assert task.output
+        task.output.seek(0)
+        text = task.output.read()
+        task.output.close()
+        return text
+
+    @staticmethod
+    def kill(task: Task, sig: int):
+        """Send a signal to the process group of a job."""
+        try:
+            os.killpg(task.pid, sig)
+        except OSError:
+            pass
+
+    def clean(self):
+        """Delete the files of the executor (nothing to do)."""
+
+
+@dataclass
+class ArrayExecutor:
+    """Runs jobs as tasks of array jobs of a batch system"""
+
+    backend: str  # slurm, condor or fake
+    dir_work: str  # directory with submit files, task outputs and completion markers (shared with the worker nodes)
+    command: str  # bash command with "{}" replaced by the job index
+    cores: float = 1.0  # number of cores requested per task
+    path_options: str = ""  # file with additional lines of the submit files
+    interval_check: float = 30.0  # minimum interval between checks of the queue of the batch system [s]
+    debug: bool = False
+    local = False
+    pending: List[Task] = field(default_factory=list)  # tasks waiting for submission
+    tasks: Dict[int, Task] = field(default_factory=dict)  # submitted tasks by index
+    ids_active: Set[str] = field(default_factory=set)  # IDs of queued and running tasks in the batch system
+    n_arrays: int = 0  # number of submitted array jobs
+    time_check: float = 0.0  # time of the last queue check
+
+    def __post_init__(self):
+        self.dir_work = os.path.realpath(self.dir_work)
+        os.makedirs(self.dir_work, exist_ok=True)
+        with open(self.get_path("command.txt"), "w") as file:
+            file.write(self.command)
+        path_task = self.get_path("task.sh")
+        with open(path_task, "w") as file:
+            file.write(
+                "#!/bin/bash\n"
+                "# Run the job with the index given as the first argument and mark its completion.\n"
+                'Index="$1"\n'
+                "cd %s || exit 1\n"
+                "Command=$(cat %s)\n"
+                'bash -c "${Command//\\{\\}/$Index}" > %s/"$Index".out 2>&1\n'
+                'echo $? > %s/"$Index".exit.tmp && mv %s/"$Index".exit.tmp %s/"$Index".exit\n'
+                % (
+                    shlex.quote(os.getcwd()),
+                    shlex.quote(self.get_path("command.txt")),
+                    *[shlex.quote(self.dir_work)] * 4,
+                )
+            )
+        os.chmod(path_task, 0o755)
+
+    def get_path(self, name: str) -> str:
+        """Get the path of a file in the working directory."""
+        return os.path.join(self.dir_work, name)
+
+    def get_options(self) -> List[str]:
+        """Get the additional lines of the submit files."""
+        if not self.path_options:
+            return []
+        with open(self.path_options, "r") as file:
+            return [line.rstrip("\n") for line in file if line.strip() and not line.startswith("#!")]
+
+    def write_slurm(self, indices: List[int]) -> str:
+        """Write a Slurm batch script of an array job."""
+        path = self.get_path("array_%d.sh" % self.n_arrays)
+        lines = [
+            "#!/bin/bash",
+            "#SBATCH --job-name=run_jobs",
+            "#SBATCH --array=%s" % ",".join(str(i) for i in indices),
+            "#SBATCH --cpus-per-task=%d" % math.ceil(self.cores),
+            "#SBATCH --output=/dev/null",
+        ]
+        lines += [opt if opt.startswith("#") else "#SBATCH %s" % opt for opt in self.get_options()]
+        lines.append('bash %s "$SLURM_ARRAY_TASK_ID"' % shlex.quote(self.get_path("task.sh")))
+        with open(path, "w") as file:
+            file.write("\n".join(lines) + "\n")
+        return path
+
+    def write_condor(self, indices: List[int]) -> str:
+        """Write an HTCondor submit file of an array job."""
+        path = self.get_path("array_%d.sub" % self.n_arrays)
+        lines = [
+            "universe = vanilla",
+            "executable = %s" % self.get_path("task.sh"),
+            "arguments = $(Index)",
+            "getenv = True",
+            "request_cpus = %d" % math.ceil(self.cores),
+            "output = /dev/null",
+            "error = /dev/null",
+            "log = %s" % self.get_path("condor.log"),
+        ]
+        lines += self.get_options()
+        lines.append("queue Index in (%s)" % ", ".join(str(i) for i in indices))
+        with open(path, "w") as file:
+            file.write("\n".join(lines) + "\n")
+        return path
+
+    def start(self, index: int, command: str, slot: Slot) -> Task:  # pylint: disable=unused-argument
+        """Queue a job for the submission of the next array job."""
+        for suffix in (".out", ".exit"):
+            if os.path.exists(self.get_path(str(index) + suffix)):
+                os.remove(self.get_path(str(index) + suffix))
+        task = Task(index)
+        self.pending.append(task)
+        return task
+
+    def flush(self):
+        """Submit the queued jobs as one array job."""
+        if not self.pending:
+            return
+        indices = [task.index for task in self.pending]
+        time_submit = time.time()
+        if self.backend == "condor":
+            path = self.write_condor(indices)
+            result = sp.run(["condor_submit", "-terse", path], capture_output=True, text=True, check=False)  # nosec
+            cluster = result.stdout.split(".")[0].strip()
+            ids = ["%s.%d" % (cluster, i) for i in range(len(indices))]
+        elif self.backend == "slurm":
+            path = self.write_slurm(indices)
+            result = sp.run(["sbatch", "--parsable", path], capture_output=True, text=True, check=False)  # nosec
+            id_array = result.stdout.strip().split(";")[0]
+            ids = ["%s_%d" % (id_array, i) for i in indices]
+        else:
+            path = self.write_slurm(indices)
+            result = sp.CompletedProcess([], 0)
+            ids = []
+            for task in self.pending:
+                task.process = sp.Popen(  # pylint: disable=consider-using-with # nosec B603 B607
+                    ["bash", path],
+                    env=dict(os.environ, SLURM_ARRAY_TASK_ID=str(task.index)),
+                    stdout=sp.DEVNULL,
+                    stderr=sp.DEVNULL,
+                    start_new_session=True,
+                )
+                task.pid = task.process.pid
+                ids.append(str(task.pid))
+        if result.returncode != 0:
+            msg_warn("Failed to submit %s: %s" % (path, (result.stderr or "").strip()))
+            ids = [""] * len(indices)
+        for task, id_batch in zip(self.pending, ids):
+            task.id_batch = id_batch
+            task.time_submit = time_submit
+            self.tasks[task.index] = task
+            self.ids_active.add(id_batch)
+        if self.debug:
+            eprint("Submitted array job %d with %d tasks: %s" % (self.n_arrays, len(indices), path))
+        self.n_arrays += 1
+        self.pending = []
+
+    def get_ids_active(self) -> Optional[Set[str]]:
+        """Get the IDs of the queued and running tasks from the batch system (None if the query failed)."""
+        if self.backend == "fake":
+            return {str(t.pid) for t in self.tasks.values() if t.process and t.process.poll() is None}
+        if self.backend == "slurm":
+            arrays = sorted({t.id_batch.split("_")[0] for t in self.tasks.values() if t.id_batch})
+            command = ["squeue", "-h", "-r", "-o", "%i", "-j", ",".join(arrays)]
+        else:
+            arrays = sorted({t.id_batch.split(".")[0] for t in self.tasks.values() if t.id_batch})
+            command = ["condor_q"] + arrays + ["-af", "ClusterId", "ProcId"]
+        if not arrays:
+            return set()
+        result = sp.run(command, capture_output=True, text=True, check=False)  # nosec B603 B607
+        if result.returncode != 0:
+            # Slurm rejects IDs of array jobs which have already left the queue.
+            return set() if "Invalid job id" in result.stderr else None
+        return {".".join(line.split()) for line in result.stdout.splitlines() if line.strip()}
+
+    def refresh(self):
+        """Check the queue of the batch system for lost tasks (at most once per check interval)."""
+        time_now = time.time()
+        if self.backend != "fake" and time_now - self.time_check < self.interval_check:
+            return
+        self.time_check = time_now
+        ids_active = self.get_ids_active()
+        if ids_active is None:
+            return
+        self.ids_active = ids_active
+        for task in self.tasks.values():
+            if task.id_batch in ids_active or os.path.exists(self.get_path("%d.exit" % task.index)):
+                task.n_missing = 0
+            else:
+                task.n_missing += 1
+
+    def poll(self, task: Task) -> Optional[int]:
+        """Get the exit code of a job from its completion marker (None if running)."""
+        path = self.get_path("%d.exit" % task.index)
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                text = file.read().strip()
+            self.tasks.pop(task.index, None)
+            return int(text) if text.lstrip("-").isdigit() else EXIT_LOST
+        # The task left the queue (seen twice to tolerate delayed markers on shared file systems).
+        if not task.id_batch or task.n_missing >= 2:
+            self.tasks.pop(task.index, None)
+            return EXIT_LOST
+        return None
+
+    def read_output(self, task: Task) -> str:
+        """Read the output of a finished job."""
+        path = self.get_path("%d.out" % task.index)
+        text = ""
+        if os.path.exists(path):
+            with open(path, "r", errors="replace") as file:
+                text = file.read()
+        if not os.path.exists(self.get_path("%d.exit" % task.index)):
+            text += "Task %s of job %d lost without completion marker\n" % (
+                task.id_batch or "(not submitted)",
+                task.index,
+            )
+        return text
+
+    def kill(self, task: Task, sig: int):
+        """Remove a job from the batch system."""
+        if task in self.pending:
+            self.pending.remove(task)
+            return
+        if self.backend == "fake":
+            LocalExecutor.kill(task, sig)
+            return
+        if not task.id_batch:
+            return
+        command = ["scancel", task.id_batch] if self.backend == "slurm" else ["condor_rm", task.id_batch]
+        if sig == signal.SIGKILL and self.backend == "slurm":
+            command.insert(1, "--signal=KILL")
+        sp.run(command, stdout=sp.DEVNULL, stderr=sp.DEVNULL, check=False)  # nosec B603 B607
+
+    def clean(self):
+        """Delete the working directory (kept in debug mode)."""
+        if not self.debug:
+            shutil.rmtree(self.dir_work, ignore_errors=True)
+
+
+def make_executor(
+    backend: str, dir_work: str, command: str, cores: float, path_options: str, affinity: bool, debug: bool
+):
+    """Make the executor of a backend."""
+    if backend == "local":
+        return LocalExecutor(affinity)
+    return ArrayExecutor(backend, dir_work, command, cores, path_options, debug=debug)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+"""
+Makes a list of input files from a persistent catalogue of an input directory.
+Replacement of "find <directory> -name <pattern> | sort | head -n <number>" that does not list unchanged directories.
+
+The catalogue stores the path, size, modification time and optionally the number of events of each file
+matching the pattern, and the modification time of each directory.
+It is updated incrementally: only directories whose modification time changed are listed again.
+(A directory changes when files are added, removed or renamed in it, not when a file is modified in place.)
+Numbers of events can be imported from a file and are kept as long as the file size and modification time do not change.
+
+Files in a quarantine list (input files that failed alone in jobs, see quarantine.py) can be excluded.
+The selected files are sorted like by sort (locale collation) and written in the output list.
+Their sizes and numbers of events can be written in an info file for the job planner (see plan_jobs.py).
+"""
+
+import argparse
+import fnmatch
+import hashlib
+import json
+import locale
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from quarantine import Quarantine
+from utilities import eprint, msg_fatal, msg_warn
+
+VERSION = 1  # version of the catalogue format
+
+
+def select(files: List[str], n_files_max: str) -> List[str]:
+    """Select files like head -n: the first N files for N > 0, all but the last N files for -N."""
+    try:
+        number = int(n_files_max)
+    except ValueError:
+        msg_fatal("Invalid maximum number of files: %s" % n_files_max)
+    if n_files_max.strip().startswith("-"):
+        return files[: len(files) + number]
+    return files[:number]
+
+
+def sort_paths(paths: List[str]) -> List[str]:
+    """Sort paths like sort (locale collation with byte comparison of equal strings)."""
+    try:
+        locale.setlocale(locale.LC_COLLATE, "")
+    except locale.Error:
+        pass
+    return sorted(paths, key=lambda path: (locale.strxfrm(path), path))
+
+
+@dataclass
+class Catalogue:
+    """Catalogue of files matching a pattern in a directory tree"""
+
+    dir_root: str  # input directory
+    pattern: str  # file name pattern
+    path: str = ""  # file with the catalogue (empty = not persistent)
+    dirs: Dict[str, dict] = field(default_factory=dict)  # directory entries by path relative to the root
+    n_listed: int = 0  # number of directories listed in the last update
+    n_reused: int = 0  # number of unchanged directories in the last update
+
+    def load(self):
+        """Load the catalogue from the file."""
+        if not self.path or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, "r") as file:
+                data = json.load(file)
+        except (OSError, ValueError) as error:
+            msg_warn("Failed to read the catalogue %s: %s" % (self.path, error))
+            return
+        if data.get("version") == VERSION and data.get("dir") == self.dir_root and data.get("pattern") == self.pattern:
+            self.dirs = data["dirs"]
+
+    def save(self):
+        """Save the catalogue in the file."""
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        path_tmp = "%s.tmp.%d" % (self.path, os.getpid())
+        with open(path_tmp, "w") as file:
+            json.dump({"version": VERSION, "dir": self.dir_root, "pattern": self.pattern, "dirs": self.dirs}, file)
+        os.replace(path_tmp, self.path)
+
+    def list_dir(self, path_dir: str, entry_old: Optional[dict]) -> dict:
+        """List a directory. Return its entry with subdirectories and matching files."""
+        subdirs = []
+        files = {}
+        files_old = entry_old["files"] if entry_old else {}
+        with os.scandir(path_dir) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                elif fnmatch.fnmatchcase(entry.name, self.pattern):
+                    try:
+                        stat = os.stat(entry.path)
+                    except OSError:
+                        continue
+                    size, mtime = stat.st_size, stat.st_mtime_ns
+                    # Keep the number of events of unchanged files.
+                    old = files_old.get(entry.name)
+                    events = old[2] if old and old[:2] == [size, mtime] else None
+                    files[entry.name] = [size, mtime, events]
+        return {"subdirs": sorted(subdirs), "files": files}
+
+    def update(self):
+        """Update the catalogue by listing changed directories."""
+        dirs = {}
+        self.n_listed = self.n_reused = 0
+        stack = [""]
+        while stack:
+            rel = stack.pop()
+            path_dir = os.path.join(self.dir_root, rel) if rel else self.dir_root
+            try:
+                mtime = os.stat(path_dir).st_mtime_ns
+            except OSError:
+                continue
+            entry = self.dirs.get(rel)
+            if entry and entry["mtime"] == mtime:
+                self.n_reused += 1
+            else:
+                try:
+                    entry = self.list_dir(path_dir, entry)
+                except OSError as error:
+                    msg_warn("Failed to list %s: %s" % (path_dir, error))
+                    continue
+                entry["mtime"] = mtime
+                self.n_listed += 1
+            dirs[rel] = entry
+            stack.extend(os.path.join(rel, name) if rel else name for name in entry["subdirs"])
+        self.dirs = dirs
+
+    def get_files(self) -> Dict[str, list]:
+        """Get the size, modification time and number of events of all files by their paths."""
+        files = {}
+        for rel, entry in self.dirs.items():
+            path_dir = os.path.join(self.dir_root, rel) if rel else self.dir_root
+            for name, info in entry["files"].items():
+                files[os.path.join(path_dir, name)] = info
+        return files
+
+    def set_events(self, events: Dict[str, int]) -> int:
+        """Set numbers of events of files. Return the number of updated files."""
+        n_set = 0
+        for rel, entry in self.dirs.items():
+            path_dir = os.path.join(self.dir_root, rel) if rel else self.dir_root
+            for name, info in entry["files"].items():
+                path = os.path.join(path_dir, name)
+                if path in events:
+                    info[2] = events[path]
+                    n_set += 1
+        return n_set
+
+
+def read_events(path: str) -> Dict[str, int]:
+    """Read numbers of events from a file with lines "<path> <number of events>"."""
+    events = {}
+    with open(path, "r") as file:
+        for line in file:
+            words = line.split()
+            if len(words) < 2:
+                continue
+            try:
+                events[os.path.realpath(words[0])] = int(words[1])
+            except ValueError:
+                msg_warn("Invalid number of events in line: %s" % line.strip())
+    return events
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description="Make a list of input files from a catalogue of a directory.")
+    parser.add_argument("dir_input", help="input directory")
+    parser.add_argument("pattern", help="file name pattern (as in find -name)")
+    parser.add_argument("output", help="output list of files")
+    parser.add_argument(
+        "-n", "--files-max", type=str, default="-0", help="maximum number of files (as in head -n, -N = all but last N)"
+    )
+    parser.add_argument("-c", "--cache", type=str, help="directory of catalogues (no catalogue is kept if not set)")
+    parser.add_argument("-e", "--events", type=str, help='file with lines "<path> <number of events>" to import')
+    parser.add_argument("-q", "--quarantine", type=str, help="quarantine list of files to exclude")
+    parser.add_argument("--quarantine-scope", type=str, default="", help="scope of the excluded quarantine entries")
+    parser.add_argument(
+        "--quarantine-age", type=float, default=0, help="maximum age of quarantine entries [days] (0 = unlimited)"
+    )
+    parser.add_argument("-i", "--info", type=str, help='write lines "<path> <size> <number of events or -1>"')
+    parser.add_argument("-d", "--debug", action="store_true", help="debug mode")
+    args = parser.parse_args()
+
+    dir_input = os.path.realpath(args.dir_input)
+    if not os.path.isdir(dir_input):
+        msg_fatal("Directory %s does not exist." % dir_input)
+    path_catalogue = ""
+    if args.cache:
+        key = hashlib.sha256(("%s\n%s" % (dir_input, args.pattern)).encode()).hexdigest()
+        path_catalogue = os.path.join(args.cache, key + ".json")
+    catalogue = Catalogue(dir_input, args.pattern, path_catalogue)
+    time_start = time.time()
+    catalogue.load()
+    catalogue.update()
+    if args.events:
+        n_set = catalogue.set_events(read_events(args.events))
+        if args.debug:
+            eprint("Imported numbers of events of %d files" % n_set)
+    catalogue.save()
+    files = catalogue.get_files()
+    if args.debug:
+        eprint(
+            "Catalogue of %s: %d files, %d directories listed, %d unchanged (%.1f s)"
+            % (dir_input, len(files), catalogue.n_listed, catalogue.n_reused, time.time() - time_start)
+        )
+    paths = list(files)
+    if args.quarantine:
+        excluded = Quarantine(args.quarantine, args.quarantine_scope, args.quarantine_age * 86400).get_files()
+        n_paths = len(paths)
+        paths = [path for path in paths if path not in excluded]
+        if len(paths) < n_paths:
+            msg_warn("Excluded %d files in quarantine (see %s)" % (n_paths - len(paths), args.quarantine))
+    paths = select(sort_paths(paths), args.files_max)
+    with open(args.output, "w") as file:
+        for path in paths:
+            file.write(path + "\n")
+    if args.info:
+        with open(args.info, "w") as file:
+            for path in paths:
+                size, _, events = files[path]
+                file.write("%s %d %d\n" % (path, size, -1 if events is None else events))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""
+Content-addressed cache of job results
+
+A job is identified by a key computed from:
+- the job command (with the job index replaced by "{}"),
+- the content of the given files (e.g. JSON configuration, scripts) and of existing files referenced in them by
+  absolute paths (e.g. macros),
+- the path, size and modification time of each input file in the job input list,
+- the values of the given environment variables (e.g. software versions),
+- the paths, sizes and modification times of the files in the bin and lib directories of the given software builds
+  (so that a build rebuilt in place with the same installation path is recognised as different).
+Outputs of successful jobs are copied in <cache directory>/<key[:2]>/<key>/ and restored (hard-linked if possible)
+instead of running the job again.
+Entries older than the maximum age are evicted, then the least recently used entries are evicted until the cache
+is smaller than the maximum size. The eviction can be run on other cache directories with the same layout
+from the command line.
+"""
+
+import argparse
+import hashlib
+import os
+import re
+import shutil
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+FILE_DONE = ".done"  # marker of a complete cache entry
+DIRS_BUILD = ("bin", "lib")  # subdirectories of a software build identifying the build
+
+
+def hash_file(path: str) -> str:
+    """Get the hash of the content of a file."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def get_referenced_files(path: str) -> List[str]:
+    """Get existing files referenced by absolute paths in a text file."""
+    try:
+        with open(path, "r", errors="replace") as file:
+            text = file.read()
+    except OSError:
+        return []
+    paths = {match.rstrip(".,;:") for match in re.findall(r"/[^\s\"'\\(),$]+", text)}
+    return sorted(p for p in paths if os.path.isfile(p))
+
+
+def hash_build(path: str) -> str:
+    """Get the hash of the paths, sizes and modification times of the executables and libraries of a build."""
+    sha = hashlib.sha256()
+    for dir_sub in DIRS_BUILD:
+        for dir_this, dirs, files in os.walk(os.path.join(path, dir_sub)):
+            dirs.sort()
+            for name in sorted(files):
+                path_file = os.path.join(dir_this, name)
+                try:
+                    stat = os.stat(path_file)
+                except OSError:
+                    continue
+                sha.update(("%s %d %d\n" % (path_file, stat.st_size, stat.st_mtime_ns)).encode())
+    return sha.hexdigest()
+
+
+def copy_or_link(path_src: str, path_dest: str):
+    """Hard-link a file if possible, copy it otherwise."""
+    if os.path.exists(path_dest):
+        os.remove(path_dest)
+    try:
+        os.link(path_src, path_dest)
+    except OSError:
+        shutil.copy2(path_src, path_dest)
+
+
+def get_dir_size(path: str) -> int:
+    """Get the total size of files in a directory."""
+    size = 0
+    for dir_this, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(dir_this, name))
+            except OSError:
+                pass
+    return size
+
+
+@dataclass
+class JobCache:
+    """Cache of job results"""
+
+    path: str  # cache directory
+    command: str  # job command template
+    files_key: List[str]  # files whose content identifies the jobs
+    list_input: str  # job input list with "{}" replaced by the job index
+    outputs: List[str]  # job output files with "{}" replaced by the job index
+    env: List[str] = field(default_factory=list)  # environment variables identifying the jobs
+    builds: List[str] = field(default_factory=list)  # environment variables with paths of builds identifying the jobs
+    size_max: float = 0  # maximum total size in bytes (0 = unlimited)
+    age_max: float = 0  # maximum age in seconds (0 = unlimited)
+    hash_common: str = ""  # hash of the parts of the key common to all jobs
+    keys: Dict[int, str] = field(default_factory=dict)  # keys per job index
+
+    def __post_init__(self):
+        sha = hashlib.sha256()
+        sha.update(self.command.encode())
+        paths = list(self.files_key)
+        for path in self.files_key:
+            paths += get_referenced_files(path)
+        for path in paths:
+            sha.update(("%s %s\n" % (os.path.basename(path), hash_file(path))).encode())
+        for name in self.env:
+            sha.update(("%s=%s\n" % (name, os.environ.get(name, ""))).encode())
+        for name in self.builds:
+            path = os.environ.get(name, "")
+            if path:
+                sha.update(("%s %s\n" % (name, hash_build(path))).encode())
+        self.hash_common = sha.hexdigest()
+
+    def get_key(self, index: int) -> str:
+        """Get the key of a job."""
+        if index not in self.keys:
+            sha = hashlib.sha256(self.hash_common.encode())
+            with open(self.list_input.replace("{}", str(index)), "r") as file:
+                for line in file:
+                    path = line.strip()
+                    if path:
+                        stat = os.stat(path)
+                        sha.update(("%s %d %d\n" % (path, stat.st_size, stat.st_mtime_ns)).encode())
+            self.keys[index] = sha.hexdigest()
+        return self.keys[index]
+
+    def get_dir_entry(self, index: int) -> str:
+        """Get the directory of the cache entry of a job."""
+        key = self.get_key(index)
+        return os.path.join(self.path, key[:2], key)
+
+    def restore(self, index: int) -> bool:
+        """Restore the outputs of a job from the cache. Return True if found."""
+        dir_entry = self.get_dir_entry(index)
+        if not os.path.isfile(os.path.join(dir_entry, FILE_DONE)):
+            return False
+        for pattern in self.outputs:
+            path_out = pattern.replace("{}", str(index))
+            path_cached = os.path.join(dir_entry, os.path.basename(path_out))
+            if os.path.isfile(path_cached):
+                copy_or_link(path_cached, path_out)
+        os.utime(dir_entry)  # Mark as recently used.
+        return True
+
+    def store(self, index: int) -> bool:
+        """Store the outputs of a successful job in the cache. Return True if stored."""
+        dir_entry = self.get_dir_entry(index)
+        paths_out = [p.replace("{}", str(index)) for p in self.outputs]
+        paths_out = [p for p in paths_out if os.path.isfile(p)]
+        if not paths_out:
+            return False
+        dir_tmp = "%s.tmp.%d" % (dir_entry, os.getpid())
+        try:
+            os.makedirs(dir_tmp, exist_ok=True)
+            for path_out in paths_out:
+                # Copy so that the cached file cannot be modified via the job output.
+                shutil.copy2(path_out, os.path.join(dir_tmp, os.path.basename(path_out)))
+            open(os.path.join(dir_tmp, FILE_DONE), "w").close()  # pylint: disable=consider-using-with
+            shutil.rmtree(dir_entry, ignore_errors=True)
+            os.rename(dir_tmp, dir_entry)
+        except OSError:
+            shutil.rmtree(dir_tmp, ignore_errors=True)
+            return False
+        return True
+
+    def evict(self) -> Tuple[int, int]:
+        """Evict old and least recently used entries. Return the numbers of kept and evicted entries."""
+        return evict(self.path, self.size_max, self.age_max)
+
+
+def evict(path: str, size_max: float = 0, age_max: float = 0) -> Tuple[int, int]:
+    """Evict old and least recently used entries of a cache directory. Return the numbers of kept and evicted entries.
+
+    Entries are directories <path>/<key[:2]>/<key> whose modification time is the time of the last use.
+    """
+    entries = []
+    for dir_prefix in os.listdir(path) if os.path.isdir(path) else []:
+        path_prefix = os.path.join(path, dir_prefix)
+        if os.path.isdir(path_prefix):
+            for name in os.listdir(path_prefix):
+                path_entry = os.path.join(path_prefix, name)
+                if os.path.isdir(path_entry) and ".tmp." not in name:
+                    entries.append((os.path.getmtime(path_entry), get_dir_size(path_entry), path_entry))
+    entries.sort(reverse=True)  # most recently used first
+    time_now = time.time()
+    size_total = 0
+    n_evicted = 0
+    for time_used, size, path_entry in entries:
+        too_old = age_max > 0 and time_now - time_used > age_max
+        too_big = size_max > 0 and size_total + size > size_max
+        if too_old or too_big:
+            shutil.rmtree(path_entry, ignore_errors=True)
+            n_evicted += 1
+        else:
+            size_total += size
+    for dir_prefix in os.listdir(path) if os.path.isdir(path) else []:
+        path_prefix = os.path.join(path, dir_prefix)
+        if os.path.isdir(path_prefix) and not os.listdir(path_prefix):
+            os.rmdir(path_prefix)
+    return len(entries) - n_evicted, n_evicted
+
+
+def main():
+    """Evict entries of a cache directory (e.g. the store of derived AO2Ds of the staged O2 mode)."""
+    parser = argparse.ArgumentParser(description="Evict old and least recently used entries of a cache directory.")
+    parser.add_argument("path", help="cache directory")
+    parser.add_argument("-s", "--size", type=float, default=0, help="maximum size of the cache [GB] (0 = unlimited)")
+    parser.add_argument("-a", "--age", type=float, default=0, help="maximum age of entries [days] (0 = unlimited)")
+    parser.add_argument("-d", "--debug", action="store_true", help="debug mode")
+    args = parser.parse_args()
+    n_kept, n_evicted = evict(args.path, args.size * 1e9, args.age * 86400)
+    if args.debug:
+        print("Cache entries in %s: %d (evicted: %d)" % (args.path, n_kept, n_evicted))
+
+
+if __name__ == "__main__":
+    main()
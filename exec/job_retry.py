@@ -0,0 +1,64 @@
+"""
+Retries of failed jobs with their input files split in smaller jobs
+
+A failed job is retried in several jobs with new indices, each with a part of its input files,
+recursively down to single files, so that bad input files are isolated.
+The input lists of the new jobs are written in their own job directories.
+Input files that fail alone are excluded from the outputs and can be added to a quarantine list (see quarantine.py),
+unless no job succeeded, which indicates a general problem rather than bad files.
+"""
+
+import os
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from quarantine import Quarantine
+from utilities import eprint, msg_warn
+
+
+@dataclass
+class Retrier:
+    """Policy of retries of failed jobs"""
+
+    split_list: str  # input list of a job with "{}" replaced by the job index
+    command: str  # job command with "{}" replaced by the job index
+    n_parts: int = 2  # number of jobs in which a failed job is split
+    quarantine: Optional[Quarantine] = None  # list of input files that failed alone
+
+    def get_dir_job(self, index: int) -> str:
+        """Get the directory of a job (with its input list)."""
+        return os.path.dirname(self.split_list.replace("{}", str(index)))
+
+    def split(self, index: int, files: List[str], index_next: int) -> List[Tuple[int, str, List[str]]]:
+        """Write the input lists of the jobs retrying a failed job. Return the index, command and files of each job."""
+        n_parts = min(self.n_parts, len(files))
+        jobs = []
+        for i_part in range(n_parts):
+            index_new = index_next + i_part
+            files_new = files[i_part * len(files) // n_parts : (i_part + 1) * len(files) // n_parts]
+            path_list = self.split_list.replace("{}", str(index_new))
+            os.makedirs(os.path.dirname(path_list), exist_ok=True)
+            with open(path_list, "w") as file:
+                for path in files_new:
+                    file.write(path + "\n")
+            jobs.append((index_new, self.command.replace("{}", str(index_new)), files_new))
+        print(
+            "Job %d: retrying its %d input files in jobs %s" % (index, len(files), ", ".join(str(j[0]) for j in jobs)),
+            flush=True,
+        )
+        return jobs
+
+    def exclude(self, files: List[str], any_success: bool) -> bool:
+        """Exclude input files that failed alone from the outputs and add them to the quarantine list.
+
+        Input files are considered bad only if other input files can be processed (any_success).
+        Return True if the files are excluded, False if their jobs count as failed.
+        """
+        if not any_success:
+            return False
+        msg_warn("Input files excluded from the outputs (failed alone): %d" % len(files))
+        for path in files:
+            eprint(path)
+        if self.quarantine:
+            self.quarantine.add(files)
+        return True
@@ -0,0 +1,142 @@
+"""
+Live monitoring of job log files
+
+Log files are read incrementally while jobs are running (only new content is read in each update).
+Lines are classified as warnings, errors and fatal errors with the same patterns as used by the batch scripts.
+A summary of the messages of each job can be written in a JSON file.
+"""
+
+import json
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+# Patterns of message classes in log files per type of jobs (same as in the batch scripts)
+PATTERNS = {
+    "o2": {
+        "fatal": [r"\[FATAL\]", "segmentation", "Segmentation", "command not found"],
+        "error": [r"\[ERROR\]", "Error:", "Error in "],
+        "warning": [r"\[WARN\]", "Warning in "],
+    },
+    "ali": {
+        "fatal": ["^F-", "^Fatal", "segmentation", "Segmentation"],
+        "error": ["^E-", "^Error"],
+        "warning": ["^W-", "^Warning"],
+    },
+}
+CLASSES = ("fatal", "error", "warning")  # in the order of priority
+N_MESSAGES_MAX = 20  # maximum number of distinct messages per class stored in the summary
+
+
+def compile_patterns(name: str) -> Dict[str, "re.Pattern[str]"]:
+    """Compile the patterns of a given type of jobs into one regular expression per message class."""
+    return {cls: re.compile("|".join(PATTERNS[name][cls])) for cls in CLASSES}
+
+
+def classify(line: str, patterns: Dict[str, "re.Pattern[str]"]) -> Optional[str]:
+    """Get the message class of a line (None if no pattern matches)."""
+    for cls in CLASSES:
+        if patterns[cls].search(line):
+            return cls
+    return None
+
+
+@dataclass
+class LogTail:
+    """Log file read incrementally"""
+
+    path: str
+    offset: int = 0  # number of bytes read
+    n_lines: int = 0  # number of complete lines read
+    rest: bytes = b""  # incomplete last line
+
+    def read_lines(self) -> List[str]:
+        """Read new complete lines."""
+        try:
+            with open(self.path, "rb") as file:
+                file.seek(0, os.SEEK_END)
+                size = file.tell()
+                if size < self.offset:  # file was truncated or replaced
+                    self.offset, self.rest = 0, b""
+                if size == self.offset:
+                    return []
+                file.seek(self.offset)
+                data = self.rest + file.read(size - self.offset)
+                self.offset = size
+        except OSError:
+            return []
+        lines = data.split(b"\n")
+        self.rest = lines.pop()
+        return [line.decode("utf-8", errors="replace") for line in lines]
+
+    def flush(self) -> List[str]:
+        """Read the remaining lines including an incomplete last line."""
+        lines = self.read_lines()
+        if self.rest:
+            lines.append(self.rest.decode("utf-8", errors="replace"))
+            self.rest = b""
+        return lines
+
+
+@dataclass
+class JobLog:
+    """Messages found in the log files of a job"""
+
+    tails: List[LogTail]
+    counts: Dict[str, int] = field(default_factory=lambda: {cls: 0 for cls in CLASSES})
+    messages: Dict[str, Dict[str, dict]] = field(default_factory=lambda: {cls: {} for cls in CLASSES})
+    fatal: Optional[dict] = None  # first fatal message
+
+    def add(self, cls: str, path: str, i_line: int, line: str):
+        """Add a classified line."""
+        self.counts[cls] += 1
+        messages = self.messages[cls]
+        if line in messages:
+            messages[line]["count"] += 1
+        elif len(messages) < N_MESSAGES_MAX:
+            messages[line] = {"message": line, "file": path, "line": i_line, "count": 1}
+        if cls == "fatal" and not self.fatal:
+            self.fatal = {"message": line, "file": path, "line": i_line}
+
+
+@dataclass
+class LogMonitor:
+    """Monitors log files of jobs"""
+
+    patterns: Dict[str, "re.Pattern[str]"]  # compiled patterns per message class
+    paths_log: List[str]  # paths of log files with "{}" replaced by the job index
+    path_summary: str = ""  # path of the summary file with "{}" replaced by the job index
+    logs: Dict[int, JobLog] = field(default_factory=dict)  # logs per job index
+
+    def add_job(self, index: int):
+        """Start monitoring the logs of a job."""
+        self.logs[index] = JobLog([LogTail(path.replace("{}", str(index))) for path in self.paths_log])
+
+    def scan(self, index: int, final: bool = False) -> Optional[dict]:
+        """Read new lines in the logs of a job. Return the first fatal message if any."""
+        log = self.logs[index]
+        for tail in log.tails:
+            for line in tail.flush() if final else tail.read_lines():
+                tail.n_lines += 1
+                cls = classify(line, self.patterns)
+                if cls:
+                    log.add(cls, tail.path, tail.n_lines, line)
+        return log.fatal
+
+    def write_summary(self, index: int, status: str, exit_code: Optional[int]):
+        """Write the summary of messages of a job in a JSON file."""
+        if not self.path_summary:
+            return
+        log = self.logs[index]
+        summary = {
+            "job": index,
+            "status": status,
+            "exit_code": exit_code,
+            "logs": [tail.path for tail in log.tails],
+            "counts": log.counts,
+            "fatal": log.fatal,
+            "messages": {cls: list(log.messages[cls].values()) for cls in CLASSES},
+        }
+        with open(self.path_summary.replace("{}", str(index)), "w") as file:
+            json.dump(summary, file, indent=2)
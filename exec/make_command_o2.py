@@ -2,16 +2,85 @@
 
 """
 Generates full O2 command based on a YAML database of workflows and options.
+Can be imported as a library to build many commands from one database (see load_database, build_command).
+Library functions raise ConfigError on invalid input.
 Author: Vít Kučera <vit.kucera@cern.ch>
 """
 
 import argparse
+import hashlib
+import json
 import os
+import pickle  # nosec B403
+import re
 import sys
-from typing import List
+import time
+from dataclasses import dataclass, field
+from typing import Iterable, List, Optional, Tuple
 
 import yaml  # pylint: disable=import-error
 
+# Version of the format of the cached databases (Increase when parsing or validation of the database changes.)
+CACHE_VERSION = 2
+# Maximum age of unused cached databases [days]
+CACHE_AGE_MAX = 30
+# Stages of the staged mode
+STAGES = ("upstream", "downstream")
+# Name of the derived AO2D file produced in the upstream stage (without extension)
+FILE_DERIVED = "AO2D_derived"
+# DPL options set by the automatic memory tuning (see get_memory_settings)
+OPTIONS_MEMORY = ("aod-memory-rate-limit", "shm-segment-size", "readers")
+RATE_LIMIT_DEFAULT = 2e9  # AOD memory rate limit if the input size is unknown [B]
+RATE_LIMIT_MIN = 5e8  # minimum AOD memory rate limit [B]
+RATE_LIMIT_MAX = 4e9  # maximum AOD memory rate limit [B]
+FRACTION_IN_FLIGHT = 0.5  # fraction of the largest input file kept in flight by one reader
+MEMORY_DEFAULT = 0.1  # size of the tables produced by a workflow without a memory hint relative to the input size
+SHM_BASE = 1e9  # shared memory for messages other than tables (histograms, configuration) [B]
+SHM_OVERHEAD = 1.5  # safety factor of the shared memory segment (fragmentation, messages of the next time frame)
+SHM_MIN = 2e9  # minimum shared memory segment size [B]
+COST_READER = 2.0  # relative CPU cost of an AOD reader (see cost hints)
+
+
+@dataclass
+class WorkflowCommand:
+    """Command of a single workflow in the O2 pipeline"""
+
+    name: str  # name of the workflow node in the database
+    executable: str  # workflow executable
+    options: str = ""  # all command line options of the workflow
+
+    def __str__(self) -> str:
+        return self.executable + (" " + self.options if self.options else "")
+
+
+@dataclass
+class Command:
+    """Full O2 command as a pipeline of workflows"""
+
+    workflows: List[WorkflowCommand] = field(default_factory=list)  # workflows in topological order
+    options_global: str = ""  # options that appear only once at the end of the command
+    tables: List[str] = field(default_factory=list)  # tables saved in the output trees
+
+    def __str__(self) -> str:
+        command = " | \\\n".join(str(wf) for wf in self.workflows) + " "
+        if self.options_global:
+            command += " " + self.options_global
+        return command
+
+
+@dataclass
+class Resources:
+    """Input and resources of a job for the automatic tuning of the DPL memory settings"""
+
+    size_file: int = 0  # size of the largest input file [B] (0 = unknown)
+    n_files: int = 1  # number of input files per job
+    shm: int = 0  # shared memory available to all parallel jobs [B] (0 = unknown)
+    jobs: int = 1  # number of parallel jobs
+
+
+class ConfigError(ValueError):
+    """Invalid database, configuration or input of the command generation"""
+
 
 def eprint(*args, **kwargs):
     """Print to stderr."""
@@ -46,7 +115,7 @@ def join_strings(obj) -> str:
     elif isinstance(obj, list):
         return " ".join(obj)
     else:
-        msg_fatal("Cannot convert %s into a string" % type(obj))
+        raise ConfigError("Cannot convert %s into a string" % type(obj))
         return ""
 
 
@@ -57,7 +126,7 @@ def join_to_list(obj, list_out: list):
     elif isinstance(obj, list):
         list_out += obj
     else:
-        msg_fatal("Cannot convert %s into a string" % type(obj))
+        raise ConfigError("Cannot convert %s into a string" % type(obj))
 
 
 def healthy_structure(dic_full: dict):
@@ -106,81 +175,453 @@ def healthy_structure(dic_full: dict):
     return True
 
 
-def activate_workflow(wf: str, dic_wf: dict, mc=False, level=0, debug=False):
-    """Activate a workflows and its dependencies."""
-    if debug:
-        eprint((level + 1) * "  " + wf)
-    if wf in dic_wf:
-        dic_wf_single = dic_wf[wf]
-        # Deactivate workflow if it needs MC and input is not MC.
+def get_dir_cache() -> str:
+    """Get the default directory for cached files."""
+    dir_cache_main = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(dir_cache_main, "run3analysisvalidation", "make_command_o2")
+
+
+def load_database(path_file_database: str, dir_cache="", debug=False) -> dict:
+    """Load and validate the database.
+
+    If a cache directory is provided, the validated database is stored in a binary cache file of the database path
+    together with the hash of the database content and of the parser version and it is loaded from there next time
+    the same content is requested. The cache file is overwritten when the content changes.
+    Cache files unused for more than CACHE_AGE_MAX days are deleted.
+    """
+    try:
+        with open(path_file_database, "rb") as file_database:
+            content = file_database.read()
+    except IOError as err:
+        raise ConfigError("Failed to open file " + path_file_database) from err
+    path_file_cache = ""
+    key = ""
+    if dir_cache:
+        hasher = hashlib.sha256(content)
+        hasher.update(("%d %s" % (CACHE_VERSION, yaml.__version__)).encode())
+        key = hasher.hexdigest()
+        name_cache = hashlib.sha256(os.path.realpath(path_file_database).encode()).hexdigest()
+        path_file_cache = os.path.join(dir_cache, name_cache + ".pickle")
+        try:
+            with open(path_file_cache, "rb") as file_cache:
+                key_cached, dic_in = pickle.load(file_cache)  # nosec B301
+            if key_cached == key:
+                os.utime(path_file_cache)  # Mark as recently used.
+                if debug:
+                    eprint("Loaded database from cache: " + path_file_cache)
+                return dic_in
+        except (IOError, pickle.UnpicklingError, EOFError, ValueError, TypeError):
+            pass
+    dic_in = yaml.safe_load(content)
+    # Check valid structure of the input database.
+    if not healthy_structure(dic_in):
+        raise ConfigError("Bad structure!")
+    if path_file_cache:
+        # Write into a temporary file first to avoid conflicts with other processes.
+        path_file_tmp = "%s.%d.tmp" % (path_file_cache, os.getpid())
+        try:
+            os.makedirs(dir_cache, exist_ok=True)
+            with open(path_file_tmp, "wb") as file_cache:
+                pickle.dump((key, dic_in), file_cache, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path_file_tmp, path_file_cache)
+            if debug:
+                eprint("Stored database in cache: " + path_file_cache)
+        except OSError:
+            msg_warn("Failed to store database in cache " + path_file_cache)
+        prune_cache(dir_cache)
+    return dic_in
+
+
+def prune_cache(dir_cache: str):
+    """Delete cached databases unused for more than CACHE_AGE_MAX days."""
+    time_min = time.time() - CACHE_AGE_MAX * 86400
+    for name in os.listdir(dir_cache) if os.path.isdir(dir_cache) else []:
+        path = os.path.join(dir_cache, name)
+        try:
+            if name.endswith((".pickle", ".tmp")) and os.path.getmtime(path) < time_min:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def get_dependencies(dic_wf_single: dict) -> List[str]:
+    """Get the list of direct dependencies of a workflow."""
+    list_dep: List[str] = []
+    if "dependencies" in dic_wf_single:
+        join_to_list(dic_wf_single["dependencies"], list_dep)
+    return list_dep
+
+
+def resolve_workflows(list_wf: List[str], dic_wf: dict, mc=False, debug=False, exclude=None, replace=None) -> List[str]:
+    """Resolve workflows and all their dependencies.
+
+    Returns the list of workflows in a deterministic topological order with dependencies before their dependents.
+    Each workflow is resolved only once. Dependency cycles are fatal.
+    Excluded workflows (and their dependencies needed only by them) are considered as already provided.
+    Workflows in the replace dictionary are replaced with their values wherever they appear.
+    """
+    list_resolved: List[str] = []  # resolved workflows in topological order
+    set_resolved = set()  # resolved workflows for fast look-up
+    chain: List[str] = []  # current dependency chain, used to detect cycles
+
+    def resolve(wf: str, level: int):
+        if replace and wf in replace:
+            wf = replace[wf]
+        if debug:
+            eprint((level + 1) * "  " + wf + (" (resolved)" if wf in set_resolved else ""))
+        if wf in set_resolved or (exclude and wf in exclude):
+            return
+        if wf in chain:
+            raise ConfigError("Dependency cycle detected: %s" % " -> ".join(chain[chain.index(wf) :] + [wf]))
+        if wf in dic_wf:
+            dic_wf_single = dic_wf[wf]
+        else:
+            msg_warn("Adding an unknown workflow %s" % wf)
+            dic_wf_single = {}
+        # Skip workflow if it needs MC and input is not MC.
         if "requires_mc" in dic_wf_single and dic_wf_single["requires_mc"] and not mc:
             msg_warn("Deactivated %s because of non-MC input" % wf)
             # Throw error if this is a dependency.
             if level > 0:
-                msg_fatal("Workflows requiring this dependency would fail!")
-            dic_wf_single["activate"] = False
+                raise ConfigError("Workflows requiring this dependency would fail!")
             return
-        # Activate.
-        if "activate" not in dic_wf_single or not dic_wf_single["activate"]:
-            dic_wf_single["activate"] = True
-        # Activate dependencies recursively.
-        if "dependencies" in dic_wf_single:
-            list_dep: List[str] = []
-            join_to_list(dic_wf_single["dependencies"], list_dep)
-            for wf_dep in list_dep:
-                activate_workflow(wf_dep, dic_wf, mc, level + 1, debug)
-    else:
-        # Add in the dictionary if not present.
-        msg_warn("Adding an unknown workflow %s" % wf)
-        dic_wf[wf] = {"activate": True}
+        # Resolve dependencies first.
+        chain.append(wf)
+        for wf_dep in get_dependencies(dic_wf_single):
+            resolve(wf_dep, level + 1)
+        chain.pop()
+        set_resolved.add(wf)
+        list_resolved.append(wf)
+
+    for wf in list_wf:
+        resolve(wf, 0)
+    return list_resolved
+
+
+def get_tables(list_wf: List[str], dic_wf: dict, mc=False, key="tables") -> List[str]:
+    """Get the list of all tables of given workflows.
+
+    key: "tables" for produced tables, "consumes" for consumed tables
+    """
+    tables: List[str] = []
+    for wf in list_wf:
+        dic_wf_single = dic_wf.get(wf, {})
+        if key not in dic_wf_single:
+            continue
+        tab_wf = dic_wf_single[key]
+        if isinstance(tab_wf, (str, list)):
+            join_to_list(tab_wf, tables)
+        elif isinstance(tab_wf, dict):
+            if "default" in tab_wf:
+                join_to_list(tab_wf["default"], tables)
+            if not mc and "real" in tab_wf:
+                join_to_list(tab_wf["real"], tables)
+            if mc and "mc" in tab_wf:
+                join_to_list(tab_wf["mc"], tables)
+        else:
+            raise ConfigError('"%s" in %s must be str, list or dict, is %s' % (key, wf, type(tab_wf)))
+    return tables
 
 
-def main():
-    """Main function"""
-    parser = argparse.ArgumentParser(
-        description="Generates full O2 command based on a YAML " "database of workflows and options."
-    )
-    parser.add_argument("database", help="database with workflows and options")
-    parser.add_argument("-w", "--workflows", type=str, help="explicitly requested workflows")
-    parser.add_argument("--mc", action="store_true", help="Monte Carlo mode")
-    parser.add_argument("-t", "--tables", action="store_true", help="save table into trees")
-    parser.add_argument("-g", "--graph", action="store_true", help="make topology graph")
-    parser.add_argument("-d", "--debug", action="store_true", help="print debugging info")
-    args = parser.parse_args()
-    path_file_database = args.database
-    debug = args.debug
-    workflows_add = args.workflows.split() if args.workflows else ""
-    mc_mode = args.mc
-    save_tables = args.tables
-    make_graph = args.graph
+def get_tables_output(list_wf: List[str], dic_wf: dict, mc=False, tables_keep=None, debug=False) -> List[str]:
+    """Get the minimal list of tables to be saved in the output trees.
 
-    # Open database input file.
+    Tables produced by the workflows are saved only if they are not consumed by any of the workflows
+    (i.e. they are terminal outputs) or if they are explicitly requested in tables_keep.
+    Tables are matched by their names without version.
+    """
+
+    def name(table: str) -> str:
+        return table.split("/")[0]
+
+    tables_produced = get_tables(list_wf, dic_wf, mc)
+    names_consumed = {name(t) for t in get_tables(list_wf, dic_wf, mc, "consumes")}
+    names_keep = {name(t) for t in tables_keep} if tables_keep else set()
+    tables = [t for t in tables_produced if name(t) not in names_consumed or name(t) in names_keep]
+    # Add explicitly requested tables not produced by the workflows.
+    names_produced = {name(t) for t in tables_produced}
+    if tables_keep:
+        tables += [t for t in tables_keep if name(t) not in names_produced]
     if debug:
-        eprint("Input database: " + path_file_database)
+        tables_dropped = [t for t in tables_produced if t not in tables]
+        if tables_dropped:
+            eprint("\nIntermediate tables not saved:")
+            eprint("\n".join("  " + t for t in tables_dropped))
+    # Remove duplicities.
+    return list(dict.fromkeys(tables))
+
+
+def get_cost(wf: str, dic_wf_single: dict) -> float:
+    """Get the relative cost of the main device of a workflow (1 by default)."""
+    if "cost" not in dic_wf_single:
+        return 1.0
+    cost = dic_wf_single["cost"]
+    if not isinstance(cost, (int, float)) or isinstance(cost, bool) or cost <= 0:
+        raise ConfigError('"cost" in %s must be a positive number, is %s' % (wf, cost))
+    return float(cost)
+
+
+def get_memory_hint(wf: str, dic_wf_single: dict) -> float:
+    """Get the size of the tables produced by a workflow relative to the size of the input data."""
+    if "memory" not in dic_wf_single:
+        return MEMORY_DEFAULT
+    memory = dic_wf_single["memory"]
+    if not isinstance(memory, (int, float)) or isinstance(memory, bool) or memory < 0:
+        raise ConfigError('"memory" in %s must be a non-negative number, is %s' % (wf, memory))
+    return float(memory)
+
+
+def get_input_sizes(path_list: str) -> List[int]:
+    """Get the sizes of the input files in a list (from the info file of the catalogue if present).
+
+    Files that do not exist (yet) are skipped.
+    """
+    sizes_info = {}
+    path_info = path_list.replace(".txt", "_info.txt")
+    if path_info != path_list and os.path.isfile(path_info):
+        with open(path_info, "r") as file_info:
+            for line in file_info:
+                parts = line.split()
+                if len(parts) >= 2:
+                    sizes_info[parts[0]] = int(parts[1])
+    sizes = []
     try:
-        with open(path_file_database, "r") as file_database:
-            dic_in = yaml.safe_load(file_database)
-    except IOError:
-        msg_fatal("Failed to open file " + path_file_database)
+        with open(path_list, "r") as file_list:
+            paths = [line.strip() for line in file_list if line.strip()]
+    except IOError as err:
+        raise ConfigError("Failed to open file " + path_list) from err
+    for path in paths:
+        if path in sizes_info:
+            sizes.append(sizes_info[path])
+        elif os.path.isfile(path):
+            sizes.append(os.path.getsize(path))
+    return sizes
+
+
+def get_memory_settings(list_wf: List[str], dic_wf: dict, resources: Resources, cores=0, debug=False) -> dict:
+    """Derive the DPL memory settings and the number of AOD readers of a job.
+
+    Readers get a share of the cores in proportion to their cost with respect to the cost hints of the workflows
+    and there are not more readers than input files.
+    The AOD memory rate limit keeps a fraction of the largest input file in flight per reader.
+    The shared memory segment holds the AOD data in flight and the tables produced from it by all workflows
+    (memory hints) with a safety factor.
+    If the segment exceeds the fair share of the available shared memory per parallel job, the rate limit is lowered
+    to fit (not below its minimum) rather than running fewer jobs in parallel.
+    """
+    reasons: List[str] = []
+    n_readers = 1
+    if cores > 0:
+        cost_total = sum(get_cost(wf, dic_wf.get(wf, {})) for wf in list_wf)
+        n_readers = int(cores * COST_READER / (cost_total + COST_READER))
+        reasons.append(
+            "readers: %d cores shared by %d workflows (total cost %g) and readers (cost %g)"
+            % (cores, len(list_wf), cost_total, COST_READER)
+        )
+    n_readers = max(1, min(n_readers, resources.n_files))
+    if resources.size_file > 0:
+        rate = n_readers * FRACTION_IN_FLIGHT * resources.size_file
+        rate = min(RATE_LIMIT_MAX, max(RATE_LIMIT_MIN, rate))
+        reasons.append(
+            "rate limit: %d readers x %g of the largest input file (%.2f GB), limited to [%.2f, %.2f] GB"
+            % (n_readers, FRACTION_IN_FLIGHT, resources.size_file / 1e9, RATE_LIMIT_MIN / 1e9, RATE_LIMIT_MAX / 1e9)
+        )
+    else:
+        rate = RATE_LIMIT_DEFAULT
+        reasons.append("rate limit: default (input size unknown)")
+    memory_total = sum(get_memory_hint(wf, dic_wf.get(wf, {})) for wf in list_wf)
+    factor = SHM_OVERHEAD * (1 + memory_total)
+    reasons.append(
+        "shared memory: %.2f GB + %g x rate limit x (1 + %g of tables of %d workflows)"
+        % (SHM_BASE / 1e9, SHM_OVERHEAD, memory_total, len(list_wf))
+    )
+    if resources.shm > 0:
+        shm_share = resources.shm / max(1, resources.jobs)
+        if SHM_BASE + factor * rate > shm_share:
+            rate_fit = max(RATE_LIMIT_MIN, (shm_share - SHM_BASE) / factor)
+            reasons.append(
+                "rate limit lowered from %.2f GB to %.2f GB to fit the shared memory of a job (%.2f GB / %d jobs)"
+                % (rate / 1e9, rate_fit / 1e9, resources.shm / 1e9, resources.jobs)
+            )
+            rate = rate_fit
+            if SHM_BASE + factor * rate > shm_share:
+                msg_warn(
+                    "Shared memory needed by a job exceeds %.2f GB. Fewer than %d jobs will run in parallel."
+                    % (shm_share / 1e9, resources.jobs)
+                )
+    shm = max(SHM_MIN, SHM_BASE + factor * rate)
+    # Round to MB.
+    settings = {
+        "aod-memory-rate-limit": int(rate / 1e6) * 1000000,
+        "shm-segment-size": int(shm / 1e6) * 1000000,
+        "readers": n_readers,
+    }
+    if debug:
+        eprint("\nDPL memory settings:")
+        eprint("\n".join("  " + r for r in reasons))
+        eprint("\n".join("  --%s %d" % (opt, value) for opt, value in settings.items()))
+    return settings
+
+
+def get_replicas_auto(list_wf: List[str], dic_wf: dict, cores: int) -> dict:
+    """Derive numbers of replicas of the main devices of workflows from their cost hints.
+
+    Each workflow with a cost hint gets a share of the available cores proportional to its cost
+    with respect to the total cost of all workflows.
+    """
+    dic_replicas: dict = {}
+    if cores < 1:
+        return dic_replicas
+    cost_total = sum(get_cost(wf, dic_wf.get(wf, {})) for wf in list_wf)
+    for wf in list_wf:
+        dic_wf_single = dic_wf.get(wf, {})
+        if "cost" not in dic_wf_single:
+            continue
+        replicas = int(cores * get_cost(wf, dic_wf_single) / cost_total)
+        if replicas > 1:
+            dic_replicas[wf] = replicas
+    return dic_replicas
+
+
+def get_pipeline(wf: str, dic_wf_single: dict, exec_wf: str, replicas_auto=0) -> str:
+    """Get the DPL pipeline specification (device:replicas) of a workflow.
+
+    Explicit "pipeline" in the database takes precedence over the automatic number of replicas.
+    Integer number of replicas applies to the main device, named as the executable without the "o2-analysis-" prefix.
+    """
+    device_main = exec_wf.replace("o2-analysis-", "", 1)
+    dic_pipe: dict = {}
+    if "pipeline" in dic_wf_single:
+        pipe_wf = dic_wf_single["pipeline"]
+        if isinstance(pipe_wf, int) and not isinstance(pipe_wf, bool):
+            dic_pipe[device_main] = pipe_wf
+        elif isinstance(pipe_wf, dict):
+            dic_pipe = pipe_wf
+        else:
+            raise ConfigError('"pipeline" in %s must be int or dict, is %s' % (wf, type(pipe_wf)))
+    elif replicas_auto > 1:
+        dic_pipe[device_main] = replicas_auto
+    for device, replicas in dic_pipe.items():
+        if not isinstance(replicas, int) or isinstance(replicas, bool) or replicas < 1:
+            raise ConfigError("Number of replicas of %s in %s must be a positive int, is %s" % (device, wf, replicas))
+    return ",".join("%s:%d" % (device, replicas) for device, replicas in dic_pipe.items() if replicas > 1)
+
+
+def get_workflow_command(wf: str, dic_wf_single: dict, opt_local: str, mc=False, replicas_auto=0) -> WorkflowCommand:
+    """Compose the command of a single workflow."""
+    # Determine the workflow executable.
+    if "executable" in dic_wf_single:
+        exec_wf = dic_wf_single["executable"]
+        if not isinstance(exec_wf, str):
+            raise ConfigError('"executable" in %s must be str, is %s' % (wf, type(exec_wf)))
+    else:
+        exec_wf = wf
+    # Process options.
+    list_opt: List[str] = []
+    if "options" in dic_wf_single:
+        opt_wf = dic_wf_single["options"]
+        if isinstance(opt_wf, (str, list)):
+            list_opt.append(join_strings(opt_wf))
+        elif isinstance(opt_wf, dict):
+            if "default" in opt_wf:
+                list_opt.append(join_strings(opt_wf["default"]))
+            if not mc and "real" in opt_wf:
+                list_opt.append(join_strings(opt_wf["real"]))
+            if mc and "mc" in opt_wf:
+                list_opt.append(join_strings(opt_wf["mc"]))
+        else:
+            raise ConfigError('"options" in %s must be str, list or dict, is %s' % (wf, type(opt_wf)))
+    # Run heavy devices in parallel replicas.
+    pipeline = get_pipeline(wf, dic_wf_single, exec_wf, replicas_auto)
+    if pipeline:
+        list_opt.append("--pipeline " + pipeline)
+    if opt_local:
+        list_opt.append(opt_local)
+    return WorkflowCommand(wf, exec_wf, " ".join(list_opt))
+
+
+def get_stage_workflows(
+    list_wf: List[str], dic_wf: dict, cut: List[str], stage: str, mc=False, debug=False
+) -> List[str]:
+    """Get workflows of a stage of the topology cut at given workflows.
+
+    The upstream stage consists of the cut workflows and their dependencies.
+    The downstream stage consists of the remaining workflows. Workflows depending directly on the cut workflows
+    are replaced by their "_derived" variants, if present, which read the tables from the derived AO2D.
+    """
+    for wf in cut:
+        if wf not in list_wf:
+            raise ConfigError("Cut workflow %s is not activated." % wf)
+    list_wf_up = resolve_workflows(cut, dic_wf, mc)
+    if stage == "upstream":
+        return list_wf_up
+    list_wf_down = [wf for wf in list_wf if wf not in list_wf_up]
+    # Find replacements of workflows that depend directly on the cut workflows.
+    dic_replace = {}
+    for wf in list_wf:
+        if not set(get_dependencies(dic_wf.get(wf, {}))) & set(cut):
+            continue
+        wf_derived = wf + "_derived"
+        if wf_derived in dic_wf:
+            if debug:
+                eprint("Replacing %s with %s" % (wf, wf_derived))
+            dic_replace[wf] = wf_derived
+        else:
+            msg_warn("No derived variant of %s found. Using it without its cut dependencies." % wf)
+    # Resolve the dependencies again without the cut workflows.
+    return resolve_workflows(list_wf_down, dic_wf, mc, debug, cut, dic_replace)
 
-    # Check valid structure of the input database.
-    if not healthy_structure(dic_in):
-        msg_fatal("Bad structure!")
 
-    if mc_mode:
-        msg_warn("MC mode is on.")
-    if save_tables:
-        msg_warn("Tables will be saved in trees.")
+def get_config_hash(command: Command, path_file_json: str, executables_exclude: List[str]) -> str:
+    """Get the hash of the command and of its JSON configuration.
 
+    JSON sections of devices that belong to the excluded executables (matched by the name prefix) are ignored.
+    """
+    try:
+        with open(path_file_json, "r") as file_json:
+            dic_json = json.load(file_json)
+    except (IOError, ValueError) as err:
+        raise ConfigError("Failed to read JSON file " + path_file_json) from err
+    prefixes = tuple(exe.replace("o2-analysis-", "", 1) for exe in executables_exclude)
+    dic_json = {key: value for key, value in dic_json.items() if not key.startswith(prefixes)}
+    hasher = hashlib.sha256(str(command).encode())
+    hasher.update(json.dumps(dic_json, sort_keys=True).encode())
+    return hasher.hexdigest()
+
+
+def build_command(
+    database: dict,
+    workflows: Iterable[str],
+    mc=False,
+    tables=False,
+    debug=False,
+    cores=0,
+    tables_keep=None,
+    stage="",
+    cut=None,
+    resources: Optional[Resources] = None,
+) -> Command:
+    """Build the full O2 command.
+
+    database: validated database (see load_database)
+    workflows: explicitly requested workflows (in addition to the ones activated in the database)
+    mc: Monte Carlo mode
+    tables: save tables into trees
+    cores: number of cores to distribute among replicas of workflows with cost hints (0 to disable)
+    tables_keep: tables to be saved even if they are consumed by other workflows
+    stage: stage of the topology cut at the cut workflows ("upstream", "downstream", "" for the full topology)
+    cut: workflows at which the topology is cut
+    resources: input and resources of a job to derive the DPL memory settings from (None to keep the database options)
+    """
     # Get workflow-independent options.
-    dic_opt = dic_in["options"]
+    dic_opt = database["options"]
     # options that appear only once
     opt_global = join_strings(dic_opt["global"])
     # options that appear for each workflow
     opt_local = join_strings(dic_opt["local"])
 
     # Get the workflow database.
-    dic_wf = dic_in["workflows"]
+    dic_wf = database["workflows"]
 
     # Get list of primary workflows to run.
     # already activated in the database
@@ -188,127 +629,365 @@ def main():
     if debug and list_wf_activated:
         eprint("\nWorkflows activated in the database:")
         eprint("\n".join("  " + wf for wf in list_wf_activated))
-    # requested on command line
-    if workflows_add:
+    # requested explicitly
+    workflows = list(workflows)
+    if workflows:
         if debug:
             eprint("\nWorkflows specified on command line:")
-            eprint("\n".join("  " + wf for wf in workflows_add))
-        list_wf_activated += workflows_add
+            eprint("\n".join("  " + wf for wf in workflows))
+        list_wf_activated += workflows
     # Remove duplicities.
     list_wf_activated = list(dict.fromkeys(list_wf_activated))
     if debug:
         eprint("\nPrimary workflows to run:")
         eprint("\n".join("  " + wf for wf in list_wf_activated))
 
-    # Activate all needed workflows recursively.
+    # Resolve all needed workflows.
     if debug:
-        eprint("\nActivating workflows")
-    for wf in list_wf_activated:
-        activate_workflow(wf, dic_wf, mc_mode, 0, debug)
+        eprint("\nResolving workflows")
+    list_wf_resolved = resolve_workflows(list_wf_activated, dic_wf, mc, debug)
+
+    # Cut the topology and keep only the workflows of the requested stage.
+    if stage:
+        if stage not in STAGES:
+            raise ConfigError("Unknown stage %s" % stage)
+        if not cut:
+            raise ConfigError("No workflows to cut at.")
+        if debug:
+            eprint("\nSelecting %s stage" % stage)
+        list_wf_resolved = get_stage_workflows(list_wf_resolved, dic_wf, cut, stage, mc, debug)
 
     # Get the list of tables and add the option to the local options.
-    if save_tables:
-        tables = []  # list of all tables of activated workflows
-        for wf, dic_wf_single in dic_wf.items():
-            if "activate" not in dic_wf_single or not dic_wf_single["activate"]:
-                continue
-            if "tables" not in dic_wf_single:
-                continue
-            tab_wf = dic_wf_single["tables"]
-            if isinstance(tab_wf, (str, list)):
-                join_to_list(tab_wf, tables)
-            elif isinstance(tab_wf, dict):
-                if "default" in tab_wf:
-                    join_to_list(tab_wf["default"], tables)
-                if not mc_mode and "real" in tab_wf:
-                    join_to_list(tab_wf["real"], tables)
-                if mc_mode and "mc" in tab_wf:
-                    join_to_list(tab_wf["mc"], tables)
-            else:
-                msg_fatal('"tables" in %s must be str, list or dict, is %s' % (wf, type(tab_wf)))
+    list_tables: List[str] = []
+    if stage == "upstream":
+        # Save all tables of the cut workflows in the derived AO2D.
+        list_tables = list(dict.fromkeys(get_tables(cut, dic_wf, mc)))
+        string_tables = ",".join("AOD/" + t + ("" if "/" in t else "/0") for t in list_tables)
+        if not string_tables:
+            raise ConfigError("Cut workflows produce no tables.")
+        opt_local += " --aod-writer-keep " + string_tables + " --aod-writer-resfile " + FILE_DERIVED
+    elif tables:
+        list_tables = get_tables_output(list_wf_resolved, dic_wf, mc, tables_keep, debug)
         str_before = "AOD/"
         str_after = "/0"
-        string_tables = ",".join(str_before + t + ("" if "/" in t else str_after) for t in tables)
+        string_tables = ",".join(str_before + t + ("" if "/" in t else str_after) for t in list_tables)
         if string_tables:
             opt_local += " --aod-writer-keep " + string_tables
 
+    # Get the numbers of replicas derived from the cost hints.
+    dic_replicas = get_replicas_auto(list_wf_resolved, dic_wf, cores)
+    if debug and dic_replicas:
+        eprint("\nReplicas derived from cost hints for %d cores:" % cores)
+        eprint("\n".join("  %s: %d" % (wf, n) for wf, n in dic_replicas.items()))
+
+    # Replace the DPL memory settings with the ones derived for the job.
+    if resources:
+        dic_memory = get_memory_settings(list_wf_resolved, dic_wf, resources, cores, debug)
+        pattern_memory = r"\s*--(%s)(?:\s+|=)(\S+)" % "|".join(OPTIONS_MEMORY)
+        for opt, value in re.findall(pattern_memory, opt_local):
+            if value != str(dic_memory[opt]):
+                msg_warn(
+                    "Option --%s %s of the database replaced with the tuned value %d." % (opt, value, dic_memory[opt])
+                )
+        opt_local = re.sub(pattern_memory, "", opt_local)
+        opt_local += "".join(" --%s %d" % (opt, value) for opt, value in dic_memory.items())
+
     # Compose the full command with all options.
-    command = ""
-    eprint("\nActivated workflows:")
-    for wf, dic_wf_single in dic_wf.items():
-        if "activate" not in dic_wf_single or not dic_wf_single["activate"]:
-            continue
-        msg_bold("  " + wf)
-        # Determine the workflow executable.
-        if "executable" in dic_wf_single:
-            exec_wf = dic_wf_single["executable"]
-            if not isinstance(exec_wf, str):
-                msg_fatal('"executable" in %s must be str, is %s' % (wf, type(exec_wf)))
-            string_wf = exec_wf
-        else:
-            string_wf = wf
+    command = Command(options_global=opt_global, tables=list_tables)
+    for wf in list_wf_resolved:
+        wf_command = get_workflow_command(wf, dic_wf.get(wf, {}), opt_local, mc, dic_replicas.get(wf, 0))
         # Detect duplicate workflows.
-        if string_wf + " " in command:
-            msg_warn("Workflow %s is already present." % string_wf)
-        # Process options.
-        if "options" in dic_wf_single:
-            opt_wf = dic_wf_single["options"]
-            if isinstance(opt_wf, (str, list)):
-                string_wf += " " + join_strings(opt_wf)
-            elif isinstance(opt_wf, dict):
-                if "default" in opt_wf:
-                    string_wf += " " + join_strings(opt_wf["default"])
-                if not mc_mode and "real" in opt_wf:
-                    string_wf += " " + join_strings(opt_wf["real"])
-                if mc_mode and "mc" in opt_wf:
-                    string_wf += " " + join_strings(opt_wf["mc"])
-            else:
-                msg_fatal('"options" in %s must be str, list or dict, is %s' % (wf, type(opt_wf)))
-        if opt_local:
-            string_wf += " " + opt_local
-        command += "| \\\n" + string_wf + " "
-    if not command:
-        msg_fatal("Nothing to do!")
-    # Remove the leading "| \\\n".
-    command = command[4:]
-    # Append global options.
-    if opt_global:
-        command += " " + opt_global
+        if any(wf_command.executable == w.executable for w in command.workflows):
+            msg_warn("Workflow %s is already present." % wf_command.executable)
+        command.workflows.append(wf_command)
+    return command
+
+
+def build_commands(
+    database: dict, variants: Iterable[Tuple[Iterable[str], bool, bool]], debug=False, **kwargs
+) -> List[Command]:
+    """Build O2 commands for many variants (workflows, mc, tables) of the same database.
+
+    Keyword arguments are passed to build_command.
+    """
+    return [build_command(database, workflows, mc, tables, debug, **kwargs) for workflows, mc, tables in variants]
+
+
+def load_metrics(path_file_metrics: str) -> dict:
+    """Load resource metrics per workflow (see collect_metrics.py)."""
+    try:
+        with open(path_file_metrics, "r") as file_metrics:
+            dic_metrics = json.load(file_metrics)
+    except (IOError, ValueError) as err:
+        raise ConfigError("Failed to read metrics file " + path_file_metrics) from err
+    if not isinstance(dic_metrics, dict) or not isinstance(dic_metrics.get("workflows"), dict):
+        raise ConfigError("No metrics of workflows in " + path_file_metrics)
+    return dic_metrics["workflows"]
+
+
+def get_critical_path(command: Command, dic_wf: dict, costs: dict) -> List[str]:
+    """Get the chain of dependent workflows with the largest total cost.
+
+    Workflows of the command are in topological order so each workflow is processed after its dependencies.
+    """
+    dic_total: dict = {}  # largest total cost of a chain ending at the workflow
+    dic_prev: dict = {}  # previous workflow in this chain
+    for wf_command in command.workflows:
+        wf = wf_command.name
+        deps = [d for d in get_dependencies(dic_wf.get(wf, {})) if d in dic_total]
+        wf_prev = max(deps, key=lambda d: dic_total[d], default="")
+        dic_total[wf] = costs[wf] + (dic_total[wf_prev] if wf_prev else 0)
+        dic_prev[wf] = wf_prev
+    path: List[str] = []
+    wf = max(dic_total, key=lambda w: dic_total[w], default="")
+    while wf:
+        path.insert(0, wf)
+        wf = dic_prev[wf]
+    return path
+
+
+def make_graph(command: Command, dic_wf: dict, path_file_database: str, path_file_metrics=""):
+    """Produce topology graph.
+
+    Nodes are coloured by the cost of the workflows and the critical path (chain of dependent workflows
+    with the largest total cost) is highlighted.
+    The cost is the CPU time per job from the metrics file, if provided, or the cost hint of the database.
+    An annotated graph is written in JSON too.
+    """
+    basename, _ = os.path.splitext(path_file_database)
+    ext_graph = "pdf"
+    path_file_dot = basename + ".gv"
+    path_file_graph = basename + "." + ext_graph
+    path_file_json = basename + "_graph.json"
+    dic_metrics = load_metrics(path_file_metrics) if path_file_metrics else {}
+    # Get the costs of the workflows.
+    costs = {}
+    metrics = {}
+    for wf_command in command.workflows:
+        wf = wf_command.name
+        if path_file_metrics:
+            metrics[wf] = dic_metrics.get(wf_command.executable.replace("o2-analysis-", "", 1), {})
+            costs[wf] = metrics[wf].get("cpu_s", 0) / max(1, metrics[wf].get("jobs", 1))
+        else:
+            costs[wf] = get_cost(wf, dic_wf.get(wf, {}))
+    cost_max = max(costs.values(), default=0) or 1
+    path_critical = get_critical_path(command, dic_wf, costs)
+    eprint("Making diagram in: %s" % path_file_dot)
+    dot = "digraph {\n"
+    dot += "  edge [dir=back] // inverted arrow direction\n"
+    dot += "  rankdir=BT // bottom to top drawing\n"
+    dot += "  ranksep=2 // vertical node separation\n"
+    dot += '  node [shape=box, style="filled,rounded", fillcolor=papayawhip, fontname=Courier, fontsize=20]\n'
+    nodes = []
+    for wf_command in command.workflows:
+        wf = wf_command.name
+        dic_wf_single = dic_wf.get(wf, {})
+        # Hyphens are not allowed in node names.
+        node_wf = wf.replace("-", "_")
+        # Replace hyphens with line breaks to save horizontal space.
+        label_wf = wf.replace("o2-analysis-", "")
+        label_wf = label_wf.replace("-", "\\n")
+        # Annotate with the cost.
+        if not path_file_metrics:
+            label_wf += "\\n\\ncost %g" % costs[wf]
+        elif metrics[wf]:
+            label_wf += "\\n\\nCPU %.1f s/job\\nRSS %.0f MB\\n%.1f MB/s" % (
+                costs[wf],
+                metrics[wf].get("rss_max_mb", 0),
+                metrics[wf].get("throughput_mb_s", 0),
+            )
+        else:
+            label_wf += "\\n\\nno metrics"
+        # Colour from pale orange (cheap) to red (expensive).
+        ratio = costs[wf] / cost_max
+        attributes = 'label="%s", fillcolor="%.3f %.3f 1.000"' % (label_wf, 0.08 * (1 - ratio), 0.1 + 0.7 * ratio)
+        if wf in path_critical:
+            attributes += ", color=red, penwidth=5"
+        dot += "  %s [%s]\n" % (node_wf, attributes)
+        deps = get_dependencies(dic_wf_single)
+        # The edge to the previous workflow in the critical path
+        i_path = path_critical.index(wf) if wf in path_critical else 0
+        deps_critical = [d for d in deps if i_path > 0 and d == path_critical[i_path - 1]]
+        deps_other = [d for d in deps if d not in deps_critical]
+        if deps_other:
+            dot += "  %s -> {%s}\n" % (node_wf, " ".join(deps_other).replace("-", "_"))
+        for dep in deps_critical:
+            dot += "  %s -> %s [color=red, penwidth=4]\n" % (node_wf, dep.replace("-", "_"))
+        nodes.append(
+            {
+                "name": wf,
+                "executable": wf_command.executable,
+                "dependencies": deps,
+                "cost": costs[wf],
+                "metrics": metrics.get(wf, {}),
+                "critical": wf in path_critical,
+            }
+        )
+    dot += "}\n"
+    dic_graph = {
+        "cost": "CPU time per job [s]" if path_file_metrics else "cost hint",
+        "critical_path": path_critical,
+        "cost_critical": sum(costs[wf] for wf in path_critical),
+        "cost_total": sum(costs.values()),
+        "nodes": nodes,
+    }
+    try:
+        with open(path_file_dot, "w") as file_dot:
+            file_dot.write(dot)
+        with open(path_file_json, "w") as file_json:
+            json.dump(dic_graph, file_json, indent=2)
+    except IOError as err:
+        raise ConfigError("Failed to write the graph files " + path_file_dot + ", " + path_file_json) from err
+    eprint("Annotated graph in JSON: %s" % path_file_json)
+    eprint(
+        "Critical path (cost %g of %g): %s"
+        % (dic_graph["cost_critical"], dic_graph["cost_total"], " -> ".join(path_critical))
+    )
+    eprint("Produce graph with Graphviz: dot -T%s %s -o %s" % (ext_graph, path_file_dot, path_file_graph))
+
+
+def run_batch(database: dict, path_file_batch: str, debug=False, **kwargs):
+    """Print out commands for all variants specified in a YAML batch file as JSON.
+
+    The batch file contains a list of variants with keys: name, workflows (str, list), mc (bool), tables (bool).
+    """
+    try:
+        with open(path_file_batch, "r") as file_batch:
+            list_variants = yaml.safe_load(file_batch)
+    except IOError as err:
+        raise ConfigError("Failed to open file " + path_file_batch) from err
+    if not isinstance(list_variants, list):
+        raise ConfigError("Batch file must contain a list of variants.")
+    names = []
+    variants = []
+    for i, variant in enumerate(list_variants):
+        if not isinstance(variant, dict):
+            raise ConfigError("Variant %d is not a dictionary." % i)
+        workflows: List[str] = []
+        if "workflows" in variant:
+            join_to_list(variant["workflows"], workflows)
+        names.append(str(variant.get("name", i)))
+        variants.append(
+            (" ".join(workflows).split(), bool(variant.get("mc", False)), bool(variant.get("tables", False)))
+        )
+    commands = build_commands(database, variants, debug, **kwargs)
+    print(json.dumps([{"name": name, "command": str(cmd)} for name, cmd in zip(names, commands)], indent=2))
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(
+        description="Generates full O2 command based on a YAML " "database of workflows and options."
+    )
+    parser.add_argument("database", help="database with workflows and options")
+    parser.add_argument("-w", "--workflows", type=str, help="explicitly requested workflows")
+    parser.add_argument("--mc", action="store_true", help="Monte Carlo mode")
+    parser.add_argument("-t", "--tables", action="store_true", help="save table into trees")
+    parser.add_argument("-g", "--graph", action="store_true", help="make topology graph")
+    parser.add_argument(
+        "--metrics", type=str, default="", help="metrics of workflows (see collect_metrics.py) to annotate the graph"
+    )
+    parser.add_argument("-d", "--debug", action="store_true", help="print debugging info")
+    parser.add_argument(
+        "--cache-dir", type=str, default=get_dir_cache(), help="directory for cached databases (default: %(default)s)"
+    )
+    parser.add_argument("--no-cache", action="store_true", help="do not use cached databases")
+    parser.add_argument(
+        "-b", "--batch", type=str, help="YAML file with variants to generate (prints JSON list of commands)"
+    )
+    parser.add_argument(
+        "-p",
+        "--cores",
+        type=int,
+        default=0,
+        help="number of cores to distribute among replicas of workflows with cost hints (0 to disable)",
+    )
+    parser.add_argument(
+        "-k",
+        "--keep-tables",
+        type=str,
+        help="tables (separated by spaces or commas) to be saved even if consumed by other workflows",
+    )
+    parser.add_argument("-s", "--stage", choices=STAGES, help="produce only the given stage of the cut topology")
+    parser.add_argument(
+        "-c", "--cut", type=str, help="workflows (separated by spaces or commas) to cut the topology at"
+    )
+    parser.add_argument("-j", "--json", type=str, help="JSON configuration (to print the upstream configuration hash)")
+    parser.add_argument(
+        "-m", "--tune-memory", action="store_true", help="derive the DPL memory settings and the number of readers"
+    )
+    parser.add_argument("-i", "--input", type=str, help="list of input files (for the memory tuning)")
+    parser.add_argument("--files-per-job", type=int, default=1, help="number of input files per job")
+    parser.add_argument("--jobs", type=int, default=1, help="number of parallel jobs sharing the shared memory")
+    parser.add_argument("--shm", type=float, default=0, help="available shared memory [B] (default: size of /dev/shm)")
+    args = parser.parse_args()
+    try:
+        make_command(args)
+    except ConfigError as err:
+        msg_fatal(str(err))
+
+
+def make_command(args: argparse.Namespace):
+    """Generate the command (or the commands of a batch) requested by the command-line arguments."""
+    path_file_database = args.database
+    debug = args.debug
+    workflows_add = args.workflows.split() if args.workflows else []
+    mc_mode = args.mc
+    save_tables = args.tables
+    dir_cache = "" if args.no_cache else args.cache_dir
+    tables_keep = args.keep_tables.replace(",", " ").split() if args.keep_tables else []
+    stage = args.stage or ""
+    cut = args.cut.replace(",", " ").split() if args.cut else []
+    resources = None
+    if args.tune_memory:
+        sizes = get_input_sizes(args.input) if args.input else []
+        shm = args.shm
+        if shm <= 0:
+            try:
+                stat = os.statvfs("/dev/shm")
+                shm = stat.f_blocks * stat.f_frsize
+            except OSError:
+                shm = 0
+        resources = Resources(max(sizes, default=0), max(1, args.files_per_job), int(shm), max(1, args.jobs))
+    opt_build = {"cores": args.cores, "tables_keep": tables_keep, "stage": stage, "cut": cut, "resources": resources}
+
+    # Open database input file.
+    if debug:
+        eprint("Input database: " + path_file_database)
+    dic_in = load_database(path_file_database, dir_cache, debug)
+
+    # Generate commands for many variants.
+    if args.batch:
+        run_batch(dic_in, args.batch, debug, **opt_build)
+        return
+
+    if mc_mode:
+        msg_warn("MC mode is on.")
+    if save_tables:
+        msg_warn("Tables will be saved in trees.")
+
+    command = build_command(dic_in, workflows_add, mc_mode, save_tables, debug, **opt_build)
+    if not command.workflows:
+        raise ConfigError("Nothing to do!")
+    eprint("\nActivated workflows:")
+    for wf_command in command.workflows:
+        msg_bold("  " + wf_command.name)
+
+    # Print out the configuration hash of the upstream stage to identify reusable derived AO2Ds.
+    if stage == "upstream" and args.json:
+        opt_build["stage"] = "downstream"
+        command_down = build_command(dic_in, workflows_add, mc_mode, save_tables, **opt_build)
+        executables_up = {wf.executable for wf in command.workflows}
+        executables_down = [wf.executable for wf in command_down.workflows if wf.executable not in executables_up]
+        print("# Configuration hash: %s" % get_config_hash(command, args.json, executables_down))
 
     # Print out the command.
     print(command)
 
     # Produce topology graph.
-    if make_graph:
-        basename, _ = os.path.splitext(path_file_database)
-        ext_graph = "pdf"
-        path_file_dot = basename + ".gv"
-        path_file_graph = basename + "." + ext_graph
-        eprint("Making diagram in: %s" % path_file_dot)
-        dot = "digraph {\n"
-        dot += "  edge [dir=back] // inverted arrow direction\n"
-        dot += "  rankdir=BT // bottom to top drawing\n"
-        dot += "  ranksep=2 // vertical node separation\n"
-        dot += '  node [shape=box, style="filled,rounded", fillcolor=papayawhip, fontname=Courier, fontsize=20]\n'
-        for wf, dic_wf_single in dic_wf.items():
-            if "activate" not in dic_wf_single or not dic_wf_single["activate"]:
-                continue
-            # Hyphens are not allowed in node names.
-            node_wf = wf.replace("-", "_")
-            # Replace hyphens with line breaks to save horizontal space.
-            label_wf = wf.replace("o2-analysis-", "")
-            label_wf = label_wf.replace("-", "\\n")
-            dot += '  %s [label="%s"]\n' % (node_wf, label_wf)
-            if "dependencies" in dic_wf_single:
-                nodes_dep = join_strings(dic_wf_single["dependencies"]).replace("-", "_")
-                dot += "  %s -> {%s}\n" % (node_wf, nodes_dep)
-        dot += "}\n"
-        try:
-            with open(path_file_dot, "w") as file_dot:
-                file_dot.write(dot)
-        except IOError:
-            msg_fatal("Failed to open file " + path_file_dot)
-        eprint("Produce graph with Graphviz: dot -T%s %s -o %s" % (ext_graph, path_file_dot, path_file_graph))
+    if args.graph:
+        make_graph(command, dic_in["workflows"], path_file_database, args.metrics)
 
 
-main()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Placement of parallel jobs on CPUs
+
+Each job slot (one running job) gets a disjoint set of the CPUs available to the process.
+Slots are distributed over the NUMA nodes in proportion to their numbers of CPUs
+and the CPUs of each node are split between its slots in contiguous ranges.
+If there are more slots than CPUs, the CPU sets overlap.
+A job is started with the CPU affinity of its slot (inherited by all its processes)
+and with the memory of the NUMA node of the slot preferred (if numactl is available).
+"""
+
+import glob
+import os
+import re
+import shutil
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from utilities import msg_warn
+
+
+def parse_cpu_list(text: str) -> List[int]:
+    """Parse a list of CPUs in the kernel format (e.g. "0-3,8-11")."""
+    cpus = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus += list(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def get_numa_nodes() -> Dict[int, List[int]]:
+    """Get the CPUs available to this process per NUMA node (one node -1 if the topology is unknown)."""
+    cpus_allowed = sorted(os.sched_getaffinity(0))
+    nodes = {}
+    for path in glob.glob("/sys/devices/system/node/node*/cpulist"):
+        match = re.search(r"node(\d+)/cpulist$", path)
+        if not match:
+            continue
+        with open(path, "r") as file:
+            cpus = [cpu for cpu in parse_cpu_list(file.read()) if cpu in cpus_allowed]
+        if cpus:
+            nodes[int(match.group(1))] = cpus
+    if not nodes or sum(len(cpus) for cpus in nodes.values()) != len(cpus_allowed):
+        return {-1: cpus_allowed}
+    return dict(sorted(nodes.items()))
+
+
+@dataclass
+class Slot:
+    """Slot of a running job with its CPUs and usage"""
+
+    index: int  # slot index
+    cpus: List[int]  # CPUs assigned to the slot
+    node: int = -1  # NUMA node (-1 = unknown or not bound)
+    n_cores: float = 0.0  # number of cores available to the slot
+    job: Optional[int] = None  # index of the running job
+    n_jobs: int = 0  # number of finished jobs
+    time_busy: float = 0.0  # total wall time of finished jobs
+    time_cpu: float = 0.0  # total CPU time of finished jobs
+
+
+def make_slots(n_slots: int) -> List[Slot]:
+    """Assign disjoint sets of CPUs to slots, distributed over the NUMA nodes."""
+    nodes = get_numa_nodes()
+    n_cpus = sum(len(cpus) for cpus in nodes.values())
+    if n_slots > n_cpus:
+        msg_warn("More job slots (%d) than CPUs (%d). CPU sets of slots overlap." % (n_slots, n_cpus))
+    # Distribute the slots over the nodes in proportion to their numbers of CPUs (largest remainders).
+    shares = {node: n_slots * len(cpus) / n_cpus for node, cpus in nodes.items()}
+    counts = {node: int(share) for node, share in shares.items()}
+    for node in sorted(shares, key=lambda n: counts[n] - shares[n])[: n_slots - sum(counts.values())]:
+        counts[node] += 1
+    slots = []
+    for node, cpus in nodes.items():
+        n_node = counts[node]
+        for i_slot in range(n_node):
+            cpus_slot = cpus[i_slot * len(cpus) // n_node : (i_slot + 1) * len(cpus) // n_node]
+            cpus_slot = cpus_slot or [cpus[i_slot % len(cpus)]]
+            slots.append(Slot(len(slots), cpus_slot, node, n_cores=len(cpus_slot)))
+    return slots
+
+
+def make_slots_shared(n_slots: int) -> List[Slot]:
+    """Make slots sharing all available CPUs (no placement)."""
+    cpus = sorted(os.sched_getaffinity(0))
+    return [Slot(i, cpus, n_cores=len(cpus) / n_slots) for i in range(n_slots)]
+
+
+def get_launcher(slot: Slot) -> List[str]:
+    """Get the command prefix that prefers the memory of the NUMA node of a slot."""
+    if slot.node < 0 or not shutil.which("numactl"):
+        return []
+    return ["numactl", "--preferred=%d" % slot.node]
+
+
+def format_cpus(cpus: List[int]) -> str:
+    """Format a list of CPUs in the kernel format."""
+    ranges: List[List[int]] = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(a) if a == b else "%d-%d" % (a, b) for a, b in ranges)
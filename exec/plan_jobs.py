@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+"""
+Splits input files into jobs with balanced load.
+Files are packed into jobs by their weight (number of events if provided, size otherwise)
+(Sizes and numbers of events can be taken from the info file written by file_catalogue.py.)
+using the longest-processing-time-first rule, while respecting the maximum number of files per job.
+If the number of parallel slots is given, the number of jobs is a multiple of it (if possible) so that all slots
+stay busy. Otherwise, the number of jobs is given only by the maximum number of files per job.
+Jobs are numbered in the order of decreasing weight so that the heaviest jobs start first.
+Input files that are still being produced by other jobs (pipelined steps) are split in the order of the list
+into consecutive jobs of equal numbers of files so that the first jobs can start as soon as possible.
+For each job, a directory <output directory>/<job index> with the list of its input files is created.
+The number of jobs is printed to stdout.
+"""
+
+import argparse
+import heapq
+import math
+import os
+from typing import Dict, List, Tuple
+
+from utilities import check_file, eprint, msg_fatal, msg_warn
+
+
+def read_list(path: str, check: bool = True) -> List[str]:
+    """Read a list of input files, one per line. Return their real paths."""
+    check_file(path)
+    with open(path, "r") as file:
+        files = [line.strip() for line in file if line.strip()]
+    for path_file in files if check else []:
+        check_file(path_file)
+    return [os.path.realpath(path_file) for path_file in files]
+
+
+def read_events(path: str) -> Dict[str, int]:
+    """Read numbers of events from a file with lines "<path> <number of events>"."""
+    check_file(path)
+    events = {}
+    with open(path, "r") as file:
+        for line in file:
+            words = line.split()
+            if len(words) < 2:
+                continue
+            try:
+                events[os.path.realpath(words[0])] = int(words[1])
+            except ValueError:
+                msg_warn("Invalid number of events in line: %s" % line.strip())
+    return events
+
+
+def read_info(path: str) -> Tuple[Dict[str, int], Dict[str, int]]:
+    """Read sizes and numbers of events from a file with lines "<path> <size> <number of events or -1>"."""
+    check_file(path)
+    sizes, events = {}, {}
+    with open(path, "r") as file:
+        for line in file:
+            words = line.split()
+            if len(words) < 3:
+                continue
+            path_file = os.path.realpath(words[0])
+            sizes[path_file] = int(words[1])
+            if int(words[2]) >= 0:
+                events[path_file] = int(words[2])
+    return sizes, events
+
+
+def get_weights(files: List[str], events=None, sizes=None) -> List[int]:
+    """Get weights of files: numbers of events if known for all files, sizes otherwise."""
+    if events:
+        weights = [events.get(f, -1) for f in files]
+        if min(weights) >= 0:
+            return weights
+        msg_warn("Numbers of events missing for some files. Using file sizes instead.")
+    sizes = sizes or {}
+    return [sizes[f] if f in sizes else os.path.getsize(f) for f in files]
+
+
+def get_n_jobs(n_files: int, n_files_max: int, n_slots: int) -> int:
+    """Get the number of jobs needed to respect the maximum number of files per job and to fill all slots."""
+    if n_files == 0:
+        return 0
+    n_jobs = math.ceil(n_files / n_files_max) if n_files_max > 0 else 1
+    if n_slots > 0:
+        n_jobs = math.ceil(n_jobs / n_slots) * n_slots  # full waves of jobs
+    return min(n_jobs, n_files)
+
+
+def plan_jobs(weights: List[int], n_jobs: int, n_files_max: int = 0) -> List[List[int]]:
+    """Pack files (given by their weights) into jobs.
+
+    Returns lists of file indices per job, sorted by decreasing total weight of the job.
+    """
+    if n_jobs <= 0:
+        return []
+    jobs: List[List[int]] = [[] for _ in range(n_jobs)]
+    heap: List[Tuple[int, int]] = [(0, i) for i in range(n_jobs)]  # (load, job index)
+    for index in sorted(range(len(weights)), key=lambda i: weights[i], reverse=True):
+        if not heap:
+            msg_fatal("Not enough jobs for %d files with at most %d files per job." % (len(weights), n_files_max))
+        load, job = heapq.heappop(heap)
+        jobs[job].append(index)
+        if n_files_max <= 0 or len(jobs[job]) < n_files_max:
+            heapq.heappush(heap, (load + weights[index], job))
+    jobs = [sorted(files) for files in jobs if files]
+    return sorted(jobs, key=lambda files: sum(weights[i] for i in files), reverse=True)
+
+
+def plan_jobs_ordered(n_files: int, n_jobs: int) -> List[List[int]]:
+    """Split files into consecutive jobs of equal numbers of files (differing by one at most)."""
+    if n_jobs <= 0:
+        return []
+    return [list(range(i * n_files // n_jobs, (i + 1) * n_files // n_jobs)) for i in range(n_jobs)]
+
+
+def write_jobs(files: List[str], jobs: List[List[int]], dir_out: str, name_list: str, merge=None, debug=False):
+    """Create job directories with lists of input files and append the paths of job outputs to merge lists."""
+    lists_merge = {}
+    for _, path_list in merge or []:
+        lists_merge[path_list] = open(path_list, "a")  # pylint: disable=consider-using-with
+    try:
+        for i_job, indices in enumerate(jobs):
+            dir_job = os.path.join(dir_out, str(i_job))
+            os.makedirs(dir_job, exist_ok=True)
+            with open(os.path.join(dir_job, name_list), "w") as file:
+                for index in indices:
+                    file.write(files[index] + "\n")
+                    if debug:
+                        eprint("Input file (%d, job %d): %s" % (index, i_job, files[index]))
+            for file_out, path_list in merge or []:
+                lists_merge[path_list].write(os.path.join(dir_job, file_out) + "\n")
+    finally:
+        for file in lists_merge.values():
+            file.close()
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description="Split input files into jobs with balanced load.")
+    parser.add_argument("input", help="list of input files")
+    parser.add_argument("dir_out", help="output directory with job subdirectories")
+    parser.add_argument("list_job", help="name of the list of input files in each job directory")
+    parser.add_argument("-n", "--files-max", type=int, default=0, help="maximum number of files per job (0 = no limit)")
+    parser.add_argument(
+        "-j", "--slots", type=int, default=0, help="number of parallel slots to fill with full waves of jobs (0 = none)"
+    )
+    parser.add_argument("-e", "--events", type=str, help='file with lines "<path> <number of events>"')
+    parser.add_argument("-c", "--info", type=str, help='file with lines "<path> <size> <number of events or -1>"')
+    parser.add_argument(
+        "-m",
+        "--merge",
+        nargs=2,
+        action="append",
+        metavar=("FILE", "LIST"),
+        help="append the path of the job output FILE to the merge LIST (repeatable)",
+    )
+    parser.add_argument(
+        "-p", "--pending", action="store_true", help="input files are being produced in the order of the list"
+    )
+    parser.add_argument("-d", "--debug", action="store_true", help="debug mode")
+    args = parser.parse_args()
+
+    files = read_list(args.input, not args.pending)
+    n_jobs = get_n_jobs(len(files), args.files_max, args.slots)
+    if args.pending:
+        weights = [1] * len(files)  # unknown
+        jobs = plan_jobs_ordered(len(files), n_jobs)
+    else:
+        sizes, events = read_info(args.info) if args.info else ({}, {})
+        if args.events:
+            events = read_events(args.events)
+        weights = get_weights(files, events, sizes)
+        jobs = plan_jobs(weights, n_jobs, args.files_max)
+    write_jobs(files, jobs, args.dir_out, args.list_job, args.merge, args.debug)
+    if args.debug:
+        for i_job, indices in enumerate(jobs):
+            eprint("Job %d: %d files, weight %d" % (i_job, len(indices), sum(weights[i] for i in indices)))
+    print(len(jobs))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Quarantine of input files that failed alone in jobs
+
+Each entry of the quarantine list is a line "<path> <time> <scope>" with the time when the file failed alone
+and the scope in which it failed (e.g. the input directory and file pattern of a validation case).
+Files are excluded only in the same scope and only until their entries expire,
+so that the quarantine of one case does not affect other cases and files are tried again later
+(e.g. with a new software version).
+The list is updated under a file lock so that several runners can add files at the same time.
+Expired entries are removed when the list is updated.
+"""
+
+import fcntl
+import os
+import time
+from dataclasses import dataclass
+from typing import List, Set, Tuple
+
+
+@dataclass
+class Quarantine:
+    """List of input files excluded from jobs"""
+
+    path: str  # quarantine list
+    scope: str = ""  # scope of the entries
+    age_max: float = 0  # maximum age of entries in seconds (0 = unlimited)
+
+    def read(self) -> List[Tuple[str, float, str]]:
+        """Get all entries (path, time, scope) of the list that did not expire."""
+        entries = []
+        time_min = time.time() - self.age_max if self.age_max > 0 else 0
+        try:
+            with open(self.path, "r") as file:
+                for line in file:
+                    words = line.strip().split(" ", 2)
+                    if not words[0]:
+                        continue
+                    try:
+                        time_failed = float(words[1]) if len(words) > 1 else 0
+                    except ValueError:
+                        time_failed = 0
+                    if time_failed >= time_min:
+                        entries.append((words[0], time_failed, words[2] if len(words) > 2 else ""))
+        except OSError:
+            pass
+        return entries
+
+    def get_files(self) -> Set[str]:
+        """Get the files excluded in the scope."""
+        return {path for path, _, scope in self.read() if scope == self.scope}
+
+    def add(self, files: List[str]):
+        """Add files to the list in the scope and remove expired entries."""
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path + ".lock", "a") as file_lock:
+            fcntl.flock(file_lock, fcntl.LOCK_EX)
+            time_now = time.time()
+            entries = [e for e in self.read() if not (e[2] == self.scope and e[0] in files)]
+            entries += [(path, time_now, self.scope) for path in dict.fromkeys(files)]
+            path_tmp = "%s.tmp.%d" % (self.path, os.getpid())
+            with open(path_tmp, "w") as file:
+                for path, time_failed, scope in entries:
+                    file.write(("%s %d %s" % (path, time_failed, scope)).rstrip() + "\n")
+            os.replace(path_tmp, self.path)
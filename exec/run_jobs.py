@@ -0,0 +1,928 @@
+#!/usr/bin/env python3
+
+"""
+Runs jobs in parallel with admission control based on available resources.
+Replacement of GNU parallel for the batch scripts.
+
+The command is executed with bash for each job index with "{}" replaced by the index.
+Outputs of jobs are merged while the jobs are running.
+Optional features (log monitoring, caching, shared core pool, retries, CPU affinity, stage-in,
+batch systems, traces) are implemented in their own modules and described in the classes using them.
+
+The exit code is 1 if any job or merge failed, 2 if input files failed alone and were excluded from the outputs.
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import signal
+import subprocess as sp  # nosec B404
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from typing import IO, Dict, List, Optional, Tuple, Union
+
+from core_pool import CorePool, is_alive
+from executors import BACKENDS, ArrayExecutor, LocalExecutor, Task, make_executor
+from job_cache import JobCache
+from job_retry import Retrier
+from log_monitor import PATTERNS, LogMonitor, compile_patterns
+from placement import Slot, format_cpus, make_slots, make_slots_shared
+from quarantine import Quarantine
+from stage_in import Stager
+from timeline import Tracer
+from utilities import eprint, msg_fatal, msg_warn
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+GB = 1e9
+ABORT_MODES = ("job", "batch")  # what to abort when a fatal error appears in a job log
+TIME_KILL = 10  # time (in seconds) to wait after SIGTERM before killing a process group with SIGKILL
+FILE_JOB_DONE = "job.done"  # marker of a successful job in the job directory
+FILE_JOB_FAILED = "job.failed"  # marker of a failed job in the job directory
+EXIT_ISOLATED = 2  # exit code if input files failed alone and were excluded from the outputs
+
+
+def format_gb(n_bytes: float) -> str:
+    """Format a number of bytes in GB."""
+    return "%.2f GB" % (n_bytes / GB)
+
+
+def get_mem_available() -> int:
+    """Get the available memory (in bytes) as estimated by the kernel."""
+    with open("/proc/meminfo", "r") as file:
+        for line in file:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def get_shm_usage(path: str = "/dev/shm") -> Tuple[int, int]:
+    """Get the free and the used space (in bytes) of the shared memory file system."""
+    try:
+        stat = os.statvfs(path)
+    except OSError:
+        return 0, 0
+    return stat.f_bavail * stat.f_frsize, (stat.f_blocks - stat.f_bfree) * stat.f_frsize
+
+
+def get_cpu_children() -> float:
+    """Get the CPU time of terminated child processes (incl. their descendants)."""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def get_size(paths: List[str]) -> int:
+    """Get the total size of existing files."""
+    return sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+
+
+def get_process_children() -> Dict[int, List[int]]:
+    """Get the map of parent processes to their child processes."""
+    children: Dict[int, List[int]] = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % name, "r") as file:
+                stat = file.read()
+        except OSError:
+            continue
+        # The process name in parentheses can contain spaces.
+        ppid = int(stat[stat.rfind(")") + 2 :].split()[1])
+        children.setdefault(ppid, []).append(int(name))
+    return children
+
+
+def get_rss_private(pid: int) -> int:
+    """Get the private resident memory (in bytes) of a process, i.e. without shared pages."""
+    try:
+        with open("/proc/%d/statm" % pid, "r") as file:
+            values = file.read().split()
+    except OSError:
+        return 0
+    return max(0, int(values[1]) - int(values[2])) * PAGE_SIZE
+
+
+def get_rss_tree(pid: int, children: Dict[int, List[int]]) -> int:
+    """Get the private resident memory (in bytes) of a process and of all its descendants."""
+    rss = 0
+    stack = [pid]
+    while stack:
+        pid_this = stack.pop()
+        rss += get_rss_private(pid_this)
+        stack.extend(children.get(pid_this, []))
+    return rss
+
+
+@dataclass
+class Job:
+    """Job executed as a bash command"""
+
+    index: int  # job index
+    command: str  # bash command
+    task: Optional[Task] = None  # task of the executor running the job
+    time_start: float = 0.0  # start time
+    time_end: float = 0.0  # end time
+    rss: int = 0  # current memory usage of the process tree
+    rss_peak: int = 0  # peak memory usage of the process tree
+    time_cpu: float = 0.0  # CPU time of the process tree
+    slot: Optional[int] = None  # index of the slot
+    size_input: int = 0  # total size of the input files
+    exit_code: Optional[int] = None  # exit code
+    aborted: str = ""  # reason of abortion
+    cached: bool = False  # result restored from the cache
+    time_kill: float = 0.0  # time of the termination request
+    files: List[str] = field(default_factory=list)  # input files (if failed jobs are split)
+    parent: Optional[int] = None  # index of the failed job retried by this job
+    children: List[int] = field(default_factory=list)  # indices of the jobs retrying this failed job
+    isolated: bool = False  # failed with a single input file
+
+    @property
+    def status(self) -> str:
+        """Final status of the job"""
+        if self.children:
+            return "split"
+        if self.isolated:
+            return "isolated"
+        return "aborted" if self.aborted else "cached" if self.cached else "done" if self.exit_code == 0 else "failed"
+
+
+@dataclass
+class MergeTarget:
+    """Output file merged from the outputs of jobs"""
+
+    path_out: str  # merged output file
+    inputs: List[str]  # outputs of jobs (by job index)
+    pending: List[str] = field(default_factory=list)  # files ready to be merged
+    n_waiting: int = 0  # number of inputs not ready yet (unfinished jobs and running merges) or running final merge
+    n_partial: int = 0  # number of created partial outputs
+    done: bool = False  # final output produced
+
+    @property
+    def dir_partial(self) -> str:
+        """Directory with partial outputs"""
+        return self.path_out + ".partial"
+
+
+@dataclass
+class Merge:
+    """Running merge"""
+
+    target: MergeTarget
+    inputs: List[str]  # merged files
+    path_out: str  # output file
+    process: sp.Popen
+    output: IO  # temporary file with the merge output
+    time_start: float = 0.0  # start time
+    size_input: int = 0  # total size of the merged files
+
+
+@dataclass
+class Merger:
+    """Merges outputs of finished jobs in a tree of partial merges
+
+    Outputs of finished jobs are merged in partial merges of a given number of files (fan-in)
+    by a given number of parallel workers. Partial outputs are merged further in the same way.
+    Only the final merge of the remaining files is left after the last job finishes.
+    Outputs of failed jobs retried in new jobs are replaced by the outputs of the new jobs.
+    """
+
+    targets: List[MergeTarget]
+    fan_in: int = 8  # maximum number of files merged in one partial merge
+    n_workers: int = 1  # maximum number of parallel merges
+    debug: bool = False
+    merges: List[Merge] = field(default_factory=list)  # running merges
+    n_failed: int = 0  # number of failed merges
+    tracer: Optional[Tracer] = None  # recorder of merge spans
+
+    def __post_init__(self):
+        for target in self.targets:
+            target.n_waiting = len(target.inputs)
+
+    def add(self, index: int):
+        """Add the outputs of a successfully finished job."""
+        for target in self.targets:
+            target.pending.append(target.inputs[index])
+            target.n_waiting -= 1
+
+    def skip(self):
+        """Skip the outputs of a failed job."""
+        for target in self.targets:
+            target.n_waiting -= 1
+
+    def can_split(self, index: int, dir_job: str) -> bool:
+        """Check whether the outputs of a job are in its directory."""
+        return all(target.inputs[index].startswith(dir_job + os.sep) for target in self.targets)
+
+    def split(self, index: int, dir_job: str, dirs_new: List[str]):
+        """Replace the outputs of a failed job by the outputs of new jobs (next indices) in the new directories."""
+        for target in self.targets:
+            path = target.inputs[index]
+            target.inputs += [dir_new + path[len(dir_job) :] for dir_new in dirs_new]
+            target.n_waiting += len(dirs_new) - 1
+
+    def start(self, target: MergeTarget, inputs: List[str], final: bool):
+        """Start merging files."""
+        if final:
+            path_out = target.path_out
+        else:
+            os.makedirs(target.dir_partial, exist_ok=True)
+            path_out = os.path.join(target.dir_partial, "%d_%s" % (target.n_partial, os.path.basename(target.path_out)))
+            target.n_partial += 1
+        target.n_waiting += 1
+        if self.debug:
+            eprint("Merging %d files into %s" % (len(inputs), path_out))
+        output = tempfile.TemporaryFile(mode="w+")  # pylint: disable=consider-using-with
+        process = sp.Popen(  # pylint: disable=consider-using-with # nosec B603 B607
+            ["hadd", "-f", path_out] + inputs, stdout=output, stderr=sp.STDOUT
+        )
+        self.merges.append(Merge(target, inputs, path_out, process, output, time.time(), get_size(inputs)))
+
+    def finish(self, merge: Merge):
+        """Process a finished merge."""
+        self.merges.remove(merge)
+        merge.output.seek(0)
+        print(merge.output.read(), end="", flush=True)
+        merge.output.close()
+        target = merge.target
+        if self.tracer:
+            self.tracer.record(
+                "merge",
+                os.path.basename(merge.path_out),
+                merge.time_start,
+                time.time(),
+                pid=merge.process.pid,
+                bytes=merge.size_input,
+                exit_code=merge.process.returncode,
+                n_files=len(merge.inputs),
+            )
+        if merge.process.returncode != 0:
+            print("Merging into %s failed with exit code %d." % (merge.path_out, merge.process.returncode), flush=True)
+            self.n_failed += 1
+        elif merge.path_out == target.path_out:
+            target.done = True
+        else:
+            target.pending.append(merge.path_out)
+            target.n_waiting -= 1
+        # Delete merged partial outputs.
+        for path in merge.inputs:
+            if os.path.dirname(path) == target.dir_partial:
+                os.remove(path)
+
+    def update(self):
+        """Process finished merges and start new ones."""
+        for merge in list(self.merges):
+            if merge.process.poll() is not None:
+                self.finish(merge)
+        if self.n_failed:
+            return
+        for target in self.targets:
+            while len(self.merges) < self.n_workers and not target.done:
+                if len(target.pending) >= self.fan_in and (target.n_waiting or len(target.pending) > self.fan_in):
+                    self.start(target, target.pending[: self.fan_in], False)
+                    target.pending = target.pending[self.fan_in :]
+                elif not target.n_waiting and target.pending:
+                    self.start(target, target.pending, True)
+                    target.pending = []
+                elif not target.n_waiting:
+                    target.done = True  # nothing to merge
+                else:
+                    break
+
+    def is_done(self) -> bool:
+        """Check whether all outputs are merged or merging cannot continue."""
+        return not self.merges and (self.n_failed > 0 or all(target.done for target in self.targets))
+
+    def kill(self):
+        """Kill all running merges and delete partial outputs."""
+        for merge in self.merges:
+            merge.process.kill()
+        for target in self.targets:
+            shutil.rmtree(target.dir_partial, ignore_errors=True)
+
+
+@dataclass
+class Scheduler:
+    """Runs jobs in parallel with admission control
+
+    A new job is started only if the maximum number of parallel jobs is not reached
+    and if there is enough free memory and shared memory for it.
+    The memory needed by a job is estimated from the peak memory usage observed in the jobs
+    (private resident memory of the whole process tree) and cannot be lower than the given minimum.
+    Memory reserved for running jobs that have not reached the estimate yet is not considered free.
+    At least one job is always running so that the batch progresses even if resources are scarce.
+
+    Log files of running jobs can be monitored and the job or the whole batch aborted on fatal errors
+    (see log_monitor.py).
+    Jobs with cached results are not executed again (see job_cache.py).
+    Jobs of several runners can share one budget of CPU cores (see core_pool.py).
+    A job consuming outputs of jobs of another runner starts only when the producer jobs of all its input files
+    are marked as done in their directories and fails if any of them failed.
+    Failed jobs can be retried with their input files split in smaller jobs (see job_retry.py).
+    Each running job occupies a slot, which can be pinned to a set of CPUs (see placement.py).
+    Input files of queued jobs can be copied to local storage ahead of their execution (see stage_in.py).
+    Jobs can be executed as local processes or as tasks of array jobs of a batch system (see executors.py).
+    Resource-based admission, the core pool, the stage-in and the CPU affinity apply only to local processes.
+    """
+
+    jobs_queued: List[Job]  # jobs waiting to be started
+    n_parallel: int  # maximum number of parallel jobs
+    mem_job: int = 0  # minimum memory estimate of a job
+    shm_job: int = 0  # shared memory needed by a job
+    mem_reserve: int = 0  # memory to be kept free
+    interval: float = 1.0  # polling interval in seconds
+    debug: bool = False
+    merger: Optional[Merger] = None  # merger of job outputs
+    monitor: Optional[LogMonitor] = None  # monitor of job logs
+    abort: str = ""  # what to abort when a fatal error appears in a job log (see ABORT_MODES, empty = nothing)
+    cache: Optional[JobCache] = None  # cache of job results
+    pool: Optional[CorePool] = None  # shared pool of CPU cores
+    cores_job: float = 1.0  # number of cores used by a job
+    mark: str = ""  # job directory in which the job result is marked, with "{}" replaced by the job index
+    wait_list: str = ""  # input list of a job with files produced by other jobs, with "{}" replaced by the job index
+    wait_pid: int = 0  # process producing the input files
+    retrier: Optional[Retrier] = None  # retries of failed jobs in smaller jobs
+    stager: Optional[Stager] = None  # stage-in of input files to local storage
+    list_input: str = ""  # input list of a job with "{}" replaced by the job index
+    tracer: Optional[Tracer] = None  # recorder of job spans
+    slots: List[Slot] = field(default_factory=list)  # job slots (at least n_parallel)
+    affinity: bool = False  # run jobs with the CPU affinity of their slots
+    executor: Union[LocalExecutor, ArrayExecutor] = field(default_factory=LocalExecutor)  # executor of jobs
+    time_run: float = 0.0  # wall time of running the jobs
+    n_isolated: int = 0  # number of input files that failed alone and were excluded from the outputs
+    batch_aborted: bool = False  # all jobs aborted
+    jobs_running: List[Job] = field(default_factory=list)
+    jobs_done: List[Job] = field(default_factory=list)
+    reason_wait: str = ""  # reason for not starting the next job
+    rss_total_peak: int = 0  # peak memory usage of all running jobs together
+
+    def get_mem_estimate(self) -> int:
+        """Estimate the memory needed by a job from the observed peak memory usage."""
+        return max([self.mem_job] + [job.rss_peak for job in self.jobs_running + self.jobs_done])
+
+    def get_wait_reason(self) -> str:
+        """Check whether a new job can be started. Return the reason for waiting (empty if it can start)."""
+        if not self.jobs_running:
+            return ""
+        if len(self.jobs_running) >= self.n_parallel:
+            return "slots"
+        if not self.executor.local:
+            return ""
+        mem_job = self.get_mem_estimate()
+        mem_reserved = sum(max(0, mem_job - job.rss) for job in self.jobs_running)
+        mem_free = get_mem_available() - mem_reserved - self.mem_reserve
+        if mem_free < mem_job:
+            return "memory (free %s, job needs %s)" % (format_gb(mem_free), format_gb(mem_job))
+        if self.shm_job > 0:
+            shm_free, shm_used = get_shm_usage()
+            # Shared memory segments are filled gradually. Reserve the unused part for running jobs.
+            shm_free -= max(0, len(self.jobs_running) * self.shm_job - shm_used)
+            if shm_free < self.shm_job:
+                return "shared memory (free %s, job needs %s)" % (format_gb(shm_free), format_gb(self.shm_job))
+        return ""
+
+    def start(self, job: Job):
+        """Start a job."""
+        path_list = self.retrier.split_list if self.retrier else self.list_input
+        if path_list and not job.files:
+            with open(path_list.replace("{}", str(job.index)), "r") as file:
+                job.files = [line.strip() for line in file if line.strip()]
+        if self.tracer:
+            job.size_input = get_size(job.files)
+        if self.stager:
+            self.stager.start(job.index)
+        slot = next(s for s in self.slots if s.job is None)
+        slot.job = job.index
+        job.slot = slot.index
+        job.time_start = time.time()
+        job.task = self.executor.start(job.index, job.command, slot)
+        self.jobs_running.append(job)
+        if self.monitor:
+            self.monitor.add_job(job.index)
+        if self.debug:
+            eprint("Started job %d (running: %d)" % (job.index, len(self.jobs_running)))
+
+    def finish(self, job: Job, exit_code: int):
+        """Process a finished job."""
+        assert job.task
+        job.exit_code = exit_code
+        job.time_end = time.time()
+        if self.stager:
+            self.stager.evict(job.index)
+        slot = self.slots[job.slot]
+        slot.job = None
+        slot.n_jobs += 1
+        slot.time_busy += job.time_end - job.time_start
+        slot.time_cpu += job.time_cpu
+        self.jobs_running.remove(job)
+        self.jobs_done.append(job)
+        if self.pool:
+            self.pool.release(str(job.index))
+        print(self.executor.read_output(job.task), end="", flush=True)
+        if job.exit_code != 0:
+            print("Job %d failed with exit code %d: %s" % (job.index, job.exit_code, job.command), flush=True)
+            self.retry(job)
+        elif self.cache and not self.cache.store(job.index):
+            msg_warn("Failed to store the result of job %d in the cache." % job.index)
+        self.process_result(job)
+        if self.tracer:
+            self.tracer.record(
+                "job",
+                "job %d" % job.index,
+                job.time_start,
+                job.time_end,
+                index=job.index,
+                pid=job.task.pid,
+                slot=job.slot,
+                bytes=job.size_input,
+                exit_code=job.exit_code,
+                status=job.status,
+            )
+        if self.debug:
+            n_jobs = len(self.jobs_queued) + len(self.jobs_running) + len(self.jobs_done)
+            eprint(
+                "Finished job %d (exit code %d, %.0f s, peak memory %s) [%d/%d]"
+                % (
+                    job.index,
+                    job.exit_code,
+                    job.time_end - job.time_start,
+                    format_gb(job.rss_peak),
+                    len(self.jobs_done),
+                    n_jobs,
+                )
+            )
+
+    def retry(self, job: Job):
+        """Retry a failed job with its input files split in smaller jobs or isolate its single input file."""
+        if not self.retrier or self.batch_aborted or not job.files:
+            return
+        if len(job.files) == 1:
+            job.isolated = True
+            print("Job %d failed with the single input file %s" % (job.index, job.files[0]), flush=True)
+            if self.merger:
+                self.merger.skip()
+            return
+        dir_job = self.retrier.get_dir_job(job.index)
+        if self.merger and not self.merger.can_split(job.index, dir_job):
+            msg_warn("Outputs of job %d are not in its directory %s. Job cannot be split." % (job.index, dir_job))
+            return
+        index_next = 1 + max(j.index for j in self.jobs_queued + self.jobs_running + self.jobs_done)
+        for index, command, files in self.retrier.split(job.index, job.files, index_next):
+            job.children.append(index)
+            self.jobs_queued.append(Job(index, command, files=files, parent=job.index))
+        if self.merger:
+            self.merger.split(job.index, dir_job, [self.retrier.get_dir_job(i) for i in job.children])
+
+    def process_result(self, job: Job):
+        """Merge the output, summarise the log and mark the result of a finished job."""
+        if job.exit_code == 0 and self.merger:
+            self.merger.add(job.index)
+        if self.monitor:
+            if not job.task:
+                self.monitor.add_job(job.index)
+            self.monitor.scan(job.index, final=True)
+            self.monitor.write_summary(job.index, job.status, job.exit_code)
+        self.mark_job(job)
+
+    def mark_job(self, job: Job):
+        """Mark the result of a job in its directory."""
+        if not self.mark:
+            return
+        dir_job = self.mark.replace("{}", str(job.index))
+        name = FILE_JOB_DONE if job.exit_code == 0 else FILE_JOB_FAILED
+        try:
+            open(os.path.join(dir_job, name), "w").close()  # pylint: disable=consider-using-with
+        except OSError:
+            msg_warn("Failed to mark the result of job %d in %s." % (job.index, dir_job))
+
+    def get_input_state(self, job: Job) -> str:
+        """Check whether the input files of a job are produced. Return "ready", "waiting" or "failed"."""
+        if not self.wait_list:
+            return "ready"
+        with open(self.wait_list.replace("{}", str(job.index)), "r") as file:
+            dirs = {os.path.dirname(line.strip()) for line in file if line.strip()}
+        if any(os.path.exists(os.path.join(d, FILE_JOB_FAILED)) for d in dirs):
+            return "failed"
+        if all(os.path.exists(os.path.join(d, FILE_JOB_DONE)) for d in dirs):
+            return "ready"
+        if self.wait_pid and not is_alive(self.wait_pid):
+            return "failed"
+        return "waiting"
+
+    def settle_job(self, job: Job, exit_code: int, message: str):
+        """Finish a queued job without running it and report it with a message."""
+        job.exit_code = exit_code
+        if self.stager:
+            self.stager.evict(job.index)
+        self.jobs_queued.remove(job)
+        self.jobs_done.append(job)
+        print(message, flush=True)
+        self.process_result(job)
+
+    def fail_job(self, job: Job, reason: str):
+        """Fail a queued job without running it."""
+        self.settle_job(job, 1, "Job %d failed: %s" % (job.index, reason))
+
+    def update(self):
+        """Update the memory usage of running jobs and process finished jobs."""
+        local = self.executor.local
+        children = get_process_children() if local else {}
+        self.executor.refresh()
+        rss_total = 0
+        for job in list(self.jobs_running):
+            assert job.task
+            # The CPU time of the process tree is added to the children usage when the job process is collected.
+            cpu_before = get_cpu_children()
+            exit_code = self.executor.poll(job.task)
+            if exit_code is None:
+                if local:
+                    job.rss = get_rss_tree(job.task.pid, children)
+                    job.rss_peak = max(job.rss_peak, job.rss)
+                    rss_total += job.rss
+                if job.aborted:
+                    if time.time() - job.time_kill > TIME_KILL:
+                        self.kill_job(job, signal.SIGKILL)
+                elif self.monitor:
+                    fatal = self.monitor.scan(job.index)
+                    if fatal and self.abort:
+                        self.abort_job(job, fatal)
+            else:
+                if local:
+                    job.time_cpu = get_cpu_children() - cpu_before
+                self.finish(job, exit_code)
+        self.rss_total_peak = max(self.rss_total_peak, rss_total)
+
+    def write_report(self, path: str):
+        """Write a JSON report of the finished jobs."""
+        jobs = []
+        for job in sorted(self.jobs_done, key=lambda j: j.index):
+            jobs.append(
+                {
+                    "index": job.index,
+                    "status": job.status,
+                    "exit_code": job.exit_code,
+                    "time_start": job.time_start,
+                    "time_end": job.time_end,
+                    "rss_peak": job.rss_peak,
+                    "parent": job.parent,
+                    "slot": job.slot,
+                    "time_cpu": job.time_cpu,
+                }
+            )
+        slots = [
+            {
+                "index": slot.index,
+                "cpus": format_cpus(slot.cpus),
+                "node": slot.node,
+                "n_jobs": slot.n_jobs,
+                "time_busy": slot.time_busy,
+                "time_cpu": slot.time_cpu,
+                "utilisation": self.get_utilisation(slot),
+            }
+            for slot in self.slots
+        ]
+        report = {"rss_total_peak": self.rss_total_peak, "time_run": self.time_run, "slots": slots, "jobs": jobs}
+        with open(path, "w") as file:
+            json.dump(report, file, indent=2)
+
+    def get_utilisation(self, slot: Slot) -> float:
+        """Get the CPU time of the jobs of a slot relative to the available CPU time of the slot."""
+        return slot.time_cpu / (self.time_run * slot.n_cores) if self.time_run > 0 and slot.n_cores > 0 else 0.0
+
+    def print_slots(self):
+        """Print out the utilisation of the job slots."""
+        eprint("Utilisation of job slots (wall time: %.0f s)" % self.time_run)
+        eprint("%5s %-16s %5s %6s %9s %9s" % ("slot", "CPUs", "node", "jobs", "busy [%]", "CPU [%]"))
+        for slot in self.slots:
+            eprint(
+                "%5d %-16s %5s %6d %9.1f %9.1f"
+                % (
+                    slot.index,
+                    format_cpus(slot.cpus) if self.affinity else "all",
+                    slot.node if slot.node >= 0 else "-",
+                    slot.n_jobs,
+                    100 * slot.time_busy / self.time_run if self.time_run > 0 else 0.0,
+                    100 * self.get_utilisation(slot),
+                )
+            )
+
+    def abort_job(self, job: Job, fatal: dict):
+        """Abort a job with a fatal error (and the whole batch if requested).
+
+        If failed jobs are split, the batch is aborted only if no job has succeeded yet.
+        Otherwise, the error is more likely caused by an input file than by a general problem.
+        """
+        print(
+            "Job %d aborted because of a fatal error in %s (line %d): %s"
+            % (job.index, fatal["file"], fatal["line"], fatal["message"]),
+            flush=True,
+        )
+        job.aborted = "fatal error"
+        self.kill_job(job, signal.SIGTERM)
+        if self.abort == "batch" and not (self.retrier and any(j.exit_code == 0 for j in self.jobs_done)):
+            print("Aborting all jobs.", flush=True)
+            self.batch_aborted = True
+            for job_other in list(self.jobs_queued):
+                self.fail_job(job_other, "batch aborted")
+            for job_other in self.jobs_running:
+                if not job_other.aborted:
+                    job_other.aborted = "batch aborted"
+                    self.kill_job(job_other, signal.SIGTERM)
+
+    def kill_job(self, job: Job, sig: int):
+        """Send a signal to a job."""
+        assert job.task
+        job.time_kill = time.time()
+        self.executor.kill(job.task, sig)
+
+    def get_work(self) -> float:
+        """Estimate the remaining work (in core-seconds) from the measured job durations."""
+        time_now = time.time()
+        durations = [job.time_end - job.time_start for job in self.jobs_done if job.task]
+        if not durations:  # Use the longest running job as a lower estimate.
+            durations = [max([time_now - job.time_start for job in self.jobs_running], default=1.0)]
+        duration = sum(durations) / len(durations)
+        return (len(self.jobs_queued) + len(self.jobs_running)) * max(duration, 1.0) * self.cores_job
+
+    def admit(self):
+        """Start queued jobs with ready inputs as long as resources allow it."""
+        self.reason_wait = self.admit_ready()
+        self.executor.flush()
+        if self.stager:
+            self.stager.update([job.index for job in self.jobs_queued if self.get_input_state(job) == "ready"])
+        if self.pool:
+            self.pool.set_demand(self.get_work(), self.reason_wait == "cores")
+
+    def admit_ready(self) -> str:
+        """Start queued jobs with ready inputs as long as resources allow it. Return the reason for waiting."""
+        for job in list(self.jobs_queued):
+            state = self.get_input_state(job)
+            if state == "waiting":
+                continue
+            if state == "failed":
+                self.fail_job(job, "input files could not be produced")
+                continue
+            if self.cache and self.cache.restore(job.index):
+                job.cached = True
+                self.settle_job(job, 0, "Job %d: restored from the cache" % job.index)
+                continue
+            reason = self.get_wait_reason()
+            if not reason and self.stager and not self.stager.is_ready(job.index):
+                reason = "stage-in"
+            if not reason and self.pool and not self.pool.acquire(str(job.index), self.cores_job):
+                reason = "cores"
+            if reason:
+                if self.debug and reason != self.reason_wait and reason != "slots":
+                    eprint("Waiting for %s" % reason)
+                return reason
+            self.jobs_queued.remove(job)
+            self.start(job)
+        return ""
+
+    def kill(self):
+        """Kill all running jobs."""
+        for job in self.jobs_running:
+            self.kill_job(job, signal.SIGTERM)
+
+    def run(self) -> int:
+        """Run all jobs and merge their outputs. Return the number of failed jobs and merges."""
+        time_start = time.time()
+        try:
+            while self.jobs_queued or self.jobs_running:
+                self.update()
+                self.admit()
+                if self.merger:
+                    self.merger.update()
+                if self.jobs_queued or self.jobs_running:
+                    time.sleep(self.interval)
+            self.time_run = time.time() - time_start
+            if self.affinity or self.debug:
+                self.print_slots()
+            n_failed = sum(1 for job in self.jobs_done if job.exit_code != 0 and not job.children and not job.isolated)
+            files_isolated = [job.files[0] for job in self.jobs_done if job.isolated]
+            if files_isolated and self.retrier:
+                if self.retrier.exclude(files_isolated, any(job.exit_code == 0 for job in self.jobs_done)):
+                    self.n_isolated = len(files_isolated)
+                else:
+                    n_failed += len(files_isolated)
+            if self.merger and not n_failed:
+                while not self.merger.is_done():
+                    self.merger.update()
+                    time.sleep(0.1)
+                n_failed += self.merger.n_failed
+            if self.tracer:
+                self.tracer.record("runner", self.tracer.step, time_start, time.time(), exit_code=1 if n_failed else 0)
+            if self.cache:
+                n_kept, n_evicted = self.cache.evict()
+                if self.debug:
+                    eprint("Jobs restored from the cache: %d" % sum(1 for job in self.jobs_done if job.cached))
+                    eprint("Cache entries: %d (evicted: %d)" % (n_kept, n_evicted))
+        finally:
+            self.kill()
+            if self.merger:
+                self.merger.kill()
+            if self.pool:
+                self.pool.remove_runner()
+            if self.stager:
+                self.stager.clean()
+            self.executor.clean()
+        return n_failed
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description="Run jobs in parallel with admission control.")
+    parser.add_argument("command", help='bash command with "{}" replaced by the job index')
+    parser.add_argument("n_jobs", type=int, help="number of jobs (indices from 0)")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=0, help="maximum number of parallel jobs (0 = number of CPUs)"
+    )
+    parser.add_argument("--mem-job", type=float, default=0, help="minimum memory estimate of a job [B]")
+    parser.add_argument("--shm-job", type=float, default=0, help="shared memory needed by a job [B]")
+    parser.add_argument("--mem-reserve", type=float, default=GB, help="memory to be kept free [B]")
+    parser.add_argument("--interval", type=float, default=1.0, help="polling interval [s]")
+    parser.add_argument(
+        "-m",
+        "--merge",
+        nargs=2,
+        action="append",
+        metavar=("LIST", "FILE"),
+        help="merge the job outputs from LIST (line per job index) into FILE (repeatable)",
+    )
+    parser.add_argument("--merge-fan-in", type=int, default=8, help="number of files per partial merge")
+    parser.add_argument("--merge-workers", type=int, default=1, help="maximum number of parallel merges")
+    parser.add_argument(
+        "--log", action="append", help='log file of a job to monitor with "{}" replaced by the job index'
+    )
+    parser.add_argument("--log-type", choices=list(PATTERNS), default="o2", help="type of log patterns")
+    parser.add_argument("--log-summary", type=str, default="", help='JSON summary of log messages with "{}" as index')
+    parser.add_argument("--abort", choices=ABORT_MODES, help="abort job or batch when a fatal error appears in a log")
+    parser.add_argument("--cache", type=str, help="directory of the cache of job results")
+    parser.add_argument("--cache-list", type=str, help='job input list with "{}" replaced by the job index')
+    parser.add_argument("--cache-file", action="append", default=[], help="file identifying the jobs (repeatable)")
+    parser.add_argument("--cache-env", action="append", default=[], help="environment variable identifying the jobs")
+    parser.add_argument(
+        "--cache-build",
+        action="append",
+        default=[],
+        help="environment variable with the path of a software build whose binaries identify the jobs",
+    )
+    parser.add_argument("--cache-output", action="append", default=[], help='job output file with "{}" as index')
+    parser.add_argument("--cache-size", type=float, default=0, help="maximum size of the cache [GB] (0 = unlimited)")
+    parser.add_argument(
+        "--cache-age", type=float, default=0, help="maximum age of cache entries [days] (0 = unlimited)"
+    )
+    parser.add_argument("--core-pool", type=str, help="file with the pool of CPU cores shared with other runners")
+    parser.add_argument("--cores", type=float, default=0, help="number of cores in the pool (0 = number of CPUs)")
+    parser.add_argument("--cores-job", type=float, default=1, help="number of cores used by a job")
+    parser.add_argument(
+        "--mark", type=str, default="", help='job directory to mark the job result in with "{}" as index'
+    )
+    parser.add_argument(
+        "--wait-inputs",
+        type=str,
+        default="",
+        help='job input list with files produced by other jobs with "{}" as index',
+    )
+    parser.add_argument("--wait-pid", type=int, default=0, help="process producing the input files")
+    parser.add_argument(
+        "--split", type=str, default="", help='job input list with "{}" as index to split failed jobs and retry them'
+    )
+    parser.add_argument("--split-parts", type=int, default=2, help="number of jobs a failed job is split into")
+    parser.add_argument("--quarantine", type=str, default="", help="list of input files that failed alone")
+    parser.add_argument("--quarantine-scope", type=str, default="", help="scope of the added quarantine entries")
+    parser.add_argument(
+        "--quarantine-age", type=float, default=0, help="maximum age of quarantine entries [days] (0 = unlimited)"
+    )
+    parser.add_argument("--stage", type=str, help="local directory to copy input files of jobs to before they start")
+    parser.add_argument("--stage-list", type=str, help='job input list with "{}" replaced by the job index')
+    parser.add_argument("--stage-ahead", type=int, default=2, help="number of queued jobs whose inputs are copied")
+    parser.add_argument("--stage-workers", type=int, default=2, help="maximum number of parallel copies")
+    parser.add_argument(
+        "--affinity", action="store_true", help="pin job slots to disjoint sets of CPUs (per NUMA node if possible)"
+    )
+    parser.add_argument(
+        "--executor", choices=BACKENDS, default="local", help="backend executing the jobs (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--executor-dir", type=str, help="shared directory with submit files and task outputs of array jobs"
+    )
+    parser.add_argument("--submit-options", type=str, help="file with additional lines of the submit files")
+    parser.add_argument("--trace", type=str, help="trace event file to record spans of jobs and merges in")
+    parser.add_argument("--trace-name", type=str, default="jobs", help="name of the traced step")
+    parser.add_argument("--report", type=str, help="JSON report of the jobs")
+    parser.add_argument("-d", "--debug", action="store_true", help="debug mode")
+    args = parser.parse_args()
+
+    if args.n_jobs < 0:
+        msg_fatal("Invalid number of jobs: %d" % args.n_jobs)
+    n_parallel = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    shm_size = sum(get_shm_usage())
+    if args.shm_job > shm_size > 0:
+        msg_warn(
+            "Shared memory needed by a job (%s) exceeds the size of /dev/shm (%s). Jobs will run one by one."
+            % (format_gb(args.shm_job), format_gb(shm_size))
+        )
+    if args.executor != "local":
+        for option, name in ((args.core_pool, "core pool"), (args.stage, "stage-in"), (args.affinity, "CPU affinity")):
+            if option:
+                msg_warn("The %s applies only to local jobs. Ignored with the %s executor." % (name, args.executor))
+        args.core_pool, args.stage, args.affinity = None, None, False
+    jobs = [Job(i, args.command.replace("{}", str(i))) for i in range(args.n_jobs)]
+    tracer = Tracer(os.path.realpath(args.trace), args.trace_name) if args.trace else None
+    merger = None
+    if args.merge:
+        if not shutil.which("hadd"):
+            msg_fatal("hadd not found. (Is ROOT loaded?)")
+        targets = []
+        for path_list, path_out in args.merge:
+            with open(path_list, "r") as file:
+                inputs = [line.strip() for line in file if line.strip()]
+            if len(inputs) != args.n_jobs:
+                msg_fatal("Number of files in %s (%d) differs from the number of jobs." % (path_list, len(inputs)))
+            targets.append(MergeTarget(path_out, inputs))
+        merger = Merger(targets, max(2, args.merge_fan_in), max(1, args.merge_workers), args.debug, tracer=tracer)
+    monitor = None
+    if args.log:
+        monitor = LogMonitor(compile_patterns(args.log_type), args.log, args.log_summary)
+    elif args.abort:
+        msg_warn("No log files to monitor.")
+    cache = None
+    if args.cache:
+        if not args.cache_list or not args.cache_output:
+            msg_fatal("The cache needs the job input list and the job outputs.")
+        cache = JobCache(
+            args.cache,
+            args.command,
+            args.cache_file,
+            args.cache_list,
+            args.cache_output,
+            args.cache_env,
+            args.cache_build,
+            size_max=args.cache_size * GB,
+            age_max=args.cache_age * 86400,
+        )
+    pool = None
+    if args.core_pool:
+        pool = CorePool(args.core_pool, args.cores if args.cores > 0 else (os.cpu_count() or 1))
+    stager = None
+    if args.stage:
+        if not args.stage_list:
+            msg_fatal("The stage-in needs the job input list.")
+        dir_stage = os.path.join(os.path.realpath(args.stage), "run3analysisvalidation_stage_%d" % os.getpid())
+        stager = Stager(dir_stage, args.stage_list, max(1, args.stage_ahead), max(1, args.stage_workers), args.debug)
+    retrier = None
+    if args.split and args.split_parts > 1:
+        quarantine = None
+        if args.quarantine:
+            quarantine = Quarantine(args.quarantine, args.quarantine_scope, args.quarantine_age * 86400)
+        retrier = Retrier(args.split, args.command, args.split_parts, quarantine)
+    slots = make_slots(n_parallel) if args.affinity else make_slots_shared(n_parallel)
+    executor = make_executor(
+        args.executor,
+        args.executor_dir or os.path.join(os.getcwd(), "run_jobs_%s_%d" % (args.executor, os.getpid())),
+        args.command,
+        args.cores_job,
+        args.submit_options or "",
+        args.affinity,
+        args.debug,
+    )
+    scheduler = Scheduler(
+        jobs,
+        n_parallel,
+        mem_job=int(args.mem_job),
+        shm_job=int(args.shm_job),
+        mem_reserve=int(args.mem_reserve),
+        interval=args.interval,
+        debug=args.debug,
+        merger=merger,
+        monitor=monitor,
+        abort=args.abort or "",
+        cache=cache,
+        pool=pool,
+        cores_job=args.cores_job,
+        mark=args.mark,
+        wait_list=args.wait_inputs,
+        wait_pid=args.wait_pid,
+        retrier=retrier,
+        stager=stager,
+        list_input=args.cache_list or args.split or "",
+        tracer=tracer,
+        slots=slots,
+        affinity=args.affinity,
+        executor=executor,
+    )
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(1))
+    n_failed = scheduler.run()
+    if args.report:
+        scheduler.write_report(args.report)
+    if args.debug:
+        eprint("Jobs: %d, failed: %d" % (args.n_jobs, n_failed))
+    sys.exit(1 if n_failed else EXIT_ISOLATED if scheduler.n_isolated else 0)
+
+
+if __name__ == "__main__":
+    main()
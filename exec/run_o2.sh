@@ -4,11 +4,44 @@ SCRIPT="$1"
 FILEIN="$2"
 JSON="$3"
 LOGFILE="$4"
+SCRIPT_UPSTREAM="$5"  # (optional) script of the upstream stage producing the derived AO2D
+DIR_DERIVED="$6"      # (optional) directory with reusable derived AO2Ds (entries evicted by job_cache.py)
+
+# Run the upstream stage or reuse its output.
+if [ "$SCRIPT_UPSTREAM" ]; then
+  # The derived AO2D is identified by the upstream script (incl. its configuration hash) and by the input files.
+  Key=$( { cat "$SCRIPT_UPSTREAM"; while read -r File; do stat -L -c "%n %s %Y" "$File"; done < "$FILEIN"; } | sha1sum | cut -d " " -f 1)
+  DirDerived="$DIR_DERIVED/${Key:0:2}/$Key"
+  FileDerived="$DirDerived/AO2D_derived.root"
+  if [ -f "$FileDerived" ]; then
+    echo "Reusing derived AO2D $FileDerived"
+    touch "$DirDerived" # Mark as recently used.
+  else
+    # Run in a temporary directory and move it in place only if everything went fine.
+    DirTmp="$DirDerived.tmp.$$"
+    mkdir -p "$DirTmp" && cp "$FILEIN" "$DirTmp/" || { echo "Error: Failed to prepare $DirTmp"; exit 1; }
+    (cd "$DirTmp" && bash "$SCRIPT_UPSTREAM" "$FILEIN" "$JSON") > "${LOGFILE/.log/_upstream.log}" 2>&1
+    ExitCode=$?
+    if [[ $ExitCode -ne 0 || ! -f "$DirTmp/AO2D_derived.root" ]]; then
+      echo "Error: Upstream stage failed. Check $(realpath "${LOGFILE/.log/_upstream.log}")"
+      rm -rf "$DirTmp"
+      exit 1
+    fi
+    { mv "$DirTmp" "$DirDerived" || rm -rf "$DirTmp"; } 2> /dev/null
+  fi
+  # Read the derived AO2D instead of the input files.
+  mv "$FILEIN" "${FILEIN/.txt/_parent.txt}" && echo "$FileDerived" > "$FILEIN" || { echo "Error: Failed to make $FILEIN"; exit 1; }
+fi
 
 # Run the script.
 bash "$SCRIPT" "$FILEIN" "$JSON" > "$LOGFILE" 2>&1
 ExitCode=$?
 
+# Add the output of the upstream stage. (Histograms of workflows running in both stages are summed.)
+if [[ "$SCRIPT_UPSTREAM" && $ExitCode -eq 0 && -f "$DirDerived/AnalysisResults.root" ]]; then
+  hadd -a AnalysisResults.root "$DirDerived/AnalysisResults.root" >> "$LOGFILE" 2>&1 || ExitCode=1
+fi
+
 # Show warnings and errors in the log file.
 grep -e "\\[WARN\\]" -e "\\[ERROR\\]" -e "\\[FATAL\\]" -e "segmentation" -e "Segmentation" -e "command not found" -e "Error:" -e "Error in " -e "Warning in " "$LOGFILE" | sort -u
 
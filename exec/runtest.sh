@@ -42,7 +42,40 @@ USEALIEVCUTS=0                  # Use AliEventCuts in AliPhysics (as used by con
 NCORES=$(nproc)                 # Ideal number of used cores
 NCORESPERJOB_ALI=1              # Average number of cores used by one AliPhysics job
 NCORESPERJOB_O2=1.6             # Average number of cores used by one O2 job
-NJOBSPARALLEL_O2=$(nproc)       # Maximum number of simultaneously running O2 jobs
+NJOBSPARALLEL_O2=$(nproc)       # Maximum number of simultaneously running O2 jobs (started only if there is enough free memory)
+PIPELINE_CONVERT_O2=0           # Start O2 jobs as soon as their input files are converted. (Conversion and O2 jobs share NCORES. AliPhysics tasks run after O2 tasks.)
+CONCURRENT_ALI_O2=0             # Run AliPhysics and O2 tasks at the same time. (AliPhysics and O2 jobs share NCORES.)
+BENCHMARK_O2=0                  # Run O2 jobs for each combination of the settings below instead of running them once, and write the fastest settings with correct output in benchmark_o2_best.sh. (Option -b)
+BENCHMARK_NFILESPERJOB_O2="1 4 16"  # Numbers of input files per O2 job to benchmark
+BENCHMARK_NJOBSPARALLEL_O2="$(( ($(nproc) + 3) / 4 )) $(( ($(nproc) + 1) / 2 )) $(nproc)"  # Maximum numbers of simultaneously running O2 jobs to benchmark
+BENCHMARK_NCORESPERJOB_O2="1.6" # Numbers of cores per O2 job to benchmark
+FILE_TRACE=""                   # Record a timeline of the steps and jobs in $FILE_TRACE.json (Chrome/Perfetto trace) and $FILE_TRACE.csv. ("" = no tracing)
+NFILESPERMERGE=8                # Number of files merged together in partial merges of job outputs
+NJOBSPARALLEL_MERGE=2           # Maximum number of simultaneously running partial merges
+ABORT_ON_FATAL=""               # Abort jobs as soon as a fatal error appears in a job log. ("" = never, "job" = only the job, "batch" = all jobs)
+CACHE_JOBS=0                    # Reuse results of unchanged jobs from previous runs. (Jobs are identified by their inputs, configuration and software builds.)
+DIR_CACHE_JOBS="${XDG_CACHE_HOME:-$HOME/.cache}/run3analysisvalidation/jobs" # Directory of the cache of job results
+CACHE_JOBS_SIZE=100             # Maximum size of the cache of job results [GB]
+CACHE_JOBS_AGE=30               # Maximum age of unused job results in the cache [days]
+DIR_DERIVED_O2="derived_o2"     # Directory of derived AO2D.root files of the upstream stage of the staged O2 mode, reused by next runs with the same upstream configuration and input files (not deleted by cleaning)
+DERIVED_O2_SIZE=50              # Maximum size of the directory of derived AO2D.root files [GB] (least recently used files are evicted, 0 = unlimited)
+DERIVED_O2_AGE=7                # Maximum age of unused derived AO2D.root files [days] (0 = unlimited)
+CACHE_AO2D=0                    # Reuse AO2D.root files converted from unchanged AliESDs.root files with the same conversion settings and AliPhysics version. (Independent of CACHE_JOBS, one input file per conversion job)
+DIR_CACHE_AO2D="cache_ao2d"     # Directory of the cache of converted AO2D.root files (next to the output directory by default to hard-link files instead of copying them, not deleted by cleaning)
+CACHE_AO2D_SIZE=200             # Maximum size of the cache of converted AO2D.root files [GB] (least recently used files are evicted)
+DIR_CACHE_JSON="${XDG_CACHE_HOME:-$HOME/.cache}/run3analysisvalidation/json" # Directory of the cache of adjusted JSON files ("" = no cache)
+DIR_CATALOGUE="${XDG_CACHE_HOME:-$HOME/.cache}/run3analysisvalidation/catalogue" # Directory of catalogues of input directories ("" = scan input directories every time)
+EXECUTOR="local"                # Backend running jobs: "local" (processes on this machine), "slurm" or "condor" (array jobs on a batch system with a file system shared with this machine, outputs merged here), "fake" (array tasks run as local processes, for testing)
+FILE_SUBMIT_OPTIONS=""          # File with additional lines of the submit files of array jobs (e.g. "--partition=short" for Slurm, '+JobFlavour = "workday"' for HTCondor) ("" = none)
+AFFINITY_O2=0                   # Pin each O2 job slot to a disjoint set of CPUs, within one NUMA node if possible. (Utilisation of slots is reported in the O2 log.)
+DIR_STAGE=""                    # Local directory (e.g. node-local scratch or tmpfs) to copy input files of O2 jobs to before they start ("" = read input files in place)
+NJOBSSTAGE_O2=2                 # Number of queued O2 jobs whose input files are copied in advance
+NCOPIESPARALLEL=2               # Maximum number of simultaneous copies of input files
+NJOBSSPLIT_O2=0                 # Number of smaller jobs in which a failed O2 job is split and retried, down to single input files. (0 = no retries) The O2 step fails if input files fail alone.
+CHECK_OUTPUT_O2=0               # Check that the output of each O2 job contains the top-level directories of the output of the first successful job, so that incomplete jobs fail. (Enabled with NJOBSSPLIT_O2 > 1 to retry incomplete jobs.)
+CHECK_EVENTS_O2=""              # Histogram ("<path>[:<bin>]") with the number of events processed by an O2 job to compare with the number of input collisions ("" = no comparison)
+FILE_QUARANTINE=""               # List of O2 input files that failed alone in O2 jobs. They are excluded in next runs of the same input case. (Only with INPUT_IS_O2=1 and NJOBSSPLIT_O2 > 1, "" = no quarantine, e.g. "${XDG_CACHE_HOME:-$HOME/.cache}/run3analysisvalidation/quarantine.txt")
+QUARANTINE_AGE=7                # Number of days after which input files in the quarantine are tried again (e.g. with a new software version). (0 = never)
 
 # This directory
 DIR_EXEC="$(dirname "$(realpath "$0")")"
@@ -65,6 +98,7 @@ ENV_POST="alienv setenv ROOT/latest -c"
 
 # Step scripts
 SCRIPT_O2="script_o2.sh"
+SCRIPT_O2_UPSTREAM="" # upstream stage of the staged O2 mode (set by MakeScriptO2)
 SCRIPT_ALI="script_ali.sh"
 SCRIPT_POSTPROCESS="script_postprocess.sh"
 
@@ -72,8 +106,8 @@ SCRIPT_POSTPROCESS="script_postprocess.sh"
 source "$DIR_EXEC/utilities.sh" || { echo "Error: Failed to load utilities."; exit 1; }
 
 # Parse command line options.
-function Help { echo "Usage: bash [<path>/]$(basename "$0") [-h] [-i <input config>] [-t <task config>] [-d]"; }
-while getopts ":hi:t:d" opt; do
+function Help { echo "Usage: bash [<path>/]$(basename "$0") [-h] [-i <input config>] [-t <task config>] [-d] [-b]"; }
+while getopts ":hi:t:db" opt; do
   case ${opt} in
     h)
       Help; exit 0;;
@@ -83,6 +117,8 @@ while getopts ":hi:t:d" opt; do
       CONFIG_TASKS="$OPTARG";;
     d)
       DEBUG=1;;
+    b)
+      BENCHMARK_O2=1;;
     \?)
       MsgErr "Invalid option: $OPTARG" 1>&2; Help; exit 1;;
     :)
@@ -97,6 +133,63 @@ source "$CONFIG_INPUT" || ErrExit "Failed to load input specification."
 source "$CONFIG_TASKS" || ErrExit "Failed to load tasks configuration."
 DIR_TASKS="$(dirname "$(realpath "$CONFIG_TASKS")")"
 
+# Benchmark O2 jobs alone and without reusing cached results.
+[ "$BENCHMARK_O2" -eq 1 ] && { CACHE_JOBS=0; PIPELINE_CONVERT_O2=0; CONCURRENT_ALI_O2=0; DOPOSTPROCESS=0; }
+
+# Options of the job runner
+OPT_JOBS="--merge-fan-in $NFILESPERMERGE --merge-workers $NJOBSPARALLEL_MERGE"
+[ "$ABORT_ON_FATAL" ] && OPT_JOBS+=" --abort $ABORT_ON_FATAL"
+[ "$NJOBSSPLIT_O2" -gt 1 ] && CHECK_OUTPUT_O2=1
+[ "$EXECUTOR" != "local" ] && OPT_JOBS+=" --executor $EXECUTOR"
+[ "$FILE_SUBMIT_OPTIONS" ] && OPT_JOBS+=" --submit-options $(realpath "$FILE_SUBMIT_OPTIONS")"
+OPT_CACHE_JOBS=""  # cache of the results of AliPhysics and O2 jobs
+[ "$CACHE_JOBS" -eq 1 ] && OPT_CACHE_JOBS=" --cache $DIR_CACHE_JOBS --cache-size $CACHE_JOBS_SIZE --cache-age $CACHE_JOBS_AGE"
+OPT_CACHE_AO2D=""  # cache of the results of conversion jobs
+[ "$CACHE_AO2D" -eq 1 ] && OPT_CACHE_AO2D=" --cache $(realpath -m "$DIR_CACHE_AO2D") --cache-size $CACHE_AO2D_SIZE"
+
+# Timeline trace
+FILE_TRACE_EVENTS=""  # events recorded by this script and by the job runners
+TRACE_STEP=""         # current step
+[ "$FILE_TRACE" ] && {
+  FILE_TRACE="$(realpath -m "$FILE_TRACE")"
+  FILE_TRACE_EVENTS="$FILE_TRACE.jsonl"
+  rm -f "$FILE_TRACE_EVENTS" || ErrExit "Failed to rm $FILE_TRACE_EVENTS."
+  OPT_JOBS+=" --trace $FILE_TRACE_EVENTS"
+}
+# End the current step and begin a new one (if given).
+function TraceStep {
+  [ "$FILE_TRACE_EVENTS" ] || return 0
+  [ "$TRACE_STEP" ] && python3 "$DIR_EXEC/timeline.py" event "$FILE_TRACE_EVENTS" end "$TRACE_STEP" ${2:+-e "$2"}
+  TRACE_STEP="$1"
+  [ "$TRACE_STEP" ] && python3 "$DIR_EXEC/timeline.py" event "$FILE_TRACE_EVENTS" begin "$TRACE_STEP"
+  return 0
+}
+# End the current step and write the trace.
+function TraceEnd {
+  [ "$FILE_TRACE_EVENTS" ] || return 0
+  TraceStep "" "$1"
+  python3 "$DIR_EXEC/timeline.py" write "$FILE_TRACE_EVENTS" "$FILE_TRACE" || MsgWarn "Failed to write the trace."
+  return 0
+}
+
+# Steps running at the same time
+[[ $DOCONVERT -eq 1 && $DOO2 -eq 1 ]] || PIPELINE_CONVERT_O2=0
+[[ $DOALI -eq 1 && $DOO2 -eq 1 ]] || CONCURRENT_ALI_O2=0
+PID_CONVERT=""  # process running the conversion jobs in the pipelined mode
+PID_ALI=""      # process running the AliPhysics jobs in the concurrent mode
+FILE_CORE_POOL="${TMPDIR:-/tmp}/run3analysisvalidation_cores_$$.json"  # pool of cores shared by the steps running at the same time
+OPT_POOL="--core-pool $FILE_CORE_POOL --cores $NCORES"
+OPT_JOBS_O2="$OPT_JOBS$OPT_CACHE_JOBS --split-parts $NJOBSSPLIT_O2"
+# The quarantine is scoped by the input directory and the input file pattern.
+OPT_QUARANTINE="--quarantine-scope $(realpath -m "$INPUT_DIR")/$INPUT_FILES --quarantine-age $QUARANTINE_AGE"
+[[ $INPUT_IS_O2 -eq 1 && "$FILE_QUARANTINE" ]] && OPT_JOBS_O2+=" --quarantine $FILE_QUARANTINE $OPT_QUARANTINE"
+[ "$AFFINITY_O2" -eq 1 ] && OPT_JOBS_O2+=" --affinity"
+[ "$EXECUTOR" != "local" ] && OPT_JOBS_O2+=" --cores-job $NCORESPERJOB_O2"
+[ "$DIR_STAGE" ] && OPT_JOBS_O2+=" --stage $DIR_STAGE --stage-ahead $NJOBSSTAGE_O2 --stage-workers $NCOPIESPARALLEL"
+[[ $PIPELINE_CONVERT_O2 -eq 1 || $CONCURRENT_ALI_O2 -eq 1 ]] && OPT_JOBS_O2+=" $OPT_POOL --cores-job $NCORESPERJOB_O2"
+# Stop the steps running in the background and delete the pool when exiting.
+trap 'ExitCode=$?; for Pid in $PID_CONVERT $PID_ALI; do kill -- -"$Pid" 2> /dev/null; done; rm -f "$FILE_CORE_POOL" "$FILE_CORE_POOL.lock"; TraceEnd $ExitCode' EXIT
+
 ########## END OF CONFIGURATION ##########
 
 ####################################################################################################
@@ -111,20 +204,29 @@ MsgStep "Processing case $INPUT_CASE: $INPUT_LABEL"
 # Clean before running.
 if [ $DOCLEAN -eq 1 ]; then
   MsgStep "Cleaning..."
+  TraceStep "clean"
   Clean 1 || ErrExit "Clean failed."
 fi
 
 # Generate list of input files.
 MsgStep "Generating list of input files..."
+TraceStep "input list"
 [ $INPUT_IS_O2 -eq 1 ] && LISTFILES="$LISTFILES_O2" || LISTFILES="$LISTFILES_ALI"
+LISTFILES_INFO="${LISTFILES/.txt/_info.txt}" # sizes and numbers of events of input files (used by the job planner)
+rm -f "${LISTFILES_ALI/.txt/_info.txt}" "${LISTFILES_O2/.txt/_info.txt}" || ErrExit "Failed to delete lists of input files."
 INPUT_DIR="$(realpath "$INPUT_DIR")"
 [ $DEBUG -eq 1 ] && { echo "Searching for $INPUT_FILES in $INPUT_DIR"; }
-find "$INPUT_DIR" -name "$INPUT_FILES" | sort | head -n $NFILESMAX > "$LISTFILES"
-[[ ${PIPESTATUS[0]} -eq 0 || ${PIPESTATUS[0]} -eq 141 ]] || ErrExit "Failed to make a list of input files."
+OPT_CATALOGUE="-n $NFILESMAX -i $LISTFILES_INFO"
+[ "$DIR_CATALOGUE" ] && OPT_CATALOGUE+=" -c $DIR_CATALOGUE"
+[[ $INPUT_IS_O2 -eq 1 && "$FILE_QUARANTINE" ]] && OPT_CATALOGUE+=" -q $FILE_QUARANTINE $OPT_QUARANTINE"
+[ $DEBUG -eq 1 ] && OPT_CATALOGUE+=" -d"
+# shellcheck disable=SC2086 # Ignore unquoted options.
+python3 "$DIR_EXEC/file_catalogue.py" "$INPUT_DIR" "$INPUT_FILES" "$LISTFILES" $OPT_CATALOGUE || ErrExit "Failed to make a list of input files."
 [ "$(wc -l < "$LISTFILES")" -eq 0 ] && { ErrExit "No input files!"; }
 
 # Modify the JSON file.
 MsgStep "Modifying JSON file..."
+TraceStep "JSON"
 CheckFile "$JSON"
 AdjustJson || ErrExit "AdjustJson failed."
 CheckFile "$JSON"
@@ -135,32 +237,55 @@ if [ $DOCONVERT -eq 1 ]; then
   NFILES=$(wc -l < "$LISTFILES_ALI")
   [ "$NFILES" -eq 0 ] && { ErrExit "No input conversion files!"; }
   NFILESPERJOB_CONVERT=$(python3 -c "n = $NFILESPERJOB_CONVERT; print(n if n > 0 else max(1, round($NFILES * $NCORESPERJOB_ALI / $NCORES)))")
+  # Cached conversion results are identified by the input files of the jobs. Convert each file in its own job
+  # so that the cache entries do not depend on the grouping of files (number of files and cores).
+  [ "$CACHE_AO2D" -eq 1 ] && NFILESPERJOB_CONVERT=1
   MsgStep "Converting... ($NFILES files)"
+  TraceStep "conversion"
   [ $INPUT_IS_MC -eq 1 ] && MsgWarn "Using MC mode"
   [ $DEBUG -eq 1 ] && echo "Loading AliPhysics..."
   # Run the batch script in the ALI environment.
   [ "$O2_ROOT" ] && { MsgWarn "O2 environment is loaded - expect errors!"; }
   [ "$ALICE_PHYSICS" ] && { MsgWarn "AliPhysics environment is already loaded."; ENV_ALI=""; }
-  $ENV_ALI bash "$DIR_EXEC/batch_convert.sh" "$LISTFILES_ALI" "$LISTFILES_O2" $INPUT_IS_MC $USEALIEVCUTS $DEBUG "$NFILESPERJOB_CONVERT" || exit 1
+  if [ $PIPELINE_CONVERT_O2 -eq 1 ]; then
+    # Run the conversion in the background (in a new process group) and wait for the list of output files.
+    rm -f "$LISTFILES_O2" || ErrExit "Failed to rm $LISTFILES_O2."
+    setsid $ENV_ALI bash "$DIR_EXEC/batch_convert.sh" "$LISTFILES_ALI" "$LISTFILES_O2" $INPUT_IS_MC $USEALIEVCUTS $DEBUG "$NFILESPERJOB_CONVERT" "$OPT_JOBS$OPT_CACHE_AO2D $OPT_POOL --cores-job $NCORESPERJOB_ALI" &
+    PID_CONVERT=$!
+    until [ -f "$LISTFILES_O2" ]; do
+      kill -0 "$PID_CONVERT" 2> /dev/null || [ -f "$LISTFILES_O2" ] || { wait "$PID_CONVERT"; PID_CONVERT=""; exit 1; }
+      sleep 1
+    done
+  else
+    $ENV_ALI bash "$DIR_EXEC/batch_convert.sh" "$LISTFILES_ALI" "$LISTFILES_O2" $INPUT_IS_MC $USEALIEVCUTS $DEBUG "$NFILESPERJOB_CONVERT" "$OPT_JOBS$OPT_CACHE_AO2D" || exit 1
+  fi
 fi
 
 # Run AliPhysics tasks.
-if [ $DOALI -eq 1 ]; then
+function RunAli {
   CheckFile "$LISTFILES_ALI"
   NFILES=$(wc -l < "$LISTFILES_ALI")
   [ "$NFILES" -eq 0 ] && { ErrExit "No input AliPhysics files!"; }
   NFILESPERJOB_ALI=$(python3 -c "n = $NFILESPERJOB_ALI; print(n if n > 0 else max(1, round($NFILES * $NCORESPERJOB_ALI / $NCORES)))")
   MsgStep "Running AliPhysics tasks... ($NFILES files)"
-  rm -f "$FILEOUT" "$FILEOUT_ALI" || ErrExit "Failed to rm $FILEOUT $FILEOUT_ALI."
+  TraceStep "AliPhysics"
+  rm -f "$FILEOUT_ALI" || ErrExit "Failed to rm $FILEOUT_ALI."
   MakeScriptAli || ErrExit "MakeScriptAli failed."
   CheckFile "$SCRIPT_ALI"
   [ $DEBUG -eq 1 ] && echo "Loading AliPhysics..."
   # Run the batch script in the ALI environment.
   [ "$O2_ROOT" ] && { MsgWarn "O2 environment is loaded - expect errors!"; }
   [ "$ALICE_PHYSICS" ] && { MsgWarn "AliPhysics environment is already loaded."; ENV_ALI=""; }
-  $ENV_ALI bash "$DIR_EXEC/batch_ali.sh" "$LISTFILES_ALI" "$JSON" "$SCRIPT_ALI" $DEBUG "$NFILESPERJOB_ALI" || exit 1
-  mv "$FILEOUT" "$FILEOUT_ALI" || ErrExit "Failed to mv $FILEOUT $FILEOUT_ALI."
-fi
+  if [ $CONCURRENT_ALI_O2 -eq 1 ]; then
+    # Run the AliPhysics jobs in the background (in a new process group) while the O2 jobs are running.
+    setsid $ENV_ALI bash "$DIR_EXEC/batch_ali.sh" "$LISTFILES_ALI" "$JSON" "$SCRIPT_ALI" $DEBUG "$NFILESPERJOB_ALI" "$OPT_JOBS$OPT_CACHE_JOBS $OPT_POOL --cores-job $NCORESPERJOB_ALI" "$FILEOUT_ALI" &
+    PID_ALI=$!
+  else
+    $ENV_ALI bash "$DIR_EXEC/batch_ali.sh" "$LISTFILES_ALI" "$JSON" "$SCRIPT_ALI" $DEBUG "$NFILESPERJOB_ALI" "$OPT_JOBS$OPT_CACHE_JOBS" "$FILEOUT_ALI" || exit 1
+  fi
+}
+# In the pipelined mode, run them after the O2 tasks so that O2 jobs do not wait for them (unless they run concurrently).
+[[ $DOALI -eq 1 && ($PIPELINE_CONVERT_O2 -eq 0 || $CONCURRENT_ALI_O2 -eq 1) ]] && RunAli
 
 # Run O2 tasks.
 if [ $DOO2 -eq 1 ]; then
@@ -169,6 +294,7 @@ if [ $DOO2 -eq 1 ]; then
   [ "$NFILES" -eq 0 ] && { ErrExit "No input O2 files!"; }
   NFILESPERJOB_O2=$(python3 -c "n = $NFILESPERJOB_O2; print(n if n > 0 else min(16, max(1, round($NFILES * $NCORESPERJOB_O2 / $NCORES))))") # FIXME: Jobs with more than 16 files per job lose data.
   MsgStep "Running O2 tasks... ($NFILES files)"
+  TraceStep "O2"
   rm -f "$FILEOUT" "$FILEOUT_O2" || ErrExit "Failed to rm $FILEOUT $FILEOUT_O2."
   MakeScriptO2 || ErrExit "MakeScriptO2 failed."
   CheckFile "$SCRIPT_O2"
@@ -177,15 +303,41 @@ if [ $DOO2 -eq 1 ]; then
   # Run the batch script in the O2 environment.
   [ "$ALICE_PHYSICS" ] && { MsgWarn "AliPhysics environment is loaded - expect errors!"; }
   [ "$O2_ROOT" ] && { MsgWarn "O2 environment is already loaded."; ENV_O2=""; }
-  $ENV_O2 bash "$DIR_EXEC/batch_o2.sh" "$LISTFILES_O2" "$JSON" "$SCRIPT_O2" $DEBUG "$NFILESPERJOB_O2" "$FILEOUT_TREES" "$NJOBSPARALLEL_O2" || exit 1
-  mv "$FILEOUT" "$FILEOUT_O2" || ErrExit "Failed to mv $FILEOUT $FILEOUT_O2."
-  [[ $SAVETREES -eq 1 && "$FILEOUT_TREES" ]] && { mv "$FILEOUT_TREES" "$FILEOUT_TREES_O2" || ErrExit "Failed to mv $FILEOUT_TREES $FILEOUT_TREES_O2."; }
+  if [ $BENCHMARK_O2 -eq 1 ]; then
+    MsgStep "Benchmarking O2 jobs..."
+    OPT_BENCHMARK="-f $BENCHMARK_NFILESPERJOB_O2 -j $BENCHMARK_NJOBSPARALLEL_O2 -c $BENCHMARK_NCORESPERJOB_O2 --cores $NCORES"
+    [ "$SCRIPT_O2_UPSTREAM" ] && OPT_BENCHMARK+=" -u $SCRIPT_O2_UPSTREAM"
+    [ $DEBUG -eq 1 ] && OPT_BENCHMARK+=" -d"
+    # shellcheck disable=SC2086 # Ignore unquoted options.
+    $ENV_O2 python3 "$DIR_EXEC/benchmark_o2.py" "$LISTFILES_O2" "$JSON" "$SCRIPT_O2" $OPT_BENCHMARK --opt-jobs="$OPT_JOBS_O2" || exit 1
+  elif [ $PIPELINE_CONVERT_O2 -eq 1 ]; then
+    $ENV_O2 bash "$DIR_EXEC/batch_o2.sh" "$LISTFILES_O2" "$JSON" "$SCRIPT_O2" $DEBUG "$NFILESPERJOB_O2" "$FILEOUT_TREES" "$NJOBSPARALLEL_O2" "$SCRIPT_O2_UPSTREAM" "$OPT_JOBS_O2" "$PID_CONVERT" "$CHECK_EVENTS_O2" "$DIR_DERIVED_O2" "$CHECK_OUTPUT_O2" || exit 1
+    # Check the result of the conversion.
+    wait "$PID_CONVERT" || { PID_CONVERT=""; exit 1; }
+    PID_CONVERT=""
+  else
+    $ENV_O2 bash "$DIR_EXEC/batch_o2.sh" "$LISTFILES_O2" "$JSON" "$SCRIPT_O2" $DEBUG "$NFILESPERJOB_O2" "$FILEOUT_TREES" "$NJOBSPARALLEL_O2" "$SCRIPT_O2_UPSTREAM" "$OPT_JOBS_O2" "" "$CHECK_EVENTS_O2" "$DIR_DERIVED_O2" "$CHECK_OUTPUT_O2" || exit 1
+  fi
+  # Delete old and least recently used derived AO2Ds of the staged mode.
+  [[ "$SCRIPT_O2_UPSTREAM" && $BENCHMARK_O2 -eq 0 ]] && { python3 "$DIR_EXEC/job_cache.py" "$DIR_DERIVED_O2" -s "$DERIVED_O2_SIZE" -a "$DERIVED_O2_AGE" || MsgWarn "Failed to evict derived AO2Ds."; }
+  [ $BENCHMARK_O2 -eq 1 ] || { mv "$FILEOUT" "$FILEOUT_O2" || ErrExit "Failed to mv $FILEOUT $FILEOUT_O2."; }
+  [[ $BENCHMARK_O2 -eq 0 && $SAVETREES -eq 1 && "$FILEOUT_TREES" ]] && { mv "$FILEOUT_TREES" "$FILEOUT_TREES_O2" || ErrExit "Failed to mv $FILEOUT_TREES $FILEOUT_TREES_O2."; }
+fi
+
+[[ $DOALI -eq 1 && $PIPELINE_CONVERT_O2 -eq 1 && $CONCURRENT_ALI_O2 -eq 0 ]] && RunAli
+
+# Wait for the AliPhysics tasks running concurrently.
+if [ "$PID_ALI" ]; then
+  TraceStep "waiting for AliPhysics"
+  wait "$PID_ALI" || { PID_ALI=""; exit 1; }
+  PID_ALI=""
 fi
 
 # Run output postprocessing. (Compare AliPhysics and O2 output.)
 if [ $DOPOSTPROCESS -eq 1 ]; then
   LogFile="log_postprocess.log"
   MsgStep "Postprocessing... (logfile: $LogFile)"
+  TraceStep "postprocessing"
   MakeScriptPostprocess || ErrExit "MakeScriptPostprocess failed."
   CheckFile "$SCRIPT_POSTPROCESS"
   [ $DEBUG -eq 1 ] && echo "Loading ROOT..."
@@ -200,7 +352,9 @@ fi
 # Clean after running.
 if [ $DOCLEAN -eq 1 ]; then
   MsgStep "Cleaning..."
+  TraceStep "clean"
   Clean 2 || ErrExit "Clean failed."
+  rm -f "$LISTFILES_INFO" || ErrExit "Failed to rm $LISTFILES_INFO."
 fi
 
 MsgStep "Done"
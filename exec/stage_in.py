@@ -0,0 +1,141 @@
+"""
+Stage-in of job input files to local storage
+
+Input files of queued jobs are copied to a local directory (e.g. node-local scratch or tmpfs) a given number of jobs
+ahead of their execution by a given number of parallel copies, so that jobs do not read from a slow shared file system
+while competing with each other.
+When a job starts, its input list is rewritten to the local copies.
+When the job finishes, the copies are deleted and the original input list is restored.
+If a copy fails, the job reads the original files.
+"""
+
+import os
+import shutil
+import subprocess as sp  # nosec B404
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from utilities import eprint, msg_warn
+
+
+@dataclass
+class StagedJob:
+    """Input files of a job copied to local storage"""
+
+    files: List[str]  # original input files
+    copies: Dict[str, str] = field(default_factory=dict)  # local copies of copied files
+    pending: List[str] = field(default_factory=list)  # files waiting to be copied
+    n_copying: int = 0  # number of running copies
+    failed: bool = False  # a copy failed
+    started: bool = False  # job started with the local copies
+
+
+@dataclass
+class Copy:
+    """Running copy of a file"""
+
+    index: int  # job index
+    path_src: str  # original file
+    path_dest: str  # local copy
+    process: sp.Popen
+
+
+@dataclass
+class Stager:
+    """Copies input files of queued jobs to local storage"""
+
+    dir_stage: str  # directory with local copies
+    list_input: str  # job input list with "{}" replaced by the job index
+    n_ahead: int = 2  # maximum number of jobs staged ahead of execution
+    n_workers: int = 2  # maximum number of parallel copies
+    debug: bool = False
+    jobs: Dict[int, StagedJob] = field(default_factory=dict)  # staged jobs by index
+    copies: List[Copy] = field(default_factory=list)  # running copies
+
+    def get_path_list(self, index: int) -> str:
+        """Get the input list of a job."""
+        return self.list_input.replace("{}", str(index))
+
+    def add(self, index: int):
+        """Start staging the input files of a job."""
+        with open(self.get_path_list(index), "r") as file:
+            files = [line.strip() for line in file if line.strip()]
+        self.jobs[index] = StagedJob(files, pending=list(files))
+
+    def finish(self, copy: Copy):
+        """Process a finished copy."""
+        self.copies.remove(copy)
+        job = self.jobs.get(copy.index)
+        if copy.process.returncode != 0 or job is None:
+            if job:
+                msg_warn("Failed to copy %s. Job %d reads the original files." % (copy.path_src, copy.index))
+                job.failed = True
+                job.n_copying -= 1
+            shutil.rmtree(os.path.dirname(copy.path_dest), ignore_errors=True)
+            return
+        os.replace(copy.path_dest + ".tmp", copy.path_dest)
+        job.copies[copy.path_src] = copy.path_dest
+        job.n_copying -= 1
+        if self.debug and not job.pending and not job.n_copying:
+            eprint("Staged %d input files of job %d" % (len(job.files), copy.index))
+
+    def update(self, indices: List[int]):
+        """Process finished copies and stage the input files of the first queued jobs (ready to be started)."""
+        for copy in list(self.copies):
+            if copy.process.poll() is not None:
+                self.finish(copy)
+        n_staged = sum(1 for job in self.jobs.values() if not job.started)
+        for index in indices:
+            if n_staged >= self.n_ahead:
+                break
+            if index not in self.jobs:
+                self.add(index)
+                n_staged += 1
+        for index, job in self.jobs.items():
+            while job.pending and not job.failed and len(self.copies) < self.n_workers:
+                path_src = job.pending.pop(0)
+                i_file = len(job.files) - len(job.pending) - 1
+                path_dest = os.path.join(self.dir_stage, str(index), str(i_file), os.path.basename(path_src))
+                os.makedirs(os.path.dirname(path_dest), exist_ok=True)
+                process = sp.Popen(  # pylint: disable=consider-using-with # nosec B603 B607
+                    ["cp", path_src, path_dest + ".tmp"], stdout=sp.DEVNULL, stderr=sp.DEVNULL
+                )
+                self.copies.append(Copy(index, path_src, path_dest, process))
+                job.n_copying += 1
+
+    def is_ready(self, index: int) -> bool:
+        """Check whether the input files of a job are staged (or failed to be staged)."""
+        job = self.jobs.get(index)
+        return job is not None and not job.n_copying and (job.failed or not job.pending)
+
+    def start(self, index: int):
+        """Rewrite the input list of a starting job to the local copies."""
+        job: Optional[StagedJob] = self.jobs.get(index)
+        if job is None:
+            return
+        job.started = True
+        if job.failed:
+            return
+        with open(self.get_path_list(index), "w") as file:
+            for path in job.files:
+                file.write(job.copies[path] + "\n")
+
+    def evict(self, index: int):
+        """Delete the local copies of a job and restore its input list."""
+        job = self.jobs.pop(index, None)
+        if job is None:
+            return
+        for copy in [c for c in self.copies if c.index == index]:
+            copy.process.kill()
+        if job.started and not job.failed:
+            with open(self.get_path_list(index), "w") as file:
+                for path in job.files:
+                    file.write(path + "\n")
+        shutil.rmtree(os.path.join(self.dir_stage, str(index)), ignore_errors=True)
+
+    def clean(self):
+        """Stop running copies and delete all local copies."""
+        for copy in self.copies:
+            copy.process.kill()
+            copy.process.wait()
+        shutil.rmtree(self.dir_stage, ignore_errors=True)
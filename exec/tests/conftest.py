@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+DIR_EXEC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, DIR_EXEC)
+
+
+@pytest.fixture
+def fake_hadd(tmp_path, monkeypatch):
+    """hadd replacement concatenating the input files"""
+    dir_bin = tmp_path / "bin"
+    dir_bin.mkdir()
+    path = dir_bin / "hadd"
+    path.write_text('#!/bin/bash\nshift\nout="$1"\nshift\ncat "$@" > "$out"\n')
+    path.chmod(0o755)
+    monkeypatch.setenv("PATH", "%s:%s" % (dir_bin, os.environ.get("PATH", "")))
+    return path
@@ -0,0 +1,63 @@
+import pytest
+from adjust_json import adjust, get_operations, matches
+
+SETTINGS = {"MC": "1", "PERIOD": "LHC22o", "TRIGGER": "0"}
+
+
+@pytest.mark.parametrize(
+    "condition, result",
+    [
+        (None, True),
+        ({"MC": 1}, True),
+        ({"MC": 0}, False),
+        ({"MC": 1, "PERIOD": "LHC22m"}, False),
+        ({"PERIOD": ["LHC22m", "LHC22o"]}, True),
+        ([{"MC": 0}, {"TRIGGER": 0}], True),
+        ([{"MC": 0}, {"TRIGGER": 1}], False),
+    ],
+)
+def test_matches(condition, result):
+    assert matches(condition, SETTINGS) is result
+
+
+def test_matches_missing_setting():
+    with pytest.raises(SystemExit):
+        matches({"RUN": 3}, SETTINGS)
+
+
+@pytest.fixture
+def rules():
+    return [
+        {"when": {"MC": 1}, "replace": {"processMC": ["false", "true"]}},
+        {"when": {"MC": 1}, "unless": {"PERIOD": "LHC22o"}, "replace": {"processMC": ["true", "false"]}},
+        {"replace": {"period": ["", "{PERIOD}"]}},
+        {"when": {"TRIGGER": 1}, "rename": {"trigger": "triggerOld"}},
+        {"when": {"TRIGGER": 0}, "rename": {"selection": "selectionOld"}},
+    ]
+
+
+def test_get_operations(rules):
+    replacements, renaming = get_operations(rules, SETTINGS)
+
+    assert replacements == {"processMC": [("false", "true")], "period": [("", "LHC22o")]}
+    assert renaming == {"selection": "selectionOld"}
+
+
+def test_adjust(rules):
+    config = {
+        "task-a": {"processMC": "false", "period": "", "selection": "1"},
+        "task-b": {"nested": [{"processMC": "false"}], "processMC": "true", "period": "LHC22m"},
+    }
+    replacements, renaming = get_operations(rules, SETTINGS)
+
+    assert adjust(config, replacements, renaming) == {
+        "task-a": {"processMC": "true", "period": "LHC22o", "selectionOld": "1"},
+        "task-b": {"nested": [{"processMC": "true"}], "processMC": "true", "period": "LHC22m"},
+    }
+
+
+def test_replacements_in_order():
+    rules = [{"replace": {"value": ["a", "b"]}}, {"replace": {"value": ["b", "c"]}}]
+    replacements, renaming = get_operations(rules, SETTINGS)
+
+    assert adjust({"task": {"value": "a"}}, replacements, renaming) == {"task": {"value": "c"}}
@@ -0,0 +1,24 @@
+import pytest
+from file_catalogue import select
+
+FILES = ["a", "b", "c", "d"]
+
+
+@pytest.mark.parametrize(
+    "n_files_max, selected",
+    [
+        ("2", ["a", "b"]),
+        ("10", FILES),
+        ("0", []),
+        ("-1", ["a", "b", "c"]),
+        ("-0", FILES),
+        ("-10", []),
+    ],
+)
+def test_select(n_files_max, selected):
+    assert select(FILES, n_files_max) == selected
+
+
+def test_select_invalid():
+    with pytest.raises(SystemExit):
+        select(FILES, "all")
@@ -0,0 +1,92 @@
+import os
+import time
+
+import pytest
+from job_cache import FILE_DONE, JobCache, evict
+
+
+@pytest.fixture
+def jobs(tmp_path):
+    """Two jobs with one input file each and a configuration file"""
+    path_config = tmp_path / "config.json"
+    path_config.write_text("{}")
+    for index in range(2):
+        dir_job = tmp_path / str(index)
+        dir_job.mkdir()
+        path_input = tmp_path / ("input_%d.root" % index)
+        path_input.write_text("input %d" % index)
+        (dir_job / "input.txt").write_text("%s\n" % path_input)
+        (dir_job / "output.root").write_text("output %d" % index)
+    return tmp_path
+
+
+def make_cache(dir_jobs, command="run {}"):
+    return JobCache(
+        str(dir_jobs / "cache"),
+        command,
+        [str(dir_jobs / "config.json")],
+        str(dir_jobs / "{}" / "input.txt"),
+        [str(dir_jobs / "{}" / "output.root")],
+    )
+
+
+def test_keys(jobs):
+    cache = make_cache(jobs)
+    key_0 = cache.get_key(0)
+
+    assert key_0 != cache.get_key(1)
+    assert key_0 == make_cache(jobs).get_key(0)
+    assert key_0 != make_cache(jobs, "run --option {}").get_key(0)
+
+    (jobs / "config.json").write_text('{"option": 1}')
+    assert key_0 != make_cache(jobs).get_key(0)
+
+
+def test_key_input_modified(jobs):
+    key = make_cache(jobs).get_key(0)
+    path_input = jobs / "input_0.root"
+    stat = path_input.stat()
+    os.utime(path_input, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    assert make_cache(jobs).get_key(0) != key
+
+
+def test_store_restore(jobs):
+    cache = make_cache(jobs)
+    assert not cache.restore(0)
+    assert cache.store(0)
+    assert os.path.isfile(os.path.join(cache.get_dir_entry(0), FILE_DONE))
+
+    (jobs / "0" / "output.root").unlink()
+    assert make_cache(jobs).restore(0)
+    assert (jobs / "0" / "output.root").read_text() == "output 0"
+    assert not make_cache(jobs).restore(1)
+
+
+def make_entry(path, key, size, age):
+    dir_entry = path / key[:2] / key
+    dir_entry.mkdir(parents=True)
+    (dir_entry / "output.root").write_bytes(b"x" * size)
+    time_used = time.time() - age
+    os.utime(dir_entry, (time_used, time_used))
+    return dir_entry
+
+
+def test_evict_age(tmp_path):
+    entry_new = make_entry(tmp_path, "aa01", 10, 0)
+    entry_old = make_entry(tmp_path, "bb01", 10, 3 * 86400)
+
+    assert evict(str(tmp_path), age_max=86400) == (1, 1)
+    assert entry_new.exists()
+    assert not entry_old.parent.exists()
+
+
+def test_evict_size(tmp_path):
+    entries = [make_entry(tmp_path, "aa0%d" % i, 100, 100 * i) for i in range(4)]
+
+    assert evict(str(tmp_path), size_max=250) == (2, 2)
+    assert [entry.exists() for entry in entries] == [True, True, False, False]
+
+
+def test_evict_missing(tmp_path):
+    assert evict(str(tmp_path / "missing"), 1, 1) == (0, 0)
@@ -0,0 +1,69 @@
+import pytest
+from make_command_o2 import ConfigError, build_command, resolve_workflows
+
+
+@pytest.fixture
+def workflows():
+    return {
+        "task": {"dependencies": ["producer-b", "producer-a"]},
+        "producer-a": {"dependencies": "base"},
+        "producer-b": {"dependencies": ["base", "producer-a"]},
+        "base": {},
+        "task-mc": {"dependencies": "producer-mc"},
+        "producer-mc": {"requires_mc": True},
+    }
+
+
+@pytest.fixture
+def database(workflows):
+    return {
+        "options": {"global": "", "local": ["-b"]},
+        "workflows": {wf: dict(dic, executable="o2-analysis-" + wf) for wf, dic in workflows.items()},
+    }
+
+
+def test_resolve_order(workflows):
+    assert resolve_workflows(["task"], workflows) == ["base", "producer-a", "producer-b", "task"]
+
+
+def test_resolve_once(workflows):
+    assert resolve_workflows(["producer-a", "task", "base"], workflows) == [
+        "base",
+        "producer-a",
+        "producer-b",
+        "task",
+    ]
+
+
+def test_resolve_exclude_replace(workflows):
+    assert resolve_workflows(["task"], workflows, exclude=["producer-a"]) == ["base", "producer-b", "task"]
+    assert resolve_workflows(["producer-b"], workflows, replace={"producer-a": "base"}) == ["base", "producer-b"]
+
+
+def test_resolve_mc(workflows):
+    assert resolve_workflows(["producer-mc"], workflows) == []
+    assert resolve_workflows(["task-mc"], workflows, mc=True) == ["producer-mc", "task-mc"]
+    with pytest.raises(ConfigError, match="would fail"):
+        resolve_workflows(["task-mc"], workflows)
+
+
+def test_resolve_cycle(workflows):
+    workflows["base"]["dependencies"] = "task"
+
+    with pytest.raises(ConfigError, match="cycle detected: task -> producer-b -> base -> task"):
+        resolve_workflows(["task"], workflows)
+
+
+def test_build_command(database):
+    command = build_command(database, ["task"])
+
+    assert [wf.name for wf in command.workflows] == ["base", "producer-a", "producer-b", "task"]
+    assert str(command).count("o2-analysis-") == 4
+
+
+def test_build_command_errors(database):
+    with pytest.raises(ConfigError, match="Unknown stage"):
+        build_command(database, ["task"], stage="middle")
+    database["workflows"]["base"]["options"] = 1
+    with pytest.raises(ConfigError, match='"options" in base'):
+        build_command(database, ["task"])
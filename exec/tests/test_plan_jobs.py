@@ -0,0 +1,47 @@
+import pytest
+from plan_jobs import get_n_jobs, plan_jobs, plan_jobs_ordered
+
+
+@pytest.mark.parametrize(
+    "n_files, n_files_max, n_slots, n_jobs",
+    [
+        (0, 4, 8, 0),  # no files
+        (10, 4, 0, 3),  # maximum number of files per job
+        (10, 0, 0, 1),  # one job without limits
+        (10, 4, 4, 4),  # rounded up to a full wave
+        (10, 0, 4, 4),  # one full wave without a limit of files
+        (10, 4, 8, 8),  # rounded up to a full wave
+        (3, 1, 8, 3),  # at most one job per file
+    ],
+)
+def test_get_n_jobs(n_files, n_files_max, n_slots, n_jobs):
+    assert get_n_jobs(n_files, n_files_max, n_slots) == n_jobs
+
+
+def test_plan_jobs_balanced():
+    weights = [10, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1]
+    jobs = plan_jobs(weights, 2)
+
+    assert sorted(i for job in jobs for i in job) == list(range(len(weights)))
+    assert jobs == [[0], list(range(1, 11))]
+
+
+def test_plan_jobs_files_max():
+    weights = [5, 4, 3, 2, 1, 1]
+    jobs = plan_jobs(weights, 3, 2)
+
+    assert sorted(i for job in jobs for i in job) == list(range(len(weights)))
+    assert all(len(job) <= 2 for job in jobs)
+    loads = [sum(weights[i] for i in job) for job in jobs]
+    assert loads == sorted(loads, reverse=True)
+    assert max(loads) - min(loads) <= 1
+
+
+def test_plan_jobs_not_enough_jobs():
+    with pytest.raises(SystemExit):
+        plan_jobs([1, 1, 1], 1, 2)
+
+
+def test_plan_jobs_ordered():
+    assert plan_jobs_ordered(5, 2) == [[0, 1], [2, 3, 4]]
+    assert plan_jobs_ordered(5, 0) == []
@@ -0,0 +1,40 @@
+import time
+
+from quarantine import Quarantine
+
+
+def test_scope(tmp_path):
+    path = str(tmp_path / "quarantine.txt")
+    Quarantine(path, "case_a").add(["/data/1.root", "/data/2.root"])
+    Quarantine(path, "case_b").add(["/data/3.root"])
+
+    assert Quarantine(path, "case_a").get_files() == {"/data/1.root", "/data/2.root"}
+    assert Quarantine(path, "case_b").get_files() == {"/data/3.root"}
+    assert Quarantine(path, "case_c").get_files() == set()
+
+
+def test_add_again(tmp_path):
+    path = str(tmp_path / "quarantine.txt")
+    quarantine = Quarantine(path, "case")
+    quarantine.add(["/data/1.root"])
+    quarantine.add(["/data/1.root", "/data/1.root"])
+
+    assert [entry[0] for entry in quarantine.read()] == ["/data/1.root"]
+
+
+def test_expiry(tmp_path):
+    path = tmp_path / "quarantine.txt"
+    time_old = int(time.time()) - 3 * 86400
+    path.write_text("/data/old.root %d case\n/data/new.root %d case\n" % (time_old, time.time()))
+    quarantine = Quarantine(str(path), "case", 86400)
+
+    assert quarantine.get_files() == {"/data/new.root"}
+    assert Quarantine(str(path), "case").get_files() == {"/data/old.root", "/data/new.root"}
+
+    quarantine.add(["/data/added.root"])
+    assert "/data/old.root" not in path.read_text()
+    assert quarantine.get_files() == {"/data/new.root", "/data/added.root"}
+
+
+def test_missing_list(tmp_path):
+    assert Quarantine(str(tmp_path / "missing.txt")).get_files() == set()
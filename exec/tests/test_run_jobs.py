@@ -0,0 +1,130 @@
+import json
+import os
+import subprocess as sp  # nosec B404
+import sys
+import time
+
+import pytest
+from conftest import DIR_EXEC
+from placement import make_slots_shared
+from run_jobs import Job, Merger, MergeTarget, Scheduler
+
+
+def run_merger(merger):
+    time_end = time.time() + 30
+    while not merger.is_done() and time.time() < time_end:
+        merger.update()
+        time.sleep(0.01)
+    return merger.is_done()
+
+
+def test_merger_tree(tmp_path, fake_hadd):
+    inputs = []
+    for index in range(5):
+        path = tmp_path / ("%d.txt" % index)
+        path.write_text("%d\n" % index)
+        inputs.append(str(path))
+    target = MergeTarget(str(tmp_path / "merged.txt"), inputs)
+    merger = Merger([target], fan_in=2, n_workers=2)
+    for index in range(4):
+        merger.add(index)
+    merger.update()
+    assert target.n_partial > 0  # partial merges start before all jobs finish
+    merger.skip()  # failed job
+
+    assert run_merger(merger)
+    assert merger.n_failed == 0
+    assert sorted(open(target.path_out).read().split()) == ["0", "1", "2", "3"]
+    assert not os.listdir(target.dir_partial)
+
+
+def test_merger_nothing(tmp_path):
+    target = MergeTarget(str(tmp_path / "merged.txt"), [str(tmp_path / "0.txt")])
+    merger = Merger([target])
+    merger.skip()
+
+    assert run_merger(merger)
+    assert not os.path.exists(target.path_out)
+
+
+def test_scheduler(tmp_path):
+    jobs = [Job(i, "echo %d > %s/%d.txt; exit $((%d %% 3 == 2))" % (i, tmp_path, i, i)) for i in range(6)]
+    scheduler = Scheduler(jobs, 2, mem_reserve=0, interval=0.01, slots=make_slots_shared(2))
+    path_report = str(tmp_path / "report.json")
+
+    assert scheduler.run() == 2
+    assert sorted(job.index for job in scheduler.jobs_done if job.exit_code) == [2, 5]
+    assert all((tmp_path / ("%d.txt" % i)).exists() for i in range(6))
+
+    scheduler.write_report(path_report)
+    with open(path_report) as file:
+        report = json.load(file)
+    assert "jobs" in report
+
+
+@pytest.fixture
+def batch(tmp_path):
+    """Two jobs with two input files each, one of which cannot be processed"""
+    dir_in = tmp_path / "input"
+    dir_in.mkdir()
+    files = {}
+    for name in ("a", "bad", "b", "c"):
+        files[name] = dir_in / name
+        files[name].write_text(name.upper() + "\n")
+    with open(tmp_path / "merge.txt", "w") as file_merge:
+        for index, names in enumerate((("a", "bad"), ("b", "c"))):
+            dir_job = tmp_path / str(index)
+            dir_job.mkdir()
+            (dir_job / "input.txt").write_text("".join("%s\n" % files[n] for n in names))
+            file_merge.write("%s\n" % (dir_job / "output.txt"))
+    return tmp_path
+
+
+def test_run_jobs_split(batch, fake_hadd):
+    command = (
+        'cd "%s/{}" && while read -r f; do grep -q BAD "$f" && exit 1; cat "$f"; done < input.txt > output.txt'
+        % (batch)
+    )
+    result = sp.run(  # nosec B603
+        [
+            sys.executable,
+            os.path.join(DIR_EXEC, "run_jobs.py"),
+            command,
+            "2",
+            "-j",
+            "2",
+            "--interval",
+            "0.05",
+            "--mem-reserve",
+            "0",
+            "--executor",
+            "fake",
+            "--executor-dir",
+            str(batch / "executor"),
+            "--split",
+            str(batch / "{}" / "input.txt"),
+            "--quarantine",
+            str(batch / "quarantine.txt"),
+            "--quarantine-scope",
+            "test",
+            "-m",
+            str(batch / "merge.txt"),
+            str(batch / "merged.txt"),
+            "--report",
+            str(batch / "report.json"),
+        ],
+        capture_output=True,
+        text=True,
+        timeout=120,
+        check=False,
+    )
+
+    assert result.returncode == 2, result.stdout + result.stderr
+    assert sorted((batch / "merged.txt").read_text().split()) == ["A", "B", "C"]
+    assert (batch / "quarantine.txt").read_text().split()[0] == str(batch / "input" / "bad")
+    with open(batch / "report.json") as file:
+        report = json.load(file)
+    statuses = {job["index"]: job["status"] for job in report["jobs"]}
+    assert statuses[0] == "split"
+    assert statuses[1] == "done"
+    assert sorted(statuses.values()).count("isolated") == 1
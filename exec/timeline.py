@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+"""
+Timeline tracing of validation steps and jobs
+
+Events are appended as JSON lines to an event file by the steering script (beginnings and ends of steps)
+and by the job runners (spans of runners, jobs and merges, see run_jobs.py).
+The event file is converted into a trace in the Chrome trace event format (<output>.json),
+which can be opened in Perfetto (https://ui.perfetto.dev) or chrome://tracing,
+and into a flat CSV table of spans (<output>.csv).
+
+In the trace, steps are shown in one track, jobs of each runner in one track per job slot
+and merges of each runner in as many tracks as needed to avoid overlaps.
+"""
+
+import argparse
+import csv
+import json
+import os
+import time
+from dataclasses import dataclass
+from typing import Dict, List
+
+from utilities import msg_fatal, msg_warn
+
+COLUMNS = [
+    "type",
+    "name",
+    "step",
+    "runner",
+    "index",
+    "pid",
+    "slot",
+    "bytes",
+    "exit_code",
+    "status",
+    "start",
+    "end",
+    "duration",
+]
+
+
+def append_event(path: str, event: dict):
+    """Append an event to the event file (one write so that events of parallel processes are not mixed)."""
+    line = (json.dumps(event) + "\n").encode()
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+@dataclass
+class Tracer:
+    """Records spans of a job runner in the event file"""
+
+    path: str  # event file
+    step: str  # name of the step run by the runner
+
+    def record(self, kind: str, name: str, start: float, end: float, **fields):
+        """Record a span."""
+        event = {"type": kind, "name": name, "step": self.step, "runner": os.getpid(), "start": start, "end": end}
+        event.update(fields)
+        try:
+            append_event(self.path, event)
+        except OSError as error:
+            msg_warn("Failed to record a trace event in %s: %s" % (self.path, error))
+
+
+def read_events(path: str) -> List[dict]:
+    """Read events from the event file."""
+    events = []
+    with open(path, "r") as file:
+        for line in file:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                msg_warn("Invalid trace event: %s" % line.strip())
+    return events
+
+
+def get_spans(events: List[dict]) -> List[dict]:
+    """Get spans of steps (paired beginnings and ends) and of runners, jobs and merges."""
+    spans = []
+    begins: Dict[str, List[dict]] = {}
+    time_last = max([e.get("end", e.get("time", 0)) for e in events], default=0)
+    for event in events:
+        if event["type"] == "step":
+            if event["phase"] == "begin":
+                begins.setdefault(event["name"], []).append(event)
+            elif begins.get(event["name"]):
+                begin = begins[event["name"]].pop()
+                spans.append(
+                    {
+                        "type": "step",
+                        "name": event["name"],
+                        "pid": begin["pid"],
+                        "exit_code": event.get("exit_code"),
+                        "start": begin["time"],
+                        "end": event["time"],
+                    }
+                )
+        else:
+            spans.append(event)
+    # Steps interrupted without an end last until the last event.
+    for name, unfinished in begins.items():
+        for begin in unfinished:
+            spans.append(
+                {"type": "step", "name": name, "pid": begin["pid"], "status": "unfinished", "start": begin["time"]}
+            )
+            spans[-1]["end"] = time_last
+    for span in spans:
+        span["duration"] = span["end"] - span["start"]
+    return sorted(spans, key=lambda s: (s["start"], s["end"]))
+
+
+def get_lanes(spans: List[dict]) -> List[int]:
+    """Assign spans (sorted by start) to lanes so that spans in one lane do not overlap."""
+    ends: List[float] = []
+    lanes = []
+    for span in spans:
+        lane = next((i for i, end in enumerate(ends) if end <= span["start"]), len(ends))
+        if lane == len(ends):
+            ends.append(0.0)
+        ends[lane] = span["end"]
+        lanes.append(lane)
+    return lanes
+
+
+def make_trace(spans: List[dict]) -> dict:
+    """Make a trace in the Chrome trace event format."""
+    time_zero = min([s["start"] for s in spans], default=0)
+    trace = []
+
+    def add_name(kind: str, pid: int, tid: int, name: str):
+        trace.append({"name": kind, "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}})
+
+    def add_span(span: dict, pid: int, tid: int):
+        args = {k: span[k] for k in COLUMNS if k in span and k not in ("type", "name", "start", "end", "duration")}
+        trace.append(
+            {
+                "name": span["name"],
+                "cat": span["type"],
+                "ph": "X",
+                "ts": round((span["start"] - time_zero) * 1e6),
+                "dur": round(span["duration"] * 1e6),
+                "pid": pid,
+                "tid": tid,
+                "args": args,
+            }
+        )
+
+    add_name("process_name", 0, 0, "steps")
+    add_name("thread_name", 0, 0, "steps")
+    for span in spans:
+        if span["type"] == "step":
+            add_span(span, 0, 0)
+    runners = sorted(
+        {s["runner"] for s in spans if "runner" in s},
+        key=lambda r: min(s["start"] for s in spans if s.get("runner") == r),
+    )
+    for runner in runners:
+        spans_runner = [s for s in spans if s.get("runner") == runner]
+        add_name("process_name", runner, 0, "%s (runner %d)" % (spans_runner[0]["step"], runner))
+        add_name("thread_name", runner, 0, "runner")
+        slots = set()
+        for span in spans_runner:
+            if span["type"] == "runner":
+                add_span(span, runner, 0)
+            elif span["type"] == "job":
+                slot = span.get("slot")
+                tid = 1 + (slot if slot is not None else 0)
+                if slot not in slots:
+                    slots.add(slot)
+                    add_name("thread_name", runner, tid, "slot %s" % slot)
+                add_span(span, runner, tid)
+        merges = [s for s in spans_runner if s["type"] == "merge"]
+        for span, lane in zip(merges, get_lanes(merges)):
+            tid = 10000 + lane
+            add_name("thread_name", runner, tid, "merge %d" % lane)
+            add_span(span, runner, tid)
+    return {"traceEvents": trace, "displayTimeUnit": "ms"}
+
+
+def write_outputs(spans: List[dict], path_out: str):
+    """Write the Chrome trace and the CSV table."""
+    with open(path_out + ".json", "w") as file:
+        json.dump(make_trace(spans), file)
+    with open(path_out + ".csv", "w", newline="") as file:
+        writer = csv.DictWriter(file, COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+        for span in spans:
+            writer.writerow(span)
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description="Record trace events and write traces.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    parser_event = subparsers.add_parser("event", help="record the beginning or the end of a step")
+    parser_event.add_argument("events", help="event file")
+    parser_event.add_argument("phase", choices=["begin", "end"], help="phase of the step")
+    parser_event.add_argument("name", help="name of the step")
+    parser_event.add_argument("-e", "--exit-code", type=int, help="exit code of the step")
+    parser_write = subparsers.add_parser("write", help="write the trace")
+    parser_write.add_argument("events", help="event file")
+    parser_write.add_argument("output", help="output path without extension")
+    args = parser.parse_args()
+
+    if args.command == "event":
+        event = {"type": "step", "phase": args.phase, "name": args.name, "pid": os.getppid(), "time": time.time()}
+        if args.exit_code is not None:
+            event["exit_code"] = args.exit_code
+        append_event(args.events, event)
+        return
+    if not os.path.isfile(args.events):
+        msg_fatal("Event file %s does not exist." % args.events)
+    write_outputs(get_spans(read_events(args.events)), args.output)
+
+
+if __name__ == "__main__":
+    main()
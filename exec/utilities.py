@@ -0,0 +1,43 @@
+"""
+Utilities for the Python scripts of the execution framework (counterpart of utilities.sh)
+"""
+
+import os
+import sys
+
+
+def eprint(*args, **kwargs):
+    """Print to stderr."""
+    print(*args, file=sys.stderr, **kwargs)
+
+
+def msg_step(message: str):
+    """Print a step message."""
+    eprint("\n\x1b[1;32m%s\x1b[0m" % message)
+
+
+def msg_bold(message: str):
+    """Print a boldface message."""
+    eprint("\x1b[1m%s\x1b[0m" % message)
+
+
+def msg_warn(message: str):
+    """Print a warning message."""
+    eprint("\x1b[1;36mWarning:\x1b[0m %s" % message)
+
+
+def msg_err(message: str):
+    """Print an error message."""
+    eprint("\x1b[1;31mError: %s\x1b[0m" % message)
+
+
+def msg_fatal(message: str):
+    """Print an error message and exit."""
+    msg_err(message)
+    sys.exit(1)
+
+
+def check_file(path: str):
+    """Exit with error if file does not exist."""
+    if not os.path.isfile(path):
+        msg_fatal("File %s does not exist." % path)